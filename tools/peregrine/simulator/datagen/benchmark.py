@@ -0,0 +1,586 @@
+"""Module for benchmarking the extraction, simulation and validation stages.
+
+Every benchmark case runs one stage on generated data in a fresh process, so
+that its peak resident set size is its own: group_inputs and
+accumulate_groups of extract_inputs.py on a synthetic AutoToken input,
+get_distributions of extract_inputs.py on a single group, generate of
+simulate_dataset.py (including write_output) and the KL-divergence of
+validate.py. The synthetic input is sampled from the distributions of a
+bundled trace, so the benchmarks run on a clean checkout. The results are
+stored as JSON and can be compared against the results of an earlier run.
+"""
+import argparse
+import contextlib
+import csv
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import distribution_store
+import extract_inputs
+import ingest
+import random_streams
+import simulate_dataset
+import validate
+
+RESULTS_VERSION = 1
+STAGES = [
+    "group_inputs",
+    "accumulate_groups",
+    "get_distributions",
+    "generate",
+    "kl_divergence",
+]
+# the dimensions each stage is measured across
+STAGE_DIMENSIONS = {
+    "group_inputs": ["rows", "jobs"],
+    "accumulate_groups": ["rows", "jobs", "workers"],
+    "get_distributions": ["rows"],
+    "generate": ["rows", "jobs"],
+    "kl_divergence": ["jobs"],
+}
+# number of instances of every job the KL-divergence is computed on
+KL_ROWS = 1000
+INPUT_HEADER = [
+    "JobId",
+    "VC",
+    "HT1",
+    "HT2",
+    "HT3",
+    "EstCardinality",
+    "InputCardinality",
+    "InputChildrenCardinality",
+    "AvgRowLength",
+    "EstCost",
+    "EstExclusiveCost",
+    "VertexCount",
+    "RequestedTokens",
+    "ActualMaxTokens",
+    "SubmitOffset",
+    "WaitTime",
+    "RunTime",
+]
+
+
+def case_key(case):
+    """
+    Get the name of a benchmark case, by which runs are compared
+    :param case: The case, a dict with the stage and its dimensions
+    :return: name
+    """
+    key = case["stage"]
+    for dimension in STAGE_DIMENSIONS[case["stage"]]:
+        key += " " + dimension + "=" + str(case[dimension])
+    return key
+
+
+def make_cases(stages, rows, jobs, workers):
+    """
+    Build the benchmark cases
+    :param stages: The stages to measure
+    :param rows: The row counts
+    :param jobs: The job counts
+    :param workers: The worker counts
+    :return: list of cases, without duplicates
+    """
+    values = {"rows": rows, "jobs": jobs, "workers": workers}
+    cases = {}
+    for stage in stages:
+        partial = [{"stage": stage}]
+        for dimension in STAGE_DIMENSIONS[stage]:
+            partial = [
+                dict(case, **{dimension: value})
+                for case in partial
+                for value in values[dimension]
+            ]
+        for case in partial:
+            cases[case_key(case)] = case
+    return list(cases.values())
+
+
+def job_distributions(dist_path, jobs):
+    """
+    Get the distributions of the first jobs of a distribution directory that
+    can be simulated, repeated if there are fewer of them
+    :param dist_path: The distribution directory
+    :param jobs: The number of jobs
+    :return: header, list of job distributions, see distribution_store
+    """
+    distributions = distribution_store.load(dist_path)
+    selected = []
+    for job in distributions.jobs():
+        _, mean, _, covar, dep_columns, _ = job
+        try:
+            simulate_dataset.factorize_dependent_data(dep_columns, mean, covar)
+        except np.linalg.LinAlgError:
+            continue
+        selected.append(job)
+        if len(selected) == jobs:
+            break
+    if not selected:
+        raise ValueError(dist_path + " has no job that can be simulated")
+    return distributions.header, [
+        selected[i % len(selected)] for i in range(jobs)
+    ]
+
+
+def sample_jobs(dist_path, rows, jobs, seed):
+    """
+    Sample instances of jobs, as they are written by simulate_dataset.py
+    :param dist_path: The distribution directory
+    :param rows: The total number of instances
+    :param jobs: The number of jobs
+    :param seed: The seed of the sample
+    :return: header, list of hash tags and list of cell matrices
+    """
+    header, dists = job_distributions(dist_path, jobs)
+    hash_tags, cells = [], []
+    for i, job in enumerate(dists):
+        size = rows // jobs + (1 if i < rows % jobs else 0)
+        rng = random_streams.job_rng(seed, i)
+        block = next(simulate_dataset.generate_blocks(job, size, rng=rng))
+        # repeated distributions get their own HT1
+        hash_tags.append(
+            job[0] if job[0] not in hash_tags else job[0] + str(i)
+        )
+        cells.append(simulate_dataset.format_rows(block, job[5]))
+    return header, hash_tags, cells
+
+
+def write_input(path, dist_path, rows, jobs, seed):
+    """
+    Write a synthetic AutoToken input, with the instances of the jobs in
+    random order
+    :param path: The output path
+    :param dist_path: The distribution directory to sample the jobs from
+    :param rows: The number of rows
+    :param jobs: The number of jobs
+    :param seed: The seed of the sample
+    """
+    _, hash_tags, cells = sample_jobs(dist_path, rows, jobs, seed)
+    input_rows = []
+    for hash_tag, job_cells in zip(hash_tags, cells):
+        for row in job_cells.tolist():
+            input_rows.append([row[0], hash_tag] + row[1:])
+    order = np.random.default_rng(seed).permutation(len(input_rows))
+    with open(path, "w", newline="\n") as input_file:
+        writer = csv.writer(input_file)
+        writer.writerow(INPUT_HEADER)
+        for job_id, i in enumerate(order):
+            writer.writerow([job_id + 1] + input_rows[i])
+
+
+def write_group(path, dist_path, rows, seed):
+    """
+    Write the data set of a single group, as written by group_inputs
+    :param path: The output path
+    :param dist_path: The distribution directory to sample the job from
+    :param rows: The number of rows
+    :param seed: The seed of the sample
+    """
+    header, _, cells = sample_jobs(dist_path, rows, 1, seed)
+    with open(path, "w", newline="\n") as group_file:
+        writer = csv.writer(group_file)
+        writer.writerow(header)
+        writer.writerows(cells[0].tolist())
+
+
+def prepare(cases, dist_path, work_path, seed):
+    """
+    Write the inputs of the cases that read files
+    :param cases: The cases
+    :param dist_path: The distribution directory to sample the inputs from
+    :param work_path: The directory to write the inputs to
+    :param seed: The seed of the inputs
+    """
+    for case in cases:
+        if case["stage"] in ["group_inputs", "accumulate_groups"]:
+            name = "input_" + str(case["rows"]) + "_" + str(case["jobs"])
+            case["input"] = os.path.join(work_path, name + ".csv")
+            if not os.path.exists(case["input"]):
+                write_input(
+                    case["input"], dist_path, case["rows"], case["jobs"], seed
+                )
+        elif case["stage"] == "get_distributions":
+            name = "group_" + str(case["rows"])
+            case["input"] = os.path.join(work_path, name + ".csv")
+            if not os.path.exists(case["input"]):
+                write_group(case["input"], dist_path, case["rows"], seed)
+
+
+def run_stage(case, dist_path, work_path, seed):
+    """
+    Run the stage of a case once, after setting up what is not measured
+    :param case: The case
+    :param dist_path: The distribution directory
+    :param work_path: A directory to write outputs to
+    :param seed: The seed of the simulation
+    :return: seconds, number of items processed and their unit
+    """
+    stage = case["stage"]
+    output_path = tempfile.mkdtemp(dir=work_path)
+    try:
+        if stage == "group_inputs":
+            start = time.perf_counter()
+            extract_inputs.group_inputs(
+                case["input"],
+                extract_inputs.HASH_TAG,
+                extract_inputs.HASH_TAG,
+                extract_inputs.COLUMNS,
+                output_path,
+                max_groups=case["jobs"],
+                support_threshold=2,
+            )
+            return time.perf_counter() - start, case["rows"], "rows"
+        if stage == "accumulate_groups":
+            start = time.perf_counter()
+            if case["workers"] > 1:
+                ingest.accumulate_groups_parallel(
+                    case["input"],
+                    extract_inputs.HASH_TAG,
+                    extract_inputs.HASH_TAG,
+                    extract_inputs.COLUMNS,
+                    extract_inputs.INT_COLUMNS,
+                    case["workers"],
+                )
+            else:
+                extract_inputs.accumulate_groups(
+                    case["input"],
+                    extract_inputs.HASH_TAG,
+                    extract_inputs.HASH_TAG,
+                    extract_inputs.COLUMNS,
+                    extract_inputs.INT_COLUMNS,
+                    max_groups=case["jobs"],
+                    support_threshold=2,
+                )
+            return time.perf_counter() - start, case["rows"], "rows"
+        if stage == "get_distributions":
+            int_columns = extract_inputs.shift_columns(
+                extract_inputs.COLUMNS, extract_inputs.INT_COLUMNS
+            )
+            start = time.perf_counter()
+            extract_inputs.get_distributions(case["input"], int_columns)
+            return time.perf_counter() - start, case["rows"], "rows"
+        if stage == "generate":
+            header, dists = job_distributions(dist_path, case["jobs"])
+            size = max(1, case["rows"] // case["jobs"])
+            start = time.perf_counter()
+            consolidated_path = os.path.join(output_path, "consolidated.csv")
+            with open(consolidated_path, "w", newline="\n") as f:
+                consolidated_csv = csv.writer(f)
+                for i, job in enumerate(dists):
+                    simulate_dataset.generate(
+                        header,
+                        job,
+                        os.path.join(output_path, str(i)),
+                        consolidated_csv,
+                        job[0],
+                        i == 0,
+                        size,
+                        rng=random_streams.job_rng(seed, i),
+                    )
+            return time.perf_counter() - start, size * len(dists), "rows"
+        if stage == "kl_divergence":
+            _, dists = job_distributions(dist_path, case["jobs"])
+            _, _, cells = sample_jobs(
+                dist_path, KL_ROWS * case["jobs"], case["jobs"], seed
+            )
+            samples = [
+                (np.mean(values, axis=0), np.cov(values.T))
+                for values in (c.astype(np.float64) for c in cells)
+            ]
+            start = time.perf_counter()
+            for job, (mean, covar) in zip(dists, samples):
+                try:
+                    validate.mv_kullback_leibler_divergence(
+                        job[1], mean, job[3], covar, job[4]
+                    )
+                except np.linalg.LinAlgError:
+                    pass
+            return time.perf_counter() - start, len(dists), "jobs"
+        raise ValueError("Unknown stage " + stage)
+    finally:
+        shutil.rmtree(output_path)
+
+
+def peak_rss():
+    """
+    Get the peak resident set size of this process and of its finished
+    children, whichever is larger
+    :return: peak RSS in MB
+    """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss keeps the peak of the parent process across fork and exec on
+    # Linux, while VmHWM only covers this process
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return max(int(line.split()[1]), children) / 2 ** 10
+    except OSError:
+        pass
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, children)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        return peak / 2 ** 20
+    return peak / 2 ** 10
+
+
+def run_case(case, dist_path, work_path, seed, repeat):
+    """
+    Measure a case in this process, keeping the fastest of several runs
+    :param case: The case
+    :param dist_path: The distribution directory
+    :param work_path: A directory to write outputs to
+    :param seed: The seed of the simulation
+    :param repeat: The number of runs
+    :return: dict with the measurements
+    """
+    times = []
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        for _ in range(repeat):
+            seconds, count, unit = run_stage(case, dist_path, work_path, seed)
+            times.append(seconds)
+    seconds = min(times)
+    return {
+        "seconds": seconds,
+        "count": count,
+        "unit": unit,
+        "rate": count / seconds if seconds > 0 else float("inf"),
+        "peak_rss_mb": peak_rss(),
+    }
+
+
+def measure(case, args):
+    """
+    Measure a case in a fresh process
+    :param case: The case
+    :param args: The parsed arguments
+    :return: dict with the measurements
+    """
+    command = [
+        sys.executable,
+        os.path.abspath(__file__),
+        "--case",
+        json.dumps(case),
+        "--distributions",
+        args.distributions,
+        "--work-dir",
+        args.work_dir,
+        "--seed",
+        str(args.seed),
+        "--repeat",
+        str(args.repeat),
+    ]
+    result = subprocess.run(
+        command, stdout=subprocess.PIPE, check=True, universal_newlines=True
+    )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def compare(results, baseline, threshold, rss_threshold):
+    """
+    Compare results against a baseline
+    :param results: The results of this run
+    :param baseline: The results of the baseline run
+    :param threshold: The relative drop of the rate that is a regression
+    :param rss_threshold: The relative growth of the peak RSS that is a
+        regression
+    :return: list of lines describing the comparison, list of regressed cases
+    """
+    lines, regressions = [], []
+    for key, result in results["cases"].items():
+        if key not in baseline["cases"]:
+            lines.append(key + ": not in the baseline")
+            continue
+        base = baseline["cases"][key]
+        rate_change = result["rate"] / base["rate"] - 1
+        rss_change = result["peak_rss_mb"] / base["peak_rss_mb"] - 1
+        regressed = rate_change < -threshold or rss_change > rss_threshold
+        lines.append(
+            key
+            + ": rate {:+.1%}, peak RSS {:+.1%}".format(
+                rate_change, rss_change
+            )
+            + (" REGRESSION" if regressed else "")
+        )
+        if regressed:
+            regressions.append(key)
+    return lines, regressions
+
+
+def int_list(value):
+    """
+    Parse a comma separated list of integers
+    :param value: The list
+    :return: list of ints
+    """
+    return [int(v) for v in value.split(",")]
+
+
+def parse_args():
+    """
+    Parse the command line arguments
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(usage="benchmark.py [options]")
+    parser.add_argument(
+        "--stages",
+        default=",".join(STAGES),
+        help="comma separated stages to measure, out of " + ", ".join(STAGES),
+    )
+    parser.add_argument(
+        "--rows",
+        type=int_list,
+        default=[20000, 100000],
+        help="comma separated row counts",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int_list,
+        default=[10, 100],
+        help="comma separated job counts",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int_list,
+        default=[1, 2],
+        help="comma separated worker counts of accumulate_groups",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="number of runs of every case, the fastest is kept",
+    )
+    parser.add_argument(
+        "--distributions",
+        default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            "..",
+            "distributions",
+            "Trace1",
+            "training_distributions",
+        ),
+        help="distribution directory to sample the inputs and jobs from",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="seed of the inputs and jobs"
+    )
+    parser.add_argument(
+        "--work-dir",
+        default=None,
+        help="directory for the inputs and outputs, a temporary directory "
+        "if not given",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="write the results to this path as JSON",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="compare the results against the results of an earlier run",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative drop of the rate of a case that is a regression",
+    )
+    parser.add_argument(
+        "--rss-threshold",
+        type=float,
+        default=0.2,
+        help="relative growth of the peak RSS of a case that is a regression",
+    )
+    # runs a single case, used by the benchmark itself
+    parser.add_argument("--case", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.stages = args.stages.split(",")
+    for stage in args.stages:
+        if stage not in STAGES:
+            parser.error("unknown stage " + stage)
+    if args.repeat < 1:
+        parser.error("--repeat must be positive")
+    if min(args.rows + args.jobs + args.workers) < 1:
+        parser.error("the row, job and worker counts must be positive")
+    return args
+
+
+def main():
+    """
+    Main method
+    """
+    args = parse_args()
+    if args.case is not None:
+        result = run_case(
+            json.loads(args.case),
+            args.distributions,
+            args.work_dir,
+            args.seed,
+            args.repeat,
+        )
+        print(json.dumps(result))
+        return
+
+    temporary = args.work_dir is None
+    if temporary:
+        args.work_dir = tempfile.mkdtemp()
+    try:
+        cases = make_cases(args.stages, args.rows, args.jobs, args.workers)
+        prepare(cases, args.distributions, args.work_dir, args.seed)
+        results = {
+            "version": RESULTS_VERSION,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "repeat": args.repeat,
+            "cases": {},
+        }
+        for case in cases:
+            result = measure(case, args)
+            results["cases"][case_key(case)] = dict(
+                {name: case[name] for name in case if name != "input"},
+                **result
+            )
+            print(
+                case_key(case)
+                + ": {:.0f} {}/s, {:.3f} s, peak RSS {:.0f} MB".format(
+                    result["rate"],
+                    result["unit"],
+                    result["seconds"],
+                    result["peak_rss_mb"],
+                )
+            )
+    finally:
+        if temporary:
+            shutil.rmtree(args.work_dir)
+
+    if args.output is not None:
+        with open(args.output, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        lines, regressions = compare(
+            results, baseline, args.threshold, args.rss_threshold
+        )
+        print("\nCompared with " + args.baseline + ":")
+        for line in lines:
+            print(line)
+        if regressions:
+            print("\n" + str(len(regressions)) + " cases regressed.")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
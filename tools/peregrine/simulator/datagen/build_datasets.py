@@ -0,0 +1,440 @@
+"""Module for simulating and validating the datasets of several traces.
+
+Every (trace, mode, size) target runs the steps of datagen.sh in its own
+processes: simulate_dataset.py, then validate.py unless the validation is
+fused into the simulation. The targets run concurrently as long as the sum of
+their workers fits in the CPU budget and the sum of their estimated peak
+memory fits in the memory budget. As with make, a target is skipped when its
+outputs are newer than the distributions.csv and header.csv it is simulated
+from, and were built with the same parameters, which are recorded in a build
+stamp once all steps succeed.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+MODES = ["training", "testing"]
+# peak memory of a simulation or validation process, measured without any
+# job, and per instance of a job held in memory, in bytes
+PROCESS_MEMORY = 64 * 2 ** 20
+INSTANCE_MEMORY = 2500
+# time between two checks of the running steps, in seconds
+POLL_SECONDS = 0.1
+
+
+class Target:
+    """
+    One dataset to simulate and validate, with the layout of datagen.sh
+    :param root: The directory holding the trace directories
+    :param trace: The trace name, e.g. Trace1
+    :param mode: training or testing
+    :param size: The size per query
+    :param suffix: Whether to add the size to the output names, for builds
+        of several sizes
+    """
+
+    def __init__(self, root, trace, mode, size, suffix=False):
+        self.trace = trace
+        self.mode = mode
+        self.size = size
+        self.dist_path = os.path.join(root, trace, mode + "_distributions")
+        name = mode + "_" + str(size) if suffix else mode
+        self.gen_path = os.path.join(root, trace)
+        prefix = os.path.join(self.gen_path, name)
+        self.sim_path = prefix + "_sim"
+        self.output_path = prefix + ".csv"
+        self.kl_table_path = prefix + "_KL.csv"
+        self.kl_path = prefix + "_KL.txt"
+        self.log_path = prefix + ".log"
+        self.stamp_path = prefix + ".build.json"
+
+    def __str__(self):
+        return self.trace + " " + self.mode + " " + str(self.size)
+
+    def inputs(self):
+        """
+        Get the files the target is built from
+        :return: list of paths
+        """
+        return [
+            os.path.join(self.dist_path, "distributions.csv"),
+            os.path.join(self.dist_path, "header.csv"),
+        ]
+
+    def outputs(self, params):
+        """
+        Get the files the target builds
+        :param params: The build parameters
+        :return: list of paths
+        """
+        outputs = [
+            self.output_path,
+            self.output_path + ".seeds.json",
+            self.kl_table_path,
+            self.kl_path,
+        ]
+        if not params["no_job_files"]:
+            outputs.append(self.sim_path)
+        return outputs
+
+    def memory(self, params):
+        """
+        Estimate the peak memory of the target
+        :param params: The build parameters
+        :return: memory in bytes
+        """
+        instances = self.size
+        if params["chunk_rows"] is not None:
+            instances = min(instances, params["chunk_rows"])
+        job_memory = PROCESS_MEMORY + instances * INSTANCE_MEMORY
+        # the pool workers each hold a job, next to the parent process
+        if params["workers"] > 1:
+            return PROCESS_MEMORY + params["workers"] * job_memory
+        return job_memory
+
+    def up_to_date(self, params):
+        """
+        Check whether the outputs of the target are newer than its inputs and
+        were built with the same parameters
+        :param params: The build parameters
+        :return: True if the target can be skipped
+        """
+        # the stamp is written last, so it stands for the time of the outputs
+        try:
+            with open(self.stamp_path) as stamp_file:
+                built = json.load(stamp_file)
+            newest_input = max(
+                os.path.getmtime(path) for path in self.inputs()
+            )
+            built_time = os.path.getmtime(self.stamp_path)
+        except (OSError, ValueError):
+            return False
+        if not all(os.path.exists(path) for path in self.outputs(params)):
+            return False
+        if params["seed"] is None:
+            # without a seed, any seed drawn by the last build will do
+            built["seed"] = None
+        return built == self.stamp(params) and built_time >= newest_input
+
+    def stamp(self, params):
+        """
+        Get what the build stamp records
+        :param params: The build parameters
+        :return: dict
+        """
+        return dict(params, size=self.size)
+
+    def steps(self, params):
+        """
+        Get the commands that build the target
+        :param params: The build parameters
+        :return: list of command lines and the paths their output goes to
+        """
+        datagen_path = os.path.dirname(os.path.abspath(__file__))
+        simulate = [
+            sys.executable,
+            os.path.join(datagen_path, "simulate_dataset.py"),
+            self.dist_path,
+            self.sim_path,
+            self.output_path,
+            str(self.size),
+            "--workers",
+            str(params["workers"]),
+        ]
+        if params["seed"] is not None:
+            simulate += ["--seed", str(params["seed"])]
+        if params["chunk_rows"] is not None:
+            simulate += ["--chunk-rows", str(params["chunk_rows"])]
+        if params["no_job_files"]:
+            simulate.append("--no-job-files")
+        if params["fused"]:
+            simulate += ["--kl-table", self.kl_table_path]
+            return [(simulate, self.kl_path)]
+        validate = [
+            sys.executable,
+            os.path.join(datagen_path, "validate.py"),
+            self.dist_path,
+            self.sim_path,
+            "--table",
+            self.kl_table_path,
+        ]
+        return [(simulate, self.log_path), (validate, self.kl_path)]
+
+
+class Build:
+    """
+    Runs the steps of a target one after the other
+    :param target: The Target to build
+    :param params: The build parameters
+    """
+
+    def __init__(self, target, params):
+        self.target = target
+        self.params = params
+        self.steps = target.steps(params)
+        self.process = None
+        self.files = []
+        self.started = time.monotonic()
+        self.failed = False
+        if os.path.exists(target.stamp_path):
+            os.remove(target.stamp_path)
+        if not os.path.exists(target.sim_path):
+            os.makedirs(target.sim_path)
+        self.log = open(target.log_path, "w")
+        self.next_step()
+
+    def next_step(self):
+        """
+        Start the next step
+        """
+        args, output_path = self.steps.pop(0)
+        if output_path == self.target.log_path:
+            output = self.log
+        else:
+            output = open(output_path, "w")
+            self.files.append(output)
+        self.process = subprocess.Popen(args, stdout=output, stderr=self.log)
+
+    def poll(self):
+        """
+        Check whether the current step is done, and start the next one
+        :return: True if the target is built or failed
+        """
+        code = self.process.poll()
+        if code is None:
+            return False
+        if code != 0:
+            self.failed = True
+        elif self.steps:
+            self.next_step()
+            return False
+        for output in self.files:
+            output.close()
+        self.log.close()
+        if not self.failed:
+            with open(self.target.stamp_path, "w") as stamp_file:
+                json.dump(self.target.stamp(self.params), stamp_file)
+        return True
+
+
+def find_traces(root, modes):
+    """
+    Find the traces that have distributions for any of the modes
+    :param root: The directory holding the trace directories
+    :param modes: The modes
+    :return: sorted list of trace names
+    """
+    return sorted(
+        name
+        for name in os.listdir(root)
+        if any(
+            os.path.isdir(os.path.join(root, name, mode + "_distributions"))
+            for mode in modes
+        )
+    )
+
+
+def build(targets, params, cpus, memory=None, force=False, dry_run=False):
+    """
+    Build the targets that are not up to date, as many at a time as the
+    budgets allow. A target that does not fit in the budgets on its own is
+    built alone.
+    :param targets: The Targets
+    :param params: The build parameters
+    :param cpus: The number of processes that can run at once
+    :param memory: The memory the builds can use at once in bytes, None for
+        no limit
+    :param force: Whether to build the targets that are up to date
+    :param dry_run: Whether to only print the targets that would be built
+    :return: list of the targets that failed
+    """
+    pending = []
+    for target in targets:
+        if not os.path.isfile(target.inputs()[0]):
+            print(str(target) + ": no distributions, skipped")
+        elif not force and target.up_to_date(params):
+            print(str(target) + ": up to date")
+        else:
+            pending.append(target)
+    if dry_run:
+        for target in pending:
+            print(str(target) + ": would be built")
+        return []
+    # the largest targets first, as they bound the total time
+    pending.sort(key=lambda target: target.size, reverse=True)
+
+    running = []
+    failed = []
+    while pending or running:
+        for run in list(running):
+            if run.poll():
+                running.remove(run)
+                seconds = time.monotonic() - run.started
+                if run.failed:
+                    failed.append(run.target)
+                    print(
+                        str(run.target)
+                        + ": failed, see "
+                        + run.target.log_path
+                    )
+                else:
+                    print(
+                        str(run.target)
+                        + ": built in "
+                        + str(round(seconds, 1))
+                        + " s"
+                    )
+        used_cpus = len(running) * params["workers"]
+        used_memory = sum(run.target.memory(params) for run in running)
+        for target in list(pending):
+            fits = used_cpus + params["workers"] <= cpus and (
+                memory is None or used_memory + target.memory(params) <= memory
+            )
+            if fits or not running:
+                pending.remove(target)
+                print(str(target) + ": building")
+                running.append(Build(target, params))
+                used_cpus += params["workers"]
+                used_memory += target.memory(params)
+        time.sleep(POLL_SECONDS)
+    return failed
+
+
+def parse_args():
+    """
+    Parse the command line arguments
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        usage="build_datasets.py <size-per-query> [<size-per-query> ...] "
+        "[options]"
+    )
+    parser.add_argument("sizes", metavar="size-per-query", type=int, nargs="+")
+    parser.add_argument(
+        "--root",
+        default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            "..",
+            "distributions",
+        ),
+        help="directory holding the trace directories",
+    )
+    parser.add_argument(
+        "--traces",
+        default=None,
+        help="comma separated traces to build, all the traces under the "
+        "root directory if not given",
+    )
+    parser.add_argument(
+        "--modes",
+        default=",".join(MODES),
+        help="comma separated modes to build",
+    )
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        default=os.cpu_count(),
+        help="number of simulation and validation processes that can run "
+        "at once",
+    )
+    parser.add_argument(
+        "--memory",
+        type=int,
+        default=None,
+        help="memory budget of the builds in MB, not limited if not given",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes simulating every target",
+    )
+    parser.add_argument(
+        "--chunk-rows",
+        type=int,
+        default=None,
+        help="generate and write each job in blocks of this many instances",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="global seed of every simulation, drawn at random for each if "
+        "not given",
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="validate the jobs while they are simulated",
+    )
+    parser.add_argument(
+        "--no-job-files",
+        action="store_true",
+        help="only write the consolidated outputs, implies --fused",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="build the targets that are up to date too",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only print the targets that would be built",
+    )
+    args = parser.parse_args()
+    if min(args.sizes) < 1:
+        parser.error("the sizes per query must be positive")
+    if args.cpus < 1:
+        parser.error("--cpus must be positive")
+    if args.memory is not None and args.memory < 1:
+        parser.error("--memory must be positive")
+    if args.workers < 1:
+        parser.error("--workers must be positive")
+    if args.chunk_rows is not None and args.chunk_rows < 1:
+        parser.error("--chunk-rows must be positive")
+    if args.no_job_files:
+        # validate.py reads the job files back
+        args.fused = True
+    args.modes = args.modes.split(",")
+    if args.traces is None:
+        args.traces = find_traces(args.root, args.modes)
+    else:
+        args.traces = args.traces.split(",")
+    return args
+
+
+def main():
+    """
+    Main method
+    """
+    args = parse_args()
+    params = {
+        "workers": args.workers,
+        "chunk_rows": args.chunk_rows,
+        "seed": args.seed,
+        "fused": args.fused,
+        "no_job_files": args.no_job_files,
+    }
+    suffix = len(args.sizes) > 1
+    targets = [
+        Target(args.root, trace, mode, size, suffix)
+        for trace in args.traces
+        for mode in args.modes
+        for size in args.sizes
+    ]
+    memory = None
+    if args.memory is not None:
+        memory = args.memory * 2 ** 20
+    failed = build(
+        targets, params, args.cpus, memory, args.force, args.dry_run
+    )
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
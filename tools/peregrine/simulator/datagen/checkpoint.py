@@ -0,0 +1,221 @@
+"""Module for resuming interrupted simulation runs.
+
+A resumable run records every job that is completely written in a progress
+manifest: its HT1, the number of rows, byte offset and size of its instances
+in the consolidated output, and the CRC32 of these bytes, along with the
+settings of the run. The manifest is replaced by renaming a new version over
+it, once the consolidated output is flushed to disk up to the offsets it
+records, so it never describes output that was not written. A restarted run
+truncates the consolidated output back to the end of the last recorded job,
+skips the recorded jobs and appends the remaining ones.
+"""
+import csv
+import json
+import os
+import time
+import zlib
+
+MANIFEST_VERSION = 1
+# minimum time between two commits of the manifest, in seconds
+COMMIT_SECONDS = 10
+
+
+def progress_path(consolidated_output_path):
+    """
+    Get the path of the progress manifest of a consolidated output
+    :param consolidated_output_path: The consolidated output path
+    :return: manifest path
+    """
+    return consolidated_output_path + ".progress.json"
+
+
+def read_manifest(path):
+    """
+    Read a progress manifest
+    :param path: The manifest path
+    :return: dict with the settings of the run, the recorded jobs and the
+        offset of the end of the last one
+    """
+    with open(path) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest["version"] != MANIFEST_VERSION:
+        raise ValueError(
+            "Unsupported progress manifest version " + str(manifest["version"])
+        )
+    return manifest
+
+
+def file_crc32(path, offset, size):
+    """
+    Compute the CRC32 of a range of bytes of a file
+    :param path: The file path
+    :param offset: The offset of the first byte
+    :param size: The number of bytes
+    :return: CRC32
+    """
+    crc = 0
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while size > 0:
+            data = f.read(min(size, 1 << 20))
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            size -= len(data)
+    return crc
+
+
+class JobRecorder:
+    """
+    Text file wrapper that splits what is written through it into jobs,
+    keeping the rows, byte offset, size and CRC32 of every job
+    :param file: The text file to write to
+    :param offset: The byte offset of the current position of the file
+    :param checkpoint: The Checkpoint to record every job in, None to only
+        keep them in jobs
+    """
+
+    def __init__(self, file, offset=0, checkpoint=None):
+        self.file = file
+        self.offset = offset
+        self.checkpoint = checkpoint
+        self.start = offset
+        self.rows = 0
+        self.crc = 0
+        self.jobs = []
+
+    def write(self, text):
+        data = text.encode(self.file.encoding)
+        self.crc = zlib.crc32(data, self.crc)
+        self.rows += data.count(b"\n")
+        self.offset += len(data)
+        return self.file.write(text)
+
+    def end_job(self, hash_tag, failed=False):
+        """
+        Record the job whose instances were written since the last one
+        :param hash_tag: The hash tag of the job
+        :param failed: Whether the job could not be simulated
+        """
+        job = {
+            "hash_tag": str(hash_tag),
+            "rows": self.rows,
+            "offset": self.start,
+            "bytes": self.offset - self.start,
+            "crc32": self.crc,
+            "failed": failed,
+        }
+        self.start = self.offset
+        self.rows = 0
+        self.crc = 0
+        if self.checkpoint is None:
+            self.jobs.append(job)
+        else:
+            self.checkpoint.add([job])
+            self.checkpoint.commit(self.file)
+
+
+class Checkpoint:
+    """
+    Progress manifest of a resumable run
+    :param path: The manifest path
+    :param settings: The settings of the run, which must be the same as the
+        ones of the run being resumed
+    """
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+        self.jobs = []
+        self.end = None
+        self.committed = time.monotonic()
+        if os.path.isfile(path):
+            manifest = read_manifest(path)
+            if manifest["settings"] != settings:
+                raise ValueError(
+                    "The run recorded in " + path + " has other settings, "
+                    "remove it to start a new run"
+                )
+            self.jobs = manifest["jobs"]
+            self.end = manifest["end"]
+
+    def done(self):
+        """
+        Get the jobs recorded, including the ones that failed
+        :return: set of hash tags
+        """
+        return {job["hash_tag"] for job in self.jobs}
+
+    def failed(self):
+        """
+        Get the recorded jobs that could not be simulated
+        :return: list of hash tags
+        """
+        return [job["hash_tag"] for job in self.jobs if job["failed"]]
+
+    def open_output(self, output_path, header):
+        """
+        Open the consolidated output for appending, truncated to the end of
+        the last recorded job, or new with its header if the run starts
+        :param output_path: The consolidated output path
+        :param header: The header of the consolidated output
+        :return: text file
+        """
+        if self.end is None:
+            output = open(output_path, "w", newline="\n")
+            csv.writer(output).writerow(header)
+            output.flush()
+            self.end = output.tell()
+            self.commit(output, force=True)
+            return output
+        if os.path.getsize(output_path) < self.end:
+            raise ValueError(
+                output_path + " is shorter than recorded in " + self.path
+            )
+        if self.jobs:
+            last = self.jobs[-1]
+            if file_crc32(output_path, last["offset"], last["bytes"]) != (
+                last["crc32"]
+            ):
+                raise ValueError(
+                    "The last job recorded in " + self.path + " does not "
+                    "match " + output_path
+                )
+        os.truncate(output_path, self.end)
+        return open(output_path, "a", newline="\n")
+
+    def add(self, jobs, base=0):
+        """
+        Record jobs written after the last recorded one
+        :param jobs: The jobs, see JobRecorder
+        :param base: The offset to add to the offsets of the jobs
+        """
+        for job in jobs:
+            job = dict(job, offset=job["offset"] + base)
+            self.jobs.append(job)
+            self.end = job["offset"] + job["bytes"]
+
+    def commit(self, output, force=False):
+        """
+        Write the manifest, at most every COMMIT_SECONDS unless forced, after
+        flushing the consolidated output to disk
+        :param output: The consolidated output file
+        :param force: Whether to commit now
+        """
+        now = time.monotonic()
+        if not force and now - self.committed < COMMIT_SECONDS:
+            return
+        output.flush()
+        os.fsync(output.fileno())
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "settings": self.settings,
+            "end": self.end,
+            "jobs": self.jobs,
+        }
+        with open(self.path + ".tmp", "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(self.path + ".tmp", self.path)
+        self.committed = now
@@ -0,0 +1,260 @@
+"""Module for the columnar format of the consolidated output.
+
+A columnar data set is a directory holding one file per column, with the
+values of the column as fixed-width little endian binary, and a manifest.json
+describing the columns. Integer columns are stored as int64 and the other
+columns as float64. HT1 is dictionary encoded: its file holds, for every row,
+the position of the hash tag of the row in the dictionary of the manifest.
+Numeric hash tags can also be stored as int64 values without a dictionary,
+for outputs with too many jobs to keep their hash tags in memory. Every column
+can be memory mapped on its own.
+"""
+
+import json
+import os
+import shutil
+import numpy as np
+
+MANIFEST = "manifest.json"
+FORMAT_VERSION = 1
+HASH_TAG = "HT1"
+INT_DTYPE = np.dtype("<i8")
+FLOAT_DTYPE = np.dtype("<f8")
+CODE_DTYPE = np.dtype("<u4")
+INT_LIMIT = 2.0 ** 63
+
+
+def column_file(name):
+    """
+    Get the file name of a column
+    :param name: The column name
+    :return: file name
+    """
+    return name + ".bin"
+
+
+class ColumnarWriter:
+    """
+    Writer of a columnar data set
+    :param path: The output directory, created if needed
+    :param header: The names of the columns, without HT1
+    :param int_mask: Which columns are integer columns
+    :param hash_tags: The dictionary of hash tags of the rows, None to store
+        the hash tags, which must be integers, as int64 values
+    """
+
+    def __init__(self, path, header, int_mask, hash_tags):
+        self.path = path
+        self.header = list(header)
+        self.int_mask = np.asarray(int_mask, dtype=bool)
+        self.hash_tags = None
+        self.codes = None
+        if hash_tags is not None:
+            self.hash_tags = [str(hash_tag) for hash_tag in hash_tags]
+            self.codes = {
+                hash_tag: i for i, hash_tag in enumerate(self.hash_tags)
+            }
+        self.rows = 0
+        self.saturated = dict.fromkeys(self.header, 0)
+        if not os.path.exists(path):
+            os.mkdir(path)
+        self.files = [
+            open(os.path.join(path, column_file(name)), "wb")
+            for name in [HASH_TAG] + self.header
+        ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def part_args(self):
+        """
+        Get the arguments, after the path, of a writer of a part of this data
+        set, to be merged with append_part
+        :return: tuple of arguments
+        """
+        return self.header, self.int_mask, self.hash_tags
+
+    def write(self, hash_tag, values):
+        """
+        Append the rows of a job
+        :param hash_tag: The hash tag of the job
+        :param values: The values of the rows, shape [n, d]
+        """
+        n = values.shape[0]
+        if self.codes is None:
+            codes = np.full(n, int(hash_tag), dtype=INT_DTYPE)
+        else:
+            codes = np.full(n, self.codes[str(hash_tag)], dtype=CODE_DTYPE)
+        self.files[0].write(codes.tobytes())
+        for i, name in enumerate(self.header):
+            column = values[:, i]
+            if self.int_mask[i]:
+                # int64 cannot hold the largest cardinalities, which are
+                # clipped and counted
+                low = column < -INT_LIMIT
+                high = column >= INT_LIMIT
+                ints = np.where(low | high, 0, column).astype(INT_DTYPE)
+                if low.any() or high.any():
+                    self.saturated[name] += int(low.sum() + high.sum())
+                    ints[low] = np.iinfo(INT_DTYPE).min
+                    ints[high] = np.iinfo(INT_DTYPE).max
+                column = ints
+            else:
+                column = column.astype(FLOAT_DTYPE)
+            self.files[i + 1].write(column.tobytes())
+        self.rows += n
+
+    def append_part(self, part_path):
+        """
+        Append the rows of another columnar data set with the same columns and
+        hash tag dictionary, and remove it
+        :param part_path: The directory of the other data set
+        """
+        manifest = read_manifest(part_path)
+        for name, f in zip([HASH_TAG] + self.header, self.files):
+            with open(
+                os.path.join(part_path, column_file(name)), "rb"
+            ) as part:
+                shutil.copyfileobj(part, f)
+        self.rows += manifest["rows"]
+        for name, count in manifest["saturated"].items():
+            self.saturated[name] += count
+        shutil.rmtree(part_path)
+
+    def append_rows(self, part_path, start, stop):
+        """
+        Append a range of rows of another columnar data set with the same
+        columns and hash tag dictionary
+        :param part_path: The directory of the other data set
+        :param start: The first row
+        :param stop: The row after the last one
+        """
+        for name, f in zip([HASH_TAG] + self.header, self.files):
+            dtype = self.hash_tag_dtype()
+            if name != HASH_TAG:
+                i = self.header.index(name)
+                dtype = INT_DTYPE if self.int_mask[i] else FLOAT_DTYPE
+            column = np.fromfile(
+                os.path.join(part_path, column_file(name)),
+                dtype=dtype,
+                count=stop - start,
+                offset=start * dtype.itemsize,
+            )
+            if name != HASH_TAG and dtype == INT_DTYPE:
+                # the values were clipped to the bounds when written
+                bounds = np.iinfo(INT_DTYPE)
+                self.saturated[name] += int(
+                    np.count_nonzero(
+                        (column == bounds.min) | (column == bounds.max)
+                    )
+                )
+            f.write(column.tobytes())
+        self.rows += stop - start
+
+    def hash_tag_dtype(self):
+        """
+        Get the type of the values of the HT1 file
+        :return: numpy dtype
+        """
+        return CODE_DTYPE if self.codes is not None else INT_DTYPE
+
+    def flush(self):
+        """
+        Flush the column files
+        """
+        for f in self.files:
+            f.flush()
+
+    def close(self):
+        """
+        Close the column files and write the manifest
+        """
+        for f in self.files:
+            f.close()
+        hash_tag_column = {
+            "name": HASH_TAG,
+            "dtype": self.hash_tag_dtype().str,
+            "file": column_file(HASH_TAG),
+        }
+        if self.hash_tags is not None:
+            hash_tag_column["dictionary"] = self.hash_tags
+        columns = [hash_tag_column]
+        for i, name in enumerate(self.header):
+            dtype = INT_DTYPE if self.int_mask[i] else FLOAT_DTYPE
+            columns.append(
+                {"name": name, "dtype": dtype.str, "file": column_file(name)}
+            )
+        manifest = {
+            "version": FORMAT_VERSION,
+            "rows": self.rows,
+            "columns": columns,
+            "saturated": {
+                name: count
+                for name, count in self.saturated.items()
+                if count > 0
+            },
+        }
+        with open(os.path.join(self.path, MANIFEST), "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+
+
+def read_manifest(path):
+    """
+    Read the manifest of a columnar data set
+    :param path: The directory of the data set
+    :return: dict with the number of rows, the columns and the number of
+        saturated values per column
+    """
+    with open(os.path.join(path, MANIFEST)) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest["version"] != FORMAT_VERSION:
+        raise ValueError(
+            "Unsupported columnar format version " + str(manifest["version"])
+        )
+    return manifest
+
+
+def read_columns(path, columns=None, mmap_mode="r"):
+    """
+    Read columns of a columnar data set
+    :param path: The directory of the data set
+    :param columns: The names of the columns to read, None for all columns
+    :param mmap_mode: The numpy memory mapping mode, None to load into memory
+    :return: dict of column name to array, HT1 holding dictionary positions
+        or the hash tags themselves if it has no dictionary
+    """
+    manifest = read_manifest(path)
+    specs = {spec["name"]: spec for spec in manifest["columns"]}
+    if columns is None:
+        columns = list(specs)
+    arrays = {}
+    for name in columns:
+        spec = specs[name]
+        file = os.path.join(path, spec["file"])
+        dtype = np.dtype(spec["dtype"])
+        if mmap_mode is None or manifest["rows"] == 0:
+            arrays[name] = np.fromfile(file, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(
+                file, dtype=dtype, mode=mmap_mode, shape=(manifest["rows"],)
+            )
+    return arrays
+
+
+def read_hash_tags(path):
+    """
+    Read the HT1 column of a columnar data set, decoded
+    :param path: The directory of the data set
+    :return: array of hash tags
+    """
+    manifest = read_manifest(path)
+    codes = read_columns(path, [HASH_TAG])[HASH_TAG]
+    if "dictionary" not in manifest["columns"][0]:
+        return np.asarray(codes).astype(np.str_)
+    dictionary = np.asarray(
+        manifest["columns"][0]["dictionary"], dtype=np.str_
+    )
+    return dictionary[codes]
@@ -25,6 +25,12 @@
 # Example invocations: 
 #       ./datagen.sh Trace3 training 1000
 #       ./datagen.sh Trace1 testing 100
+#       ./datagen.sh Trace1 testing 1000000 --chunk-rows 100000
+#       FUSED=1 ./datagen.sh Trace1 testing 1000 --no-job-files
+#
+# Any arguments after the size are passed on to simulate_dataset.py. With
+# FUSED set, the jobs are validated while they are simulated instead of being
+# read back by validate.py.
 #
 tr=$1
 mode=$2
@@ -34,10 +40,15 @@ gen_dir=../distributions/${tr}/
 sim_dir=${gen_dir}/${mode}_sim
 
 mkdir -p $sim_dir
+if [ -n "$FUSED" ]; then
+    echo "Simulating and validating"
+    python simulate_dataset.py $dist_dir $sim_dir ${gen_dir}/${mode}.csv $size_per_query --kl-table ${gen_dir}/${mode}_KL.csv "${@:4}" > ${gen_dir}/${mode}_KL.txt
+    exit
+fi
 echo "Simulating"
-python simulate_dataset.py $dist_dir $sim_dir ${gen_dir}/${mode}.csv $size_per_query
+python simulate_dataset.py $dist_dir $sim_dir ${gen_dir}/${mode}.csv $size_per_query "${@:4}"
 ##############################################################################
 
 echo "Validating"
-python validate.py $dist_dir $sim_dir > ${gen_dir}/${mode}_KL.txt
+python validate.py $dist_dir $sim_dir --table ${gen_dir}/${mode}_KL.csv > ${gen_dir}/${mode}_KL.txt
 
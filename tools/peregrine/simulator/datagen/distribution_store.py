@@ -0,0 +1,538 @@
+"""Module for reading and writing job distributions.
+
+The distributions of a trace are stored in distributions.csv and header.csv,
+see the README in the distributions directory for the format. Since parsing
+the stringified lists in distributions.csv is slow, the distributions can also
+be stored in a binary format next to the CSV files: a directory holding one
+numpy array per field, stacked over all jobs, which can be memory mapped.
+
+The extraction also stores the count, mean, co-moment matrix and column
+minimums and maximums of every job in the same layout, which are needed to
+fold new data into the distributions without the earlier inputs, see
+update_distributions.py.
+
+A few jobs can be read without parsing the whole distributions.csv through an
+index of its rows, sorted by hash tag with the byte offset of every row, which
+is built on first use and rebuilt when distributions.csv changes.
+"""
+
+import ast
+import csv
+import json
+import os
+import sys
+import numpy as np
+
+STORE_DIR = "distributions_store"
+STORE_VERSION = 1
+STORE_ARRAYS = ["hash_tags", "mean", "std", "cov", "dep_mask", "int_mask"]
+MOMENTS_DIR = "distributions_moments"
+MOMENTS_VERSION = 2
+MOMENTS_ARRAYS = [
+    "hash_tags",
+    "count",
+    "mean",
+    "comoment",
+    "minimum",
+    "maximum",
+]
+INDEX_DIR = "distributions_index"
+INDEX_ARRAYS = ["hash_tags", "offsets", "rows"]
+
+
+class Distributions:
+    """
+    Distributions of a set of jobs, stacked over the jobs
+    :param header: The names of the attributes
+    :param hash_tags: The hash tags of the jobs, shape [J]
+    :param mean: The mean vectors, shape [J, d]
+    :param std: The standard deviation vectors, shape [J, d]
+    :param cov: The covariance matrices, shape [J, d, d]
+    :param dep_mask: The dependent columns of each job, shape [J, d]
+    :param int_mask: The integer columns of each job, shape [J, d]
+    """
+
+    def __init__(self, header, hash_tags, mean, std, cov, dep_mask, int_mask):
+        self.header = header
+        self.hash_tags = hash_tags
+        self.mean = mean
+        self.std = std
+        self.cov = cov
+        self.dep_mask = dep_mask
+        self.int_mask = int_mask
+
+    def __len__(self):
+        return len(self.hash_tags)
+
+    def job(self, i):
+        """
+        Get the distribution of a single job
+        :param i: The position of the job
+        :return: hash tag, mean, standard deviation, covariance, dependent
+            columns, integer columns
+        """
+        return (
+            str(self.hash_tags[i]),
+            np.asarray(self.mean[i]),
+            np.asarray(self.std[i]),
+            np.asarray(self.cov[i]),
+            np.flatnonzero(self.dep_mask[i]),
+            np.flatnonzero(self.int_mask[i]),
+        )
+
+    def jobs(self):
+        """
+        Iterate over the distributions of all jobs
+        :return: generator of job distributions, see job()
+        """
+        for i in range(len(self)):
+            yield self.job(i)
+
+
+def parse_distribution(input_dist):
+    """
+    Parse a row of distributions.csv
+    :param input_dist: The row of the distributions file
+    :return: hash tag, mean, standard deviation, covariance, dependent
+        columns, integer columns
+    """
+    return (
+        input_dist[0],
+        np.asarray(ast.literal_eval(input_dist[1])),
+        np.asarray(ast.literal_eval(input_dist[2])),
+        np.asarray(ast.literal_eval(input_dist[3])),
+        np.asarray(ast.literal_eval(input_dist[4])),
+        np.asarray(ast.literal_eval(input_dist[5])),
+    )
+
+
+def stack_distributions(header, jobs):
+    """
+    Stack job distributions into a Distributions object
+    :param header: The names of the attributes
+    :param jobs: The job distributions, see parse_distribution()
+    :return: Distributions
+    """
+    jobs = list(jobs)
+    d = len(header)
+    J = len(jobs)
+    mean = np.zeros((J, d))
+    std = np.zeros((J, d))
+    cov = np.zeros((J, d, d))
+    dep_mask = np.zeros((J, d), dtype=bool)
+    int_mask = np.zeros((J, d), dtype=bool)
+    for i, (_, m, s, c, dep_cols, int_cols) in enumerate(jobs):
+        mean[i] = m
+        std[i] = s
+        cov[i] = c
+        dep_mask[i, np.asarray(dep_cols, dtype=int)] = True
+        int_mask[i, np.asarray(int_cols, dtype=int)] = True
+    hash_tags = np.array([str(job[0]) for job in jobs], dtype=np.str_)
+    return Distributions(header, hash_tags, mean, std, cov, dep_mask, int_mask)
+
+
+def read_header(dist_path):
+    """
+    Read the attribute names of a distribution directory
+    :param dist_path: The distribution directory
+    :return: list of attribute names
+    """
+    with open(os.path.join(dist_path, "header.csv")) as header_file:
+        for line in csv.reader(header_file, delimiter=","):
+            return line
+    return None
+
+
+def read_csv(dist_path):
+    """
+    Read the distributions from distributions.csv and header.csv
+    :param dist_path: The distribution directory
+    :return: Distributions
+    """
+    with open(os.path.join(dist_path, "distributions.csv")) as dist_file:
+        jobs = [
+            parse_distribution(input_dist)
+            for input_dist in csv.reader(dist_file, delimiter=",")
+            if len(input_dist) > 0
+        ]
+    return stack_distributions(read_header(dist_path), jobs)
+
+
+def csv_signature(dist_path):
+    """
+    Get the size and modification time of distributions.csv, which is used to
+    detect binary stores that are out of date
+    :param dist_path: The distribution directory
+    :return: [size, mtime in ns], or None if there is no distributions.csv
+    """
+    csv_path = os.path.join(dist_path, "distributions.csv")
+    if not os.path.isfile(csv_path):
+        return None
+    stat = os.stat(csv_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def write_store(dist_path, distributions):
+    """
+    Write distributions in the binary format
+    :param dist_path: The distribution directory
+    :param distributions: The distributions to write
+    """
+    store_path = os.path.join(dist_path, STORE_DIR)
+    if not os.path.exists(store_path):
+        os.mkdir(store_path)
+    for name in STORE_ARRAYS:
+        np.save(
+            os.path.join(store_path, name + ".npy"),
+            np.ascontiguousarray(getattr(distributions, name)),
+        )
+    meta = {
+        "version": STORE_VERSION,
+        "header": list(distributions.header),
+        "jobs": len(distributions),
+        "source": csv_signature(dist_path),
+    }
+    with open(os.path.join(store_path, "meta.json"), "w") as meta_file:
+        json.dump(meta, meta_file)
+
+
+def create_store(dist_path, header, jobs, hash_tag_dtype):
+    """
+    Create a binary store to be filled in place, for distributions too large
+    to be held in memory
+    :param dist_path: The distribution directory
+    :param header: The names of the attributes
+    :param jobs: The number of jobs
+    :param hash_tag_dtype: The numpy string type of the hash tags
+    :return: Distributions of writable memory mapped arrays
+    """
+    store_path = os.path.join(dist_path, STORE_DIR)
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+    d = len(header)
+    shapes = {
+        "hash_tags": ((jobs,), hash_tag_dtype),
+        "mean": ((jobs, d), np.float64),
+        "std": ((jobs, d), np.float64),
+        "cov": ((jobs, d, d), np.float64),
+        "dep_mask": ((jobs, d), bool),
+        "int_mask": ((jobs, d), bool),
+    }
+    arrays = [
+        np.lib.format.open_memmap(
+            os.path.join(store_path, name + ".npy"),
+            mode="w+",
+            dtype=shapes[name][1],
+            shape=shapes[name][0],
+        )
+        for name in STORE_ARRAYS
+    ]
+    meta = {
+        "version": STORE_VERSION,
+        "header": list(header),
+        "jobs": jobs,
+        "source": csv_signature(dist_path),
+    }
+    with open(os.path.join(store_path, "meta.json"), "w") as meta_file:
+        json.dump(meta, meta_file)
+    return Distributions(list(header), *arrays)
+
+
+def read_store(dist_path, mmap_mode="r"):
+    """
+    Read distributions in the binary format
+    :param dist_path: The distribution directory
+    :param mmap_mode: The numpy memory mapping mode, None to load into memory
+    :return: Distributions
+    """
+    store_path = os.path.join(dist_path, STORE_DIR)
+    with open(os.path.join(store_path, "meta.json")) as meta_file:
+        meta = json.load(meta_file)
+    if meta["version"] != STORE_VERSION:
+        raise ValueError(
+            "Unsupported distribution store version " + str(meta["version"])
+        )
+    arrays = [
+        np.load(os.path.join(store_path, name + ".npy"), mmap_mode=mmap_mode)
+        for name in STORE_ARRAYS
+    ]
+    return Distributions(meta["header"], *arrays)
+
+
+def has_store(dist_path):
+    """
+    Check whether the distribution directory has an up to date binary store
+    :param dist_path: The distribution directory
+    :return: True if the binary store can be used
+    """
+    meta_path = os.path.join(dist_path, STORE_DIR, "meta.json")
+    if not os.path.isfile(meta_path):
+        return False
+    with open(meta_path) as meta_file:
+        meta = json.load(meta_file)
+    source = csv_signature(dist_path)
+    return source is None or source == meta["source"]
+
+
+def load(dist_path):
+    """
+    Load the distributions of a distribution directory, from the binary store
+    if it is up to date, and from distributions.csv otherwise
+    :param dist_path: The distribution directory
+    :return: Distributions
+    """
+    if has_store(dist_path):
+        return read_store(dist_path)
+    return read_csv(dist_path)
+
+
+def write_moments(
+    dist_path, header, hash_tags, counts, means, comoments, minimums, maximums
+):
+    """
+    Write the moments of the jobs of a distribution directory, after its
+    distributions.csv
+    :param dist_path: The distribution directory
+    :param header: The names of the attributes
+    :param hash_tags: The hash tags of the jobs, in the order of
+        distributions.csv
+    :param counts: The number of instances of each job, shape [J]
+    :param means: The mean vectors, shape [J, d]
+    :param comoments: The co-moment matrices, the sums of the products of the
+        deviations from the mean, shape [J, d, d]
+    :param minimums: The minimum of every column, shape [J, d]
+    :param maximums: The maximum of every column, shape [J, d]
+    """
+    moments_path = os.path.join(dist_path, MOMENTS_DIR)
+    if not os.path.exists(moments_path):
+        os.mkdir(moments_path)
+    d = len(header)
+    arrays = {
+        "hash_tags": np.array([str(h) for h in hash_tags], dtype=np.str_),
+        "count": np.asarray(counts, dtype=np.int64).reshape(-1),
+        "mean": np.asarray(means, dtype=np.float64).reshape(-1, d),
+        "comoment": np.asarray(comoments, dtype=np.float64).reshape(-1, d, d),
+        "minimum": np.asarray(minimums, dtype=np.float64).reshape(-1, d),
+        "maximum": np.asarray(maximums, dtype=np.float64).reshape(-1, d),
+    }
+    for name in MOMENTS_ARRAYS:
+        np.save(os.path.join(moments_path, name + ".npy"), arrays[name])
+    meta = {
+        "version": MOMENTS_VERSION,
+        "header": list(header),
+        "jobs": len(arrays["hash_tags"]),
+        "source": csv_signature(dist_path),
+    }
+    with open(os.path.join(moments_path, "meta.json"), "w") as meta_file:
+        json.dump(meta, meta_file)
+
+
+def has_moments(dist_path):
+    """
+    Check whether the distribution directory has moments that are up to date
+    with its distributions.csv
+    :param dist_path: The distribution directory
+    :return: True if the moments can be used
+    """
+    meta_path = os.path.join(dist_path, MOMENTS_DIR, "meta.json")
+    if not os.path.isfile(meta_path):
+        return False
+    with open(meta_path) as meta_file:
+        meta = json.load(meta_file)
+    return meta["version"] == MOMENTS_VERSION and meta[
+        "source"
+    ] == csv_signature(dist_path)
+
+
+def read_moments(dist_path):
+    """
+    Read the moments of the jobs of a distribution directory
+    :param dist_path: The distribution directory
+    :return: header, hash tags, counts, mean vectors, co-moment matrices,
+        and column minimums and maximums
+    """
+    moments_path = os.path.join(dist_path, MOMENTS_DIR)
+    with open(os.path.join(moments_path, "meta.json")) as meta_file:
+        meta = json.load(meta_file)
+    if meta["version"] != MOMENTS_VERSION:
+        raise ValueError("Unsupported moments version " + str(meta["version"]))
+    arrays = [
+        np.load(os.path.join(moments_path, name + ".npy"))
+        for name in MOMENTS_ARRAYS
+    ]
+    return (meta["header"], *arrays)
+
+
+def build_index(dist_path):
+    """
+    Index the rows of distributions.csv by hash tag, without parsing the
+    distributions
+    :param dist_path: The distribution directory
+    :return: the sorted hash tags, and the byte offset and the position among
+        the jobs of the row of each
+    """
+    hash_tags = []
+    offsets = []
+    offset = 0
+    with open(os.path.join(dist_path, "distributions.csv"), "rb") as f:
+        for line in f:
+            if line.strip():
+                if line.startswith(b'"'):
+                    hash_tag = next(csv.reader([line.decode()]))[0]
+                else:
+                    hash_tag = line.split(b",", 1)[0].decode()
+                hash_tags.append(hash_tag)
+                offsets.append(offset)
+            offset += len(line)
+    hash_tags = np.array(hash_tags, dtype=np.str_)
+    # stable, so that the first of duplicate hash tags is found
+    order = np.argsort(hash_tags, kind="stable")
+    return (
+        hash_tags[order],
+        np.asarray(offsets, dtype=np.int64)[order],
+        order.astype(np.int64),
+    )
+
+
+def write_index(dist_path, hash_tags, offsets, rows):
+    """
+    Write the index of distributions.csv
+    :param dist_path: The distribution directory
+    :param hash_tags: The sorted hash tags
+    :param offsets: The byte offset of the row of each hash tag
+    :param rows: The position among the jobs of the row of each hash tag
+    """
+    index_path = os.path.join(dist_path, INDEX_DIR)
+    if not os.path.exists(index_path):
+        os.mkdir(index_path)
+    arrays = {"hash_tags": hash_tags, "offsets": offsets, "rows": rows}
+    for name in INDEX_ARRAYS:
+        np.save(os.path.join(index_path, name + ".npy"), arrays[name])
+    meta = {
+        "version": STORE_VERSION,
+        "jobs": len(hash_tags),
+        "source": csv_signature(dist_path),
+    }
+    with open(os.path.join(index_path, "meta.json"), "w") as meta_file:
+        json.dump(meta, meta_file)
+
+
+def read_index(dist_path):
+    """
+    Read the index of distributions.csv, building it if it is missing or out
+    of date
+    :param dist_path: The distribution directory
+    :return: the sorted hash tags, and the byte offset and the position among
+        the jobs of the row of each
+    """
+    index_path = os.path.join(dist_path, INDEX_DIR)
+    meta_path = os.path.join(index_path, "meta.json")
+    if os.path.isfile(meta_path):
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+        if meta["version"] == STORE_VERSION and meta[
+            "source"
+        ] == csv_signature(dist_path):
+            return tuple(
+                np.load(os.path.join(index_path, name + ".npy"), mmap_mode="r")
+                for name in INDEX_ARRAYS
+            )
+    index = build_index(dist_path)
+    try:
+        write_index(dist_path, *index)
+    except OSError:
+        # the index is only kept in memory in read-only directories
+        pass
+    return index
+
+
+def select(dist_path, hash_tags):
+    """
+    Load the distributions of some jobs of a distribution directory, reading
+    only their rows of distributions.csv, or of the binary store if it is up
+    to date
+    :param dist_path: The distribution directory
+    :param hash_tags: The hash tags of the jobs
+    :return: Distributions of the jobs found, in the order of hash_tags, and
+        list of the hash tags not found
+    """
+    if not os.path.isfile(os.path.join(dist_path, "distributions.csv")):
+        # a binary store without CSV files
+        distributions = read_store(dist_path)
+        positions = {}
+        for i, hash_tag in enumerate(distributions.hash_tags):
+            positions.setdefault(str(hash_tag), i)
+        found = [str(h) for h in hash_tags if str(h) in positions]
+        missing = [str(h) for h in hash_tags if str(h) not in positions]
+        jobs = [distributions.job(positions[h]) for h in found]
+        return stack_distributions(distributions.header, jobs), missing
+
+    index_tags, offsets, rows = read_index(dist_path)
+    found = []
+    missing = []
+    for hash_tag in hash_tags:
+        i = np.searchsorted(index_tags, str(hash_tag))
+        if i < len(index_tags) and index_tags[i] == str(hash_tag):
+            found.append(i)
+        else:
+            missing.append(str(hash_tag))
+    if has_store(dist_path):
+        distributions = read_store(dist_path)
+        jobs = [distributions.job(rows[i]) for i in found]
+        return stack_distributions(distributions.header, jobs), missing
+    jobs = []
+    with open(os.path.join(dist_path, "distributions.csv"), "rb") as f:
+        for i in found:
+            f.seek(offsets[i])
+            line = f.readline().decode()
+            jobs.append(parse_distribution(next(csv.reader([line]))))
+    return stack_distributions(read_header(dist_path), jobs), missing
+
+
+def read_hash_tags(hash_tags=None, hash_tag_file=None):
+    """
+    Gather the hash tags given on the command line and in a file
+    :param hash_tags: Comma separated hash tags, or None
+    :param hash_tag_file: Path of a file with one hash tag per line, or None
+    :return: list of distinct hash tags in the order given, or None if
+        neither is given
+    """
+    if hash_tags is None and hash_tag_file is None:
+        return None
+    selected = []
+    if hash_tags is not None:
+        selected += hash_tags.split(",")
+    if hash_tag_file is not None:
+        with open(hash_tag_file) as f:
+            selected += f.read().split()
+    selected = [hash_tag.strip() for hash_tag in selected]
+    return list(dict.fromkeys(h for h in selected if h))
+
+
+def convert(dist_path):
+    """
+    Convert distributions.csv of a distribution directory to the binary format
+    :param dist_path: The distribution directory
+    :return: The number of jobs converted
+    """
+    distributions = read_csv(dist_path)
+    write_store(dist_path, distributions)
+    return len(distributions)
+
+
+def main():
+    """
+    Main method
+    """
+    # check inputs
+    if len(sys.argv) < 2:
+        print("Usage: distribution_store.py <distribution-dir> ...")
+        sys.exit(1)
+
+    for dist_path in sys.argv[1:]:
+        count = convert(dist_path)
+        print("Converted " + str(count) + " jobs in " + dist_path + ".")
+
+
+if __name__ == "__main__":
+    main()
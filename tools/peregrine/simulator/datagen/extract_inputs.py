@@ -1,11 +1,23 @@
 """Module for extracting data set characteristics.
 """
-import sys
+import argparse
 import csv
 import os
 from numpy import std, array, mean, save, cov
 import numpy as np
 import json
+import time
+import distribution_store
+import ingest
+import metrics
+from moments import RunningMoments, grouped_moments, pin_constant_columns
+from sketches import HashRangeCounter, MisraGries
+
+# These constants depend on the training input schema
+# if the training input schema changes, then these have to change as well!
+HASH_TAG = 2
+COLUMNS = [1, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16]
+INT_COLUMNS = [1, 3, 4, 5, 6, 7, 11, 12, 13, 14, 15, 16]
 
 
 def group_inputs(
@@ -16,6 +28,7 @@ def group_inputs(
     output_path,
     max_groups=10,
     support_threshold=5,
+    selected=None,
 ):
     """Parse and group the AutoToken input into different recurring pipelines
     :param input_file: The data set path to parse
@@ -32,6 +45,8 @@ def group_inputs(
     :type max_groups: int, optional
     :param support_threshold: The minimum support for each group
     :type support_threshold: int, optional
+    :param selected: The keys of the groups to consider, None for all groups
+    :type selected: set, optional
     :return: list of group data sets, list of group hash values
     """
     with open(input_file) as csv_file:
@@ -46,6 +61,9 @@ def group_inputs(
                 for col in columns:
                     header.append(row[col])
             elif len(row) > 0:
+                if selected is not None and row[group_key] not in selected:
+                    line_count += 1
+                    continue
                 if not row[group_key] in group_tuples:
                     group_tuples[row[group_key]] = []
                     group_hash_tag[row[group_key]] = row[hash_tag]
@@ -58,6 +76,7 @@ def group_inputs(
             if line_count % 100000 == 0:
                 print(f"Processed {line_count} lines.")
 
+        metrics.count("rows", line_count - 1)
         files, group_hashes = [], []
         for group in group_tuples:
 
@@ -83,8 +102,306 @@ def group_inputs(
         return files, group_hashes
 
 
+def accumulate_groups(
+    input_file,
+    group_key,
+    hash_tag,
+    columns,
+    int_columns,
+    output_path=None,
+    max_groups=10,
+    support_threshold=5,
+    buffer_rows=100000,
+    selected=None,
+):
+    """Parse and group the AutoToken input into different recurring pipelines
+    in a single pass, keeping only the running moments of each group instead
+    of its rows
+    :param input_file: The data set path to parse
+    :type input_file: string
+    :param group_key: The index of the grouping key
+    :type group_key: int
+    :param hash_tag: The index of the job's recurring hash tag
+    :type hash_tag: int
+    :param columns: The list of columns to extract from the data set
+    :type columns: list
+    :param int_columns: The list of integer columns, truncated before computing
+        the moments in the same way as get_distributions does
+    :type int_columns: list
+    :param output_path: The output path to also store the grouped data sets,
+        None to not store them
+    :type output_path: string, optional
+    :param max_groups: The maximum number of groups to create
+    :type max_groups: int, optional
+    :param support_threshold: The minimum support for each group
+    :type support_threshold: int, optional
+    :param buffer_rows: The number of rows to buffer before adding them to
+        the running moments
+    :type buffer_rows: int, optional
+    :param selected: The keys of the groups to consider, None for all groups
+    :type selected: set, optional
+    :return: header, list of group hash values, list of group moments
+    """
+    truncate = np.array([i in int_columns for i in range(len(columns))])
+    with open(input_file) as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=",")
+        line_count = 0
+        group_moments = {}
+        group_hash_tag = {}
+        pending = {}
+        pending_rows = 0
+        header = []
+        for row in csv_reader:
+            if line_count == 0:
+                line_count += 1
+                for col in columns:
+                    header.append(row[col])
+            elif len(row) > 0:
+                if selected is not None and row[group_key] not in selected:
+                    line_count += 1
+                    continue
+                if not row[group_key] in group_moments:
+                    group_moments[row[group_key]] = RunningMoments(
+                        len(columns)
+                    )
+                    group_hash_tag[row[group_key]] = row[hash_tag]
+                if not row[group_key] in pending:
+                    pending[row[group_key]] = []
+                pending[row[group_key]].append([row[col] for col in columns])
+                pending_rows += 1
+                line_count += 1
+
+                if pending_rows >= buffer_rows:
+                    flush_groups(
+                        pending,
+                        group_moments,
+                        group_hash_tag,
+                        truncate,
+                        header,
+                        output_path,
+                    )
+                    pending = {}
+                    pending_rows = 0
+
+            if line_count % 100000 == 0:
+                print(f"Processed {line_count} lines.")
+
+        flush_groups(
+            pending,
+            group_moments,
+            group_hash_tag,
+            truncate,
+            header,
+            output_path,
+        )
+        metrics.count("rows", line_count - 1)
+
+    group_hashes, moments = select_groups(
+        group_moments, group_hash_tag, max_groups, support_threshold
+    )
+
+    # only the grouped data sets of the selected groups are kept
+    if output_path is not None:
+        selected = set(group_hashes)
+        for group in group_hash_tag:
+            file = os.path.join(output_path, group_hash_tag[group])
+            if group_hash_tag[group] not in selected and os.path.isfile(file):
+                os.remove(file)
+
+    return header, group_hashes, moments
+
+
+def read_group_keys(input_file, group_key):
+    """
+    Read the grouping key of every row of the AutoToken input
+    :param input_file: The data set path to parse
+    :type input_file: string
+    :param group_key: The index of the grouping key
+    :type group_key: int
+    :return: generator of group keys
+    """
+    with open(input_file) as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=",")
+        next(csv_reader, None)
+        for row in csv_reader:
+            if len(row) > 0:
+                yield row[group_key]
+
+
+def select_group_keys(
+    input_file,
+    group_key,
+    max_groups=10,
+    support_threshold=5,
+    selection="top",
+    sketch_size=None,
+    seed=0,
+):
+    """
+    Select recurring groups with bounded memory, keeping track of at most
+    sketch_size groups at a time.
+    For the top groups, a first pass over the input finds the candidate
+    groups with a frequent items sketch, and a second pass counts the
+    candidates exactly.
+    For a random sample, every pass counts the groups whose hash value falls
+    in the next range of hash values exactly, until enough recurring groups
+    are found. The sample is then stratified by support.
+    :param input_file: The data set path to parse
+    :type input_file: string
+    :param group_key: The index of the grouping key
+    :type group_key: int
+    :param max_groups: The maximum number of groups to select
+    :type max_groups: int, optional
+    :param support_threshold: The minimum support for each group
+    :type support_threshold: int, optional
+    :param selection: "top" for the groups with the highest support, "random"
+        for a random sample of the groups stratified by support
+    :type selection: string, optional
+    :param sketch_size: The number of groups to keep track of
+    :type sketch_size: int, optional
+    :param seed: The seed of the random sample
+    :type seed: int, optional
+    :return: set of selected group keys
+    """
+    if sketch_size is None:
+        sketch_size = max(10 * max_groups, 10000)
+
+    if selection == "top":
+        # keys frequent enough to be among the top groups stay in the sketch
+        sketch = MisraGries(sketch_size)
+        for key in read_group_keys(input_file, group_key):
+            sketch.update(key)
+
+        counts = dict.fromkeys(sketch.keys(), 0)
+        for key in read_group_keys(input_file, group_key):
+            if key in counts:
+                counts[key] += 1
+        recurring = [key for key in counts if counts[key] >= support_threshold]
+        recurring.sort(key=lambda key: counts[key], reverse=True)
+        return set(recurring[:max_groups])
+
+    if selection == "random":
+        counts = {}
+        low = 0
+        while True:
+            sampler = HashRangeCounter(sketch_size, low, seed)
+            for key in read_group_keys(input_file, group_key):
+                sampler.update(key)
+            for key, count in sampler.counts.items():
+                if count >= support_threshold:
+                    counts[key] = count
+            if len(counts) >= max_groups or sampler.high >= 2 ** 64:
+                break
+            low = sampler.high
+        return stratified_sample(counts, max_groups, seed)
+
+    raise ValueError("Unknown group selection: " + str(selection))
+
+
+def stratified_sample(counts, max_groups, seed=0):
+    """
+    Draw a random sample of groups, stratified by the order of magnitude
+    (log2) of their support
+    :param counts: The support of each group
+    :type counts: dict
+    :param max_groups: The number of groups to draw
+    :type max_groups: int
+    :param seed: The seed of the random sample
+    :type seed: int, optional
+    :return: set of sampled group keys
+    """
+    keys = sorted(counts)
+    if len(keys) <= max_groups:
+        return set(keys)
+
+    strata = {}
+    for key in keys:
+        strata.setdefault(int(np.log2(counts[key])), []).append(key)
+    levels = sorted(strata)
+
+    # allocate the sample to the strata in proportion to their sizes, giving
+    # the remaining groups to the largest remainders
+    quotas = np.array([len(strata[level]) for level in levels])
+    quotas = quotas * max_groups / len(keys)
+    allocation = np.floor(quotas).astype(int)
+    remainders = np.argsort(allocation - quotas, kind="stable")
+    allocation[remainders[: max_groups - allocation.sum()]] += 1
+
+    rng = np.random.default_rng(seed)
+    selected = set()
+    for level, size in zip(levels, allocation):
+        selected.update(
+            rng.choice(strata[level], size, replace=False).tolist()
+        )
+    return selected
+
+
+def select_groups(
+    group_moments, group_hash_tag, max_groups=10, support_threshold=5
+):
+    """
+    Select the first groups, in order of appearance, with enough support
+    :param group_moments: The running moments of each group
+    :type group_moments: dict
+    :param group_hash_tag: The hash value of each group
+    :type group_hash_tag: dict
+    :param max_groups: The maximum number of groups to select, None for no
+        maximum
+    :type max_groups: int, optional
+    :param support_threshold: The minimum support for each group
+    :type support_threshold: int, optional
+    :return: list of group hash values, list of group moments
+    """
+    group_hashes, moments = [], []
+    for group in group_moments:
+        if group_moments[group].count < support_threshold:
+            continue
+        group_hashes.append(group_hash_tag[group])
+        moments.append(group_moments[group])
+        if max_groups is not None and len(group_hashes) >= max_groups:
+            break
+    return group_hashes, moments
+
+
+def flush_groups(
+    pending, group_moments, group_hash_tag, truncate, header, output_path
+):
+    """
+    Add the buffered rows of each group to its running moments
+    :param pending: The buffered rows of each group, as strings
+    :type pending: dict
+    :param group_moments: The running moments of each group
+    :type group_moments: dict
+    :param group_hash_tag: The hash value of each group
+    :type group_hash_tag: dict
+    :param truncate: The mask of integer columns to truncate
+    :param header: The header of the grouped data sets
+    :type header: list
+    :param output_path: The output path to append the rows of each group to,
+        None to not store them
+    :type output_path: string
+    """
+    for group in pending:
+        block = np.array(pending[group], dtype=np.float64)
+        if output_path is not None:
+            file = os.path.join(output_path, group_hash_tag[group])
+            is_new = group_moments[group].count == 0
+            with open(file, "w" if is_new else "a") as my_file:
+                writer = csv.writer(my_file)
+                if is_new:
+                    writer.writerow(header)
+                writer.writerows(block.tolist())
+        block[:, truncate] = np.trunc(block[:, truncate])
+        group_moments[group].update_block(block)
+
+
 def store_distributions(
-    output_path, data_files, group_hashes, int_columns, int_columns_shifted
+    output_path,
+    data_files,
+    group_hashes,
+    int_columns,
+    int_columns_shifted,
+    binary=False,
 ):
     """
     Gather and collect the distributions from each of the data files separately.
@@ -97,28 +414,204 @@ def store_distributions(
     :param int_columns: The list of integer columns in the input file
     :param int_columns_shifted: The list of integer columns in the output file
     :type int_columns: list
+    :param binary: Whether to also store the distributions in the binary format
+    :type binary: bool, optional
     """
     header = None
+    jobs = []
+    counts = []
+    extents = []
+    for (data_file, group_hash) in zip(data_files, group_hashes):
+        started = time.perf_counter()
+        (
+            header,
+            mean,
+            stdev,
+            covar,
+            dep_cols,
+            count,
+            minimum,
+            maximum,
+        ) = get_distributions(data_file, int_columns)
+        metrics.observe("job", time.perf_counter() - started)
+        jobs.append(
+            (group_hash, mean, stdev, covar, dep_cols, int_columns_shifted)
+        )
+        counts.append(count)
+        extents.append((minimum, maximum))
+    with metrics.stage("write"):
+        write_distributions(output_path, header, jobs, binary)
+    if header is not None:
+        # numpy.cov normalizes the co-moments by count - 1
+        distribution_store.write_moments(
+            output_path,
+            header,
+            group_hashes,
+            counts,
+            [job[1] for job in jobs],
+            [job[3] * (count - 1) for job, count in zip(jobs, counts)],
+            [minimum for minimum, _ in extents],
+            [maximum for _, maximum in extents],
+        )
+
+
+def store_moments(
+    output_path,
+    header,
+    group_hashes,
+    group_moments,
+    int_columns_shifted,
+    binary=False,
+):
+    """
+    Compute and store the distributions from the running moments of each group.
+    :param output_path: The output path to store the distributions
+    :type output_path: string
+    :param header: The names of the columns
+    :type header: list
+    :param group_hashes: The list of hash values used for grouping the data sets
+    :type group_hashes: list
+    :param group_moments: The list of running moments of each group
+    :type group_moments: list
+    :param int_columns_shifted: The list of integer columns in the output file
+    :type int_columns_shifted: list
+    :param binary: Whether to also store the distributions in the binary format
+    :type binary: bool, optional
+    """
+    d = len(header)
+    counts = np.array([moments.count for moments in group_moments])
+    means = np.array([moments.mean for moments in group_moments])
+    comoments = np.array([moments.comoment for moments in group_moments])
+    covars, stds = moment_distributions(counts, comoments.reshape(-1, d, d))
+    with metrics.stage("dependent_columns"):
+        dep_cols = get_dependent_columns_batch(covars)
+    jobs = [
+        (
+            group_hash,
+            moments.mean,
+            std,
+            covar,
+            np.array(dep),
+            int_columns_shifted,
+        )
+        for group_hash, moments, std, covar, dep in zip(
+            group_hashes, group_moments, stds, covars, dep_cols
+        )
+    ]
+    with metrics.stage("write"):
+        write_distributions(output_path, header, jobs, binary)
+    distribution_store.write_moments(
+        output_path,
+        header,
+        group_hashes,
+        counts,
+        means,
+        comoments,
+        [moments.minimum for moments in group_moments],
+        [moments.maximum for moments in group_moments],
+    )
+
+
+def moment_distributions(counts, comoments):
+    """
+    Compute the covariance matrices and standard deviation vectors of jobs
+    from their moments
+    :param counts: The number of instances of each job, shape [G]
+    :param comoments: The co-moment matrices, shape [G, d, d]
+    :return: covariance matrices normalized like numpy.cov, NaN for the jobs
+        with a single instance, and standard deviation vectors normalized
+        like numpy.std
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        covars = comoments / (counts - 1)[:, None, None]
+        stds = np.sqrt(np.einsum("gii->gi", comoments) / counts[:, None])
+    covars[counts < 2] = np.nan
+    return covars, stds
+
+
+def extract_arrays(
+    header,
+    hash_tags,
+    values,
+    int_columns=None,
+    max_groups=None,
+    support_threshold=1,
+):
+    """
+    Compute the distributions of the recurring jobs of a data set held in
+    memory, in the same way as the extraction from an AutoToken input
+    :param header: The names of the columns
+    :type header: list
+    :param hash_tags: The hash tag of the job of each row, shape [N]
+    :param values: The column values of each row, shape [N, d]
+    :param int_columns: The list of integer columns, truncated before
+        computing the moments
+    :type int_columns: list, optional
+    :param max_groups: The maximum number of jobs, in order of first
+        appearance, None for all jobs
+    :type max_groups: int, optional
+    :param support_threshold: The minimum number of rows of each job
+    :type support_threshold: int, optional
+    :return: distribution_store.Distributions
+    """
+    int_columns = [] if int_columns is None else list(int_columns)
+    values = np.array(values, dtype=np.float64, ndmin=2)
+    values[:, int_columns] = np.trunc(values[:, int_columns])
+    keys, first, inverse = np.unique(
+        np.asarray(hash_tags).astype(str),
+        return_index=True,
+        return_inverse=True,
+    )
+    counts, means, comoments = grouped_moments(
+        inverse.reshape(-1), values, keys.size
+    )
+
+    order = np.argsort(first, kind="stable")
+    order = order[counts[order] >= support_threshold][:max_groups]
+    covars, stds = moment_distributions(counts[order], comoments[order])
+    dep_cols = get_dependent_columns_batch(covars)
+    jobs = [
+        (keys[g], means[g], stds[i], covars[i], dep_cols[i], int_columns)
+        for i, g in enumerate(order)
+    ]
+    return distribution_store.stack_distributions(header, jobs)
+
+
+def write_distributions(output_path, header, jobs, binary=False):
+    """
+    Write the distributions.csv and header.csv files
+    :param output_path: The output path to store the distributions
+    :type output_path: string
+    :param header: The names of the columns
+    :type header: list
+    :param jobs: The distribution of each group: hash value, mean, standard
+        deviation, co-variation, dependent columns, integer columns
+    :type jobs: list
+    :param binary: Whether to also store the distributions in the binary format
+    :type binary: bool, optional
+    """
     with open(
         os.path.join(output_path, "distributions.csv"), "w"
     ) as dist_file:
         dist_writer = csv.writer(dist_file)
-        for (data_file, group_hash) in zip(data_files, group_hashes):
-            header, mean, stdev, covar, dep_cols = get_distributions(
-                data_file, int_columns
-            )
+        for group_hash, mean, stdev, covar, dep_cols, int_cols in jobs:
             row = [
                 group_hash,
                 mean.tolist(),
                 stdev.tolist(),
                 covar.tolist(),
                 dep_cols.tolist(),
-                int_columns_shifted,
+                int_cols,
             ]
             dist_writer.writerow(row)
     with open(os.path.join(output_path, "header.csv"), "w") as header_file:
         header_writer = csv.writer(header_file)
         header_writer.writerow(header)
+    if binary:
+        distribution_store.write_store(
+            output_path, distribution_store.stack_distributions(header, jobs)
+        )
 
 
 def get_distributions(data_set, int_columns):
@@ -128,10 +621,11 @@ def get_distributions(data_set, int_columns):
     :type data_set: string
     :param int_columns: The list of integer columns
     :type int_columns: list
-    :return: header, mean. standard deviation, co-variation, dependent columns
+    :return: header, mean. standard deviation, co-variation, dependent
+        columns, number of rows, minimum and maximum of every column
     """
     header = None
-    with open(data_set) as csv_file:
+    with open(data_set) as csv_file, metrics.stage("read"):
         csv_reader = csv.reader(csv_file, delimiter=",")
         line_count = 0
         tuples = []
@@ -148,15 +642,26 @@ def get_distributions(data_set, int_columns):
                 line_count += 1
         data = (array(tuples).T).astype(np.float64)
 
-        covar = cov(data)
+    data_mean = mean(data, axis=1)
+    data_std = std(data, axis=1)
+    covar = cov(data)
+    minimum, maximum = data.min(axis=1), data.max(axis=1)
+    if data.shape[1] > 1:
+        # exact moments for the constant columns, as in the single pass
+        pin_constant_columns(data_mean, covar, minimum, maximum)
+        data_std[minimum == maximum] = 0
+    with metrics.stage("dependent_columns"):
         dep_cols = get_dependent_columns(covar)
-        return (
-            header,
-            mean(data, axis=1),
-            std(data, axis=1),
-            covar,
-            np.array(dep_cols),
-        )
+    return (
+        header,
+        data_mean,
+        data_std,
+        covar,
+        np.array(dep_cols),
+        data.shape[1],
+        minimum,
+        maximum,
+    )
 
 
 def get_dependent_columns(covar):
@@ -165,72 +670,279 @@ def get_dependent_columns(covar):
     :param covar: The covariance matrix
     :return: Dependent columns
     """
-    ind_columns = (np.where(~covar.any(axis=1))[0]).tolist()
-    dep_columns_z = []
-    for i in range(0, covar.shape[0]):
-        if i not in ind_columns:
-            dep_columns_z.append(i)
+    # columns with a zero row in the covariance matrix are independent
+    dep_columns_z = np.flatnonzero(covar.any(axis=1)).tolist()
     return exclude_linear_combination_variables(covar, dep_columns_z)
 
 
+def get_dependent_columns_batch(covars):
+    """
+    Get the lists of dependent columns of a stack of covariance matrices, see
+    get_dependent_columns
+    :param covars: The covariance matrices, shape [G, d, d]
+    :return: list of dependent columns for each covariance matrix
+    """
+    covars = np.asarray(covars, dtype=np.float64)
+    masks = independent_column_masks(covars, covars.any(axis=2))
+    return [np.flatnonzero(mask).tolist() for mask in masks]
+
+
 def exclude_linear_combination_variables(covar, all_columns):
     """
     Exclude columns that are linear combination of other columns in the covariance matrix.
+    The columns are visited in order, and a column is kept if the sub-matrix
+    of the columns kept so far plus that column has full rank in the sense of
+    numpy.linalg.matrix_rank, see independent_column_masks for how this is
+    decided without a singular value decomposition per column.
     :param covar: The covariance matrix
     :param all_columns: The set of all columns
     :return: List of dependent columns
     """
-    dep_columns = [all_columns[0]]
-    for i in range(1, len(all_columns)):
-        columns = dep_columns.copy()
-        columns.append(all_columns[i])
-        test_covar = []
-        for c in range(0, covar.shape[0]):
-            if c in columns:
-                row = []
-                for v in range(0, covar[c].size):
-                    if v in columns:
-                        row.append(covar[c, v])
-                test_covar.append(row)
-        test_covar = np.array(test_covar)
+    covar = np.asarray(covar, dtype=np.float64)
+    eps = np.finfo(np.float64).eps
+    gamma = 16 * covar.shape[0] * eps
+    scale = np.sqrt(np.abs(np.diag(covar)))
+
+    dep_columns = []
+    factor = np.zeros((len(all_columns), len(all_columns)))
+    norm2 = 0.0
+    inverse_norm2 = 0.0
+    max_diag = 0.0
+    exact = False
+    for column in all_columns:
+        k = len(dep_columns)
+        c = covar[column, column]
+        if k == 0:
+            if c > 0:
+                factor[0, 0] = np.sqrt(c)
+                norm2 = c ** 2
+                inverse_norm2 = 1 / c
+                max_diag = abs(c)
+                dep_columns.append(column)
+            else:
+                # the first column is always kept, continue with matrix_rank
+                exact = True
+                dep_columns.append(column)
+            continue
+
+        if not exact:
+            b = covar[dep_columns, column]
+            l = np.linalg.solve(factor[:k, :k], b)
+            u = np.linalg.solve(factor[:k, :k].T, l)
+            s = c - np.dot(l, l)
+            error = (
+                gamma
+                * (scale[column] + np.dot(np.abs(u), scale[dep_columns])) ** 2
+            )
+            new_norm2 = norm2 + 2 * np.dot(b, b) + c ** 2
+            new_max_diag = max(max_diag, abs(c))
+            lower_s = s - error
+            new_inverse_norm2 = (
+                inverse_norm2 + (np.dot(u, u) + 1) / lower_s
+                if lower_s > 0
+                else np.inf
+            )
+            reject, accept = rank_bounds(
+                s, error, k + 1, new_max_diag, new_norm2, new_inverse_norm2
+            )
+            if reject:
+                continue
+            if accept:
+                factor[k, :k] = l
+                factor[k, k] = np.sqrt(s)
+                norm2 = new_norm2
+                inverse_norm2 = new_inverse_norm2
+                max_diag = new_max_diag
+                dep_columns.append(column)
+                continue
+            exact = True
+
+        # too close to the tolerance, decide with matrix_rank
+        columns = dep_columns + [column]
+        test_covar = covar[np.ix_(columns, columns)]
         if np.linalg.matrix_rank(test_covar) == test_covar.shape[0]:
-            dep_columns.append(all_columns[i])
+            dep_columns.append(column)
     return dep_columns
 
 
-def main():
+def rank_bounds(s, error, n, max_diag, norm2, inverse_norm2):
     """
-    Main method
+    Decide whether a sub-matrix extended by one column has full rank in the
+    sense of numpy.linalg.matrix_rank, from the Schur complement of the new
+    column, see independent_column_masks
+    :param s: The Schur complement of the new column
+    :param error: Bound on the rounding error of s
+    :param n: The size of the extended sub-matrix
+    :param max_diag: The largest diagonal entry of the extended sub-matrix
+    :param norm2: The squared Frobenius norm of the extended sub-matrix
+    :param inverse_norm2: The squared Frobenius norm of the inverse Cholesky
+        factor of the extended sub-matrix, computed with s - error
+    :return: whether the column is surely rejected, whether it is surely
+        accepted
     """
-    # check inputs
-    if len(sys.argv) < 6:
-        print(
-            "Usage: extract.py <autotoken-training-input> <extraction-dir> "
-            "<distribution-dir> <max-queries> <support-threshold>"
+    eps = np.finfo(np.float64).eps
+    # sigma_min <= |s| < n * eps * max_diag <= matrix_rank tolerance
+    reject = np.abs(s) + error < n * eps * max_diag
+    # sigma_min >= 1 / |inverse factor|_F^2
+    #          > n * eps * |M|_F >= matrix_rank tolerance
+    with np.errstate(invalid="ignore"):
+        accept = (s - error > 0) & (
+            2 * n * eps * np.sqrt(norm2) * inverse_norm2 < 1
         )
-        sys.exit(1)
-
-    input_file = sys.argv[1]
-    extract_path = sys.argv[2]
-    dist_path = sys.argv[3]
-    max_queries = int(sys.argv[4])
-    support_threshold = int(sys.argv[5])
-
-    # These constants depend on the training input schema
-    # if the training input schema changes, then these have to change as well!
-    hash_tag = 2
-    columns = [1, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16]
-    int_columns = [1, 3, 4, 5, 6, 7, 11, 12, 13, 14, 15, 16]
-
-    if len(sys.argv) == 7:
-        group_key = int(sys.argv[6])
-    else:
-        group_key = hash_tag  # default group key is HT1
+    return reject, accept
+
+
+def independent_column_masks(covars, candidates):
+    """
+    Select columns that are not a linear combination of other columns, for a
+    stack of covariance matrices at once. The candidate columns are visited in
+    order, and a column is selected if the sub-matrix of the columns selected
+    so far plus that column has full rank in the sense of
+    numpy.linalg.matrix_rank. The first candidate is always selected.
+
+    Instead of a singular value decomposition per candidate, the Cholesky
+    factor of the selected sub-matrix is extended one column at a time, which
+    gives the Schur complement s of each candidate. The smallest singular
+    value of the extended sub-matrix is at most |s|, and at least the inverse
+    of the squared Frobenius norm of the inverse Cholesky factor. Together
+    with a bound on the rounding error of s, this decides most candidates
+    against the matrix_rank tolerance. Candidates too close to the tolerance
+    to be decided safely fall back to matrix_rank, so that the selection is
+    the same.
+    :param covars: The covariance matrices, shape [G, d, d]
+    :param candidates: The candidate columns of each matrix, shape [G, d]
+    :return: mask of the selected columns, shape [G, d]
+    """
+    covars = np.asarray(covars, dtype=np.float64)
+    G, d, _ = covars.shape
+    eps = np.finfo(np.float64).eps
+    gamma = 16 * d * eps
 
-    # update positions to correspond to column numbers in the per group-key
-    # generated datasets. Gaps in sequence will be removed. Also, accounts
-    # for the fact that group_key will not be explicitly included in the
-    # generated data per group_key value
+    selected = np.zeros((G, d), dtype=bool)
+    count = np.zeros(G, dtype=int)
+    # Cholesky factor of the selected sub-matrix, padded with the identity
+    factor = np.broadcast_to(np.eye(d), (G, d, d)).copy()
+    # squared Frobenius norms of the selected sub-matrix and of the inverse of
+    # its Cholesky factor, and the largest diagonal entry of the sub-matrix
+    norm2 = np.zeros(G)
+    inverse_norm2 = np.zeros(G)
+    max_diag = np.zeros(G)
+    # groups that continue with matrix_rank after an undecided candidate
+    exact = np.zeros(G, dtype=bool)
+    scale = np.sqrt(np.abs(np.einsum("gii->gi", covars)))
+
+    for j in range(d):
+        column = covars[:, :, j] * selected
+        c = covars[:, j, j]
+        # only the first j rows of the padded factors are not the identity
+        l = forward_substitution(factor, column, j)
+        u = backward_substitution(factor, l, j)
+        s = c - np.einsum("gi,gi->g", l, l)
+        n = count + 1
+
+        # first order bound on the rounding error of s, which is x' dM x for
+        # x = [-u, 1] and a perturbation dM of the order of the scale of M
+        error = (
+            gamma
+            * (scale[:, j] + np.einsum("gi,gi->g", np.abs(u), scale)) ** 2
+        )
+        new_norm2 = norm2 + 2 * np.einsum("gi,gi->g", column, column) + c ** 2
+        new_max_diag = np.maximum(max_diag, np.abs(c))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            new_inverse_norm2 = inverse_norm2 + (
+                np.einsum("gi,gi->g", u, u) + 1
+            ) / (s - error)
+
+        active = candidates[:, j] & ~exact
+        first = active & (count == 0)
+        rest = active & ~first
+        reject, accept = rank_bounds(
+            s, error, n, new_max_diag, new_norm2, new_inverse_norm2
+        )
+        reject &= rest
+        accept = (rest & accept) | (first & (c > 0))
+
+        undecided = (rest & ~reject & ~accept) | (first & ~(c > 0))
+        undecided |= candidates[:, j] & exact
+        # decide the remaining candidates with matrix_rank, in one stacked
+        # call per sub-matrix size
+        undecided = np.flatnonzero(undecided)
+        for size in np.unique(n[undecided]):
+            g = undecided[n[undecided] == size]
+            if size == 1:
+                full_rank = np.ones(g.size, dtype=bool)
+            else:
+                columns = np.nonzero(selected[g])[1].reshape(g.size, size - 1)
+                columns = np.append(columns, np.full((g.size, 1), j), axis=1)
+                test_covars = covars[
+                    g[:, np.newaxis, np.newaxis],
+                    columns[:, :, np.newaxis],
+                    columns[:, np.newaxis, :],
+                ]
+                full_rank = np.linalg.matrix_rank(test_covars) == size
+            selected[g[full_rank], j] = True
+            count[g[full_rank]] += 1
+            exact[g[full_rank]] = True
+
+        # extend the Cholesky factors with the accepted columns
+        g = np.flatnonzero(accept)
+        if g.size > 0:
+            factor[g, j, :] = l[g]
+            factor[g, j, j] = np.sqrt(s[g])
+            norm2[g] = new_norm2[g]
+            inverse_norm2[g] = np.where(
+                first[g], 1 / c[g], new_inverse_norm2[g]
+            )
+            max_diag[g] = new_max_diag[g]
+            selected[g, j] = True
+            count[g] += 1
+
+    return selected
+
+
+def forward_substitution(L, b, k):
+    """
+    Solve L x = b for a stack of lower triangular matrices whose rows after
+    the first k are those of the identity, and right hand sides that are zero
+    after the first k entries
+    :param L: The lower triangular matrices, shape [G, d, d]
+    :param b: The right hand sides, shape [G, d]
+    :param k: The number of leading rows to solve for
+    :return: The solutions, shape [G, d]
+    """
+    x = np.zeros_like(b)
+    for i in range(k):
+        x[:, i] = (b[:, i] - (L[:, i, :i] * x[:, :i]).sum(axis=1)) / L[:, i, i]
+    return x
+
+
+def backward_substitution(L, b, k):
+    """
+    Solve L' x = b for a stack of lower triangular matrices, with the same
+    structure as in forward_substitution
+    :param L: The lower triangular matrices, shape [G, d, d]
+    :param b: The right hand sides, shape [G, d]
+    :param k: The number of leading rows to solve for
+    :return: The solutions, shape [G, d]
+    """
+    x = np.zeros_like(b)
+    for i in reversed(range(k)):
+        x[:, i] = (
+            b[:, i] - (L[:, i + 1 : k, i] * x[:, i + 1 : k]).sum(axis=1)
+        ) / L[:, i, i]
+    return x
+
+
+def shift_columns(columns, int_columns):
+    """
+    Update positions to correspond to column numbers in the per group-key
+    generated datasets. Gaps in sequence will be removed. Also, accounts for
+    the fact that group_key will not be explicitly included in the generated
+    data per group_key value
+    :param columns: The list of columns extracted from the input
+    :param int_columns: The list of integer columns in the input
+    :return: list of integer columns in the output
+    """
     pos_map = {}
     j = 0
     for i in columns:
@@ -239,26 +951,200 @@ def main():
     int_columns_shifted = []
     for i in int_columns:
         int_columns_shifted.append(pos_map[i])
+    return int_columns_shifted
+
+
+def parse_args():
+    """
+    Parse the command line arguments
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        usage="extract.py <autotoken-training-input> <extraction-dir> "
+        "<distribution-dir> <max-queries> <support-threshold> [group-key] "
+        "[options]"
+    )
+    parser.add_argument("input_file", metavar="autotoken-training-input")
+    parser.add_argument("extract_path", metavar="extraction-dir")
+    parser.add_argument("dist_path", metavar="distribution-dir")
+    parser.add_argument("max_queries", metavar="max-queries", type=int)
+    parser.add_argument(
+        "support_threshold", metavar="support-threshold", type=int
+    )
+    parser.add_argument(
+        "group_key", metavar="group-key", type=int, nargs="?", default=None
+    )
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="also store the distributions in the binary format",
+    )
+    parser.add_argument(
+        "--single-pass",
+        action="store_true",
+        help="compute the distributions in a single pass over the input, "
+        "keeping only running moments per group",
+    )
+    parser.add_argument(
+        "--write-groups",
+        action="store_true",
+        help="with --single-pass, also store the grouped data sets in the "
+        "extraction directory",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="with --single-pass, parse the input in byte ranges using this "
+        "many processes",
+    )
+    parser.add_argument(
+        "--selection",
+        choices=["first", "top", "random"],
+        default="first",
+        help="select the first groups with enough support in input order, "
+        "the groups with the highest support, or a random sample of groups "
+        "stratified by support",
+    )
+    parser.add_argument(
+        "--sketch-size",
+        type=int,
+        default=None,
+        help="number of candidate groups to track with the top and random "
+        "selections",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed of the random selection",
+    )
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be positive")
+    if args.workers > 1 and not args.single_pass:
+        parser.error("--workers requires --single-pass")
+    if args.workers > 1 and args.write_groups:
+        parser.error("--write-groups is not supported with --workers")
+    return args
+
+
+def main():
+    """
+    Main method
+    """
+    args = parse_args()
+    metrics.configure(args)
+
+    input_file = args.input_file
+    extract_path = args.extract_path
+    dist_path = args.dist_path
+    max_queries = args.max_queries
+    support_threshold = args.support_threshold
+
+    hash_tag = HASH_TAG
+    columns = COLUMNS
+    int_columns = INT_COLUMNS
+
+    if args.group_key is not None:
+        group_key = args.group_key
+    else:
+        group_key = hash_tag  # default group key is HT1
+
+    int_columns_shifted = shift_columns(columns, int_columns)
+    metrics.count("bytes_read", os.path.getsize(input_file))
+
+    selected = None
+    if args.selection != "first":
+        with metrics.stage("select"):
+            selected = select_group_keys(
+                input_file,
+                group_key,
+                max_queries,
+                support_threshold,
+                args.selection,
+                args.sketch_size,
+                args.seed,
+            )
+
+    if args.single_pass:
+        with metrics.stage("parse"):
+            if args.workers > 1:
+                header, moments, hash_tags = ingest.accumulate_groups_parallel(
+                    input_file,
+                    group_key,
+                    hash_tag,
+                    columns,
+                    int_columns,
+                    args.workers,
+                    selected=selected,
+                )
+                group_hashes, group_moments = select_groups(
+                    moments, hash_tags, max_queries, support_threshold
+                )
+            else:
+                if args.write_groups and not os.path.exists(extract_path):
+                    os.mkdir(extract_path)
+                header, group_hashes, group_moments = accumulate_groups(
+                    input_file,
+                    group_key,
+                    hash_tag,
+                    columns,
+                    int_columns,
+                    extract_path if args.write_groups else None,
+                    max_queries,
+                    support_threshold,
+                    selected=selected,
+                )
+        print("\nSuccessfully extracted " + str(len(group_hashes)) + " jobs.")
+        metrics.count("jobs", len(group_hashes))
+
+        if not os.path.exists(dist_path):
+            os.mkdir(dist_path)
+        with metrics.stage("distributions"):
+            store_moments(
+                dist_path,
+                header,
+                group_hashes,
+                group_moments,
+                int_columns_shifted,
+                args.binary,
+            )
+        print("Stored job distributions.\n")
+        metrics.finish(args, "extract_inputs.py")
+        return
 
     if not os.path.exists(extract_path):
         os.mkdir(extract_path)
-    files, group_hashes = group_inputs(
-        input_file,
-        group_key,
-        hash_tag,
-        columns,
-        extract_path,
-        max_queries,
-        support_threshold,
-    )
+    with metrics.stage("parse"):
+        files, group_hashes = group_inputs(
+            input_file,
+            group_key,
+            hash_tag,
+            columns,
+            extract_path,
+            max_queries,
+            support_threshold,
+            selected,
+        )
     print("\nSuccessfully extracted " + str(len(files)) + " jobs.")
+    metrics.count("jobs", len(files))
 
     if not os.path.exists(dist_path):
         os.mkdir(dist_path)
-    store_distributions(
-        dist_path, files, group_hashes, int_columns, int_columns_shifted
-    )
+    with metrics.stage("distributions"):
+        store_distributions(
+            dist_path,
+            files,
+            group_hashes,
+            int_columns,
+            int_columns_shifted,
+            args.binary,
+        )
     print("Stored job distributions.\n")
+    metrics.finish(args, "extract_inputs.py")
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""Module for parsing large AutoToken inputs in parallel.
+
+The input file is split into byte ranges aligned on line boundaries. Each
+range is parsed in a separate process with vectorized numeric conversion and
+reduced to per-group partial moments, which are then merged in input order.
+"""
+
+import multiprocessing
+import os
+import numpy as np
+import metrics
+from moments import RunningMoments, grouped_extents, grouped_moments
+
+RANGE_BYTES = 64 * 1024 * 1024
+
+
+def split_byte_ranges(input_file, parts):
+    """
+    Split a CSV file into byte ranges that start and end on line boundaries,
+    skipping the header line
+    :param input_file: The data set path to split
+    :param parts: The number of ranges to split into
+    :return: header line, list of (start, end) byte offsets
+    """
+    size = os.path.getsize(input_file)
+    with open(input_file, "rb") as f:
+        header = f.readline()
+        start = f.tell()
+        bounds = [start]
+        for i in range(1, parts):
+            pos = max(start + (size - start) * i // parts, bounds[-1])
+            f.seek(pos)
+            if pos > bounds[-1]:
+                # move to the beginning of the next line
+                f.seek(pos - 1)
+                f.readline()
+            bounds.append(min(f.tell(), size))
+        bounds.append(size)
+    ranges = [
+        (bounds[i], bounds[i + 1])
+        for i in range(len(bounds) - 1)
+        if bounds[i + 1] > bounds[i]
+    ]
+    return header.decode().rstrip("\r\n"), ranges
+
+
+def parse_range(task):
+    """
+    Parse a byte range of the input and compute the moments of each group in
+    it. This is the unit of work of the process pool.
+    :param task: tuple of input path, start offset, end offset, group key
+        index, hash tag index, columns, integer columns mask, and the keys of
+        the groups to consider (None for all groups)
+    :return: number of rows, group keys in order of first appearance, their
+        hash tags, counts, means, co-moment matrices, and the minimums and
+        maximums of their columns
+    """
+    (
+        input_file,
+        start,
+        end,
+        group_key,
+        hash_tag,
+        columns,
+        truncate,
+        selected,
+    ) = task
+    with open(input_file, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode()
+
+    fields = np.loadtxt(
+        text.splitlines(),
+        delimiter=",",
+        dtype=str,
+        quotechar='"',
+        ndmin=2,
+    )
+    rows = fields.shape[0]
+    if selected is not None:
+        fields = fields[np.isin(fields[:, group_key], list(selected))]
+    d = len(columns)
+    if fields.shape[0] == 0:
+        return (
+            rows,
+            [],
+            [],
+            np.zeros(0),
+            np.zeros((0, d)),
+            np.zeros((0, d, d)),
+            np.zeros((0, d)),
+            np.zeros((0, d)),
+        )
+
+    values = fields[:, columns].astype(np.float64)
+    values[:, truncate] = np.trunc(values[:, truncate])
+
+    keys, first, inverse = np.unique(
+        fields[:, group_key], return_index=True, return_inverse=True
+    )
+    inverse = inverse.reshape(-1)
+    counts, means, comoments = grouped_moments(inverse, values, keys.size)
+    minimums, maximums = grouped_extents(inverse, values, keys.size)
+
+    # report the groups in order of first appearance in the range
+    order = np.argsort(first, kind="stable")
+    return (
+        rows,
+        keys[order].tolist(),
+        fields[first[order], hash_tag].tolist(),
+        counts[order],
+        means[order],
+        comoments[order],
+        minimums[order],
+        maximums[order],
+    )
+
+
+def accumulate_groups_parallel(
+    input_file,
+    group_key,
+    hash_tag,
+    columns,
+    int_columns,
+    workers,
+    range_bytes=RANGE_BYTES,
+    selected=None,
+):
+    """
+    Parse and group the AutoToken input into different recurring pipelines
+    using a pool of processes, each computing the moments of the groups in a
+    byte range of the input
+    :param input_file: The data set path to parse
+    :param group_key: The index of the grouping key
+    :param hash_tag: The index of the job's recurring hash tag
+    :param columns: The list of columns to extract from the data set
+    :param int_columns: The list of integer columns, truncated before computing
+        the moments in the same way as get_distributions does
+    :param workers: The number of worker processes
+    :param range_bytes: The approximate size of each byte range
+    :param selected: The keys of the groups to consider, None for all groups
+    :return: header, dict of group moments and dict of group hash values, both
+        in order of first appearance of the groups
+    """
+    truncate = np.array([i in int_columns for i in range(len(columns))])
+    parts = max(workers, -(-os.path.getsize(input_file) // range_bytes))
+    header_line, ranges = split_byte_ranges(input_file, parts)
+    header_fields = np.loadtxt(
+        [header_line], delimiter=",", dtype=str, quotechar='"', ndmin=2
+    )[0]
+    header = [str(header_fields[col]) for col in columns]
+
+    tasks = [
+        (
+            input_file,
+            start,
+            end,
+            group_key,
+            hash_tag,
+            columns,
+            truncate,
+            selected,
+        )
+        for start, end in ranges
+    ]
+    group_moments = {}
+    group_hash_tag = {}
+    line_count = 0
+    with multiprocessing.Pool(workers) as pool:
+        for (
+            rows,
+            keys,
+            tags,
+            counts,
+            means,
+            comoments,
+            minimums,
+            maximums,
+        ) in pool.imap(parse_range, tasks):
+            for i, key in enumerate(keys):
+                # the extents keep the constant columns exact across ranges
+                partial = RunningMoments(len(columns))
+                partial.count = int(counts[i])
+                partial.mean = means[i]
+                partial.comoment = comoments[i]
+                partial.minimum = minimums[i]
+                partial.maximum = maximums[i]
+                if key not in group_moments:
+                    group_moments[key] = partial
+                    group_hash_tag[key] = tags[i]
+                else:
+                    group_moments[key].merge(partial)
+            line_count += rows
+            if line_count // 100000 > (line_count - rows) // 100000:
+                print(f"Processed {line_count} lines.")
+    metrics.count("rows", line_count)
+
+    return header, group_moments, group_hash_tag
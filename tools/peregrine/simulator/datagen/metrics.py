@@ -0,0 +1,400 @@
+"""Module for measuring where the time of a datagen run goes.
+
+The scripts time their stages (parsing, factorization, sampling, writing,
+validation) and count the rows and bytes they process, the jobs that failed
+and the latency of every job into a histogram. The measurements are kept in
+this module, so the stages only need to be wrapped in stage(), and are written
+as a JSON report at the end of a run with the --metrics option. The worker
+processes of a run send their measurements back with the results of their
+tasks, see snapshot() and merge().
+
+One stage can also be profiled with cProfile or tracemalloc, see the
+--profile option, which only adds overhead to the calls of that stage. The
+worker processes write their profiles to their own files, which are merged
+into the profile of the run for cProfile, and listed in the report for
+tracemalloc.
+"""
+
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+REPORT_VERSION = 1
+# upper bound of the first bucket of the latency histograms, in seconds, each
+# following bucket is twice as wide
+HISTOGRAM_BASE = 1e-4
+HISTOGRAM_BUCKETS = 24
+PROFILERS = ["cprofile", "tracemalloc"]
+# number of allocation sites listed by the tracemalloc profile
+TRACEMALLOC_TOP = 50
+
+
+class Metrics:
+    """
+    Stage timers, counters and latency histograms of a process
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+        self.stages = {}
+        self.counters = {}
+        self.histograms = {}
+        self.profile_stage = None
+        self.profiler = None
+        self.profile_path = None
+        self.profile = None
+        self.peak = 0
+        # the profiles written by the worker processes
+        self.profile_parts = set()
+
+    def reset(self):
+        """
+        Clear the measurements, but not the profile
+        """
+        with self.lock:
+            self.started = time.perf_counter()
+            self.cpu_started = time.process_time()
+            self.stages = {}
+            self.counters = {}
+            self.histograms = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time a stage. The CPU time is the one of the calling thread, so
+        stages that run in background threads are measured correctly.
+        :param name: The stage name
+        """
+        profiled = name == self.profile_stage
+        if profiled:
+            self.start_profile()
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            if profiled:
+                self.stop_profile()
+            with self.lock:
+                totals = self.stages.setdefault(name, [0, 0.0, 0.0])
+                totals[0] += 1
+                totals[1] += wall
+                totals[2] += cpu
+
+    def count(self, name, n=1):
+        """
+        Add to a counter
+        :param name: The counter name
+        :param n: The amount to add
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        """
+        Add a latency to a histogram
+        :param name: The histogram name
+        :param seconds: The latency
+        """
+        bucket = 0
+        bound = HISTOGRAM_BASE
+        while seconds > bound and bucket < HISTOGRAM_BUCKETS:
+            bucket += 1
+            bound *= 2
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = [[0] * (HISTOGRAM_BUCKETS + 1), 0.0, 0.0]
+                self.histograms[name] = histogram
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+            histogram[2] = max(histogram[2], seconds)
+
+    def snapshot(self):
+        """
+        Get the measurements, to merge them into those of another process
+        :return: dict
+        """
+        with self.lock:
+            return {
+                "stages": {k: list(v) for k, v in self.stages.items()},
+                "counters": dict(self.counters),
+                "histograms": {
+                    k: [list(v[0]), v[1], v[2]]
+                    for k, v in self.histograms.items()
+                },
+                "profile_parts": sorted(self.profile_parts),
+            }
+
+    def merge(self, snapshot):
+        """
+        Add the measurements of another process
+        :param snapshot: The measurements, see snapshot()
+        """
+        with self.lock:
+            for name, (calls, wall, cpu) in snapshot["stages"].items():
+                totals = self.stages.setdefault(name, [0, 0.0, 0.0])
+                totals[0] += calls
+                totals[1] += wall
+                totals[2] += cpu
+            for name, n in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, (buckets, total, peak) in snapshot["histograms"].items():
+                histogram = self.histograms.setdefault(
+                    name, [[0] * (HISTOGRAM_BUCKETS + 1), 0.0, 0.0]
+                )
+                for i, n in enumerate(buckets):
+                    histogram[0][i] += n
+                histogram[1] += total
+                histogram[2] = max(histogram[2], peak)
+            self.profile_parts.update(snapshot["profile_parts"])
+
+    def set_profile(self, stage, profiler="cprofile", path=None):
+        """
+        Profile the calls of a stage
+        :param stage: The stage name
+        :param profiler: cprofile or tracemalloc
+        :param path: The path to write the profile to, by default the stage
+            name with a .prof or .tracemalloc.txt suffix
+        """
+        if profiler not in PROFILERS:
+            raise ValueError("Unknown profiler " + profiler)
+        if path is None:
+            suffix = ".prof" if profiler == "cprofile" else ".tracemalloc.txt"
+            path = stage + suffix
+        self.profile_stage = stage
+        self.profiler = profiler
+        self.profile_path = path
+        self.profile = None
+        self.peak = 0
+        self.profile_parts = set()
+
+    def start_profile(self):
+        """
+        Start profiling a call of the profiled stage
+        """
+        if self.profiler == "cprofile":
+            if self.profile is None:
+                self.profile = cProfile.Profile()
+            # nested or concurrent calls of the stage are profiled once
+            try:
+                self.profile.enable()
+            except ValueError:
+                pass
+        elif not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop_profile(self):
+        """
+        Stop profiling a call of the profiled stage
+        """
+        if self.profiler == "cprofile":
+            self.profile.disable()
+            return
+        if not tracemalloc.is_tracing():
+            return
+        # keep the allocations of the call with the highest peak
+        peak = tracemalloc.get_traced_memory()[1]
+        if peak >= self.peak:
+            self.peak = peak
+            self.profile = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+    def dump_profile(self, per_process=False):
+        """
+        Write the profile of the profiled stage, if it was called. The
+        cProfile profiles written by the worker processes are merged into
+        the one of the run, and removed.
+        :param per_process: Whether to add the process id to the path, for
+            worker processes, which send it back with their snapshot
+        """
+        path = self.profile_path
+        if per_process:
+            if self.profile is None:
+                return
+            path += "." + str(os.getpid())
+            self.profile_parts.add(path)
+        elif self.profiler == "cprofile" and self.profile_parts:
+            parts = sorted(self.profile_parts)
+            stats = pstats.Stats(*parts)
+            if self.profile is not None:
+                stats.add(self.profile)
+            stats.dump_stats(path)
+            for part in parts:
+                os.remove(part)
+            self.profile_parts = set()
+            return
+        if self.profile is None:
+            return
+        if self.profiler == "cprofile":
+            self.profile.dump_stats(path)
+            return
+        with open(path, "w") as profile_file:
+            profile_file.write(
+                "Peak traced memory of "
+                + self.profile_stage
+                + ": "
+                + str(self.peak)
+                + " bytes\n"
+            )
+            statistics = self.profile.statistics("lineno")
+            for statistic in statistics[:TRACEMALLOC_TOP]:
+                profile_file.write(str(statistic) + "\n")
+
+    def report(self, script):
+        """
+        Get the report of the run
+        :param script: The name of the script
+        :return: dict
+        """
+        snapshot = self.snapshot()
+        histograms = {}
+        bounds = [HISTOGRAM_BASE * 2 ** i for i in range(HISTOGRAM_BUCKETS)]
+        for name, (buckets, total, peak) in snapshot["histograms"].items():
+            count = sum(buckets)
+            histograms[name] = {
+                "count": count,
+                "mean_seconds": total / count if count > 0 else 0.0,
+                "max_seconds": peak,
+                # upper bound in seconds and count of the non-empty buckets,
+                # the last bound is null for the latencies above all bounds
+                "buckets": [
+                    [bounds[i] if i < len(bounds) else None, n]
+                    for i, n in enumerate(buckets)
+                    if n > 0
+                ],
+            }
+        report = {
+            "version": REPORT_VERSION,
+            "script": script,
+            "wall_seconds": time.perf_counter() - self.started,
+            "cpu_seconds": time.process_time() - self.cpu_started,
+            "stages": {
+                name: {
+                    "calls": calls,
+                    "wall_seconds": wall,
+                    "cpu_seconds": cpu,
+                }
+                for name, (calls, wall, cpu) in snapshot["stages"].items()
+            },
+            "counters": snapshot["counters"],
+            "histograms": histograms,
+        }
+        if self.profile_stage is not None:
+            report["profile"] = {
+                "stage": self.profile_stage,
+                "profiler": self.profiler,
+                "path": self.profile_path,
+                # the unmerged profiles of the worker processes
+                "process_paths": snapshot["profile_parts"],
+            }
+        return report
+
+
+# the measurements of this process
+current = Metrics()
+
+
+def stage(name):
+    """
+    Time a stage of this process
+    :param name: The stage name
+    :return: context manager
+    """
+    return current.stage(name)
+
+
+def count(name, n=1):
+    """
+    Add to a counter of this process
+    :param name: The counter name
+    :param n: The amount to add
+    """
+    current.count(name, n)
+
+
+def observe(name, seconds):
+    """
+    Add a latency to a histogram of this process
+    :param name: The histogram name
+    :param seconds: The latency
+    """
+    current.observe(name, seconds)
+
+
+def path_bytes(path):
+    """
+    Get the size of a file, or of all files under a directory
+    :param path: The path
+    :return: size in bytes, 0 if the path does not exist
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+def add_arguments(parser):
+    """
+    Add the options of the metrics report and profiler to a parser
+    :param parser: The argparse.ArgumentParser
+    """
+    parser.add_argument(
+        "--metrics",
+        default=None,
+        help="write the stage timers, counters and job latency histograms "
+        "of the run to this path as JSON",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        metavar="STAGE",
+        help="profile the calls of this stage, see the stages of the "
+        "metrics report",
+    )
+    parser.add_argument(
+        "--profiler",
+        choices=PROFILERS,
+        default="cprofile",
+        help="profile the stage with cProfile or with tracemalloc",
+    )
+    parser.add_argument(
+        "--profile-output",
+        default=None,
+        help="path of the profile, the stage name with a .prof or "
+        ".tracemalloc.txt suffix if not given",
+    )
+
+
+def configure(args):
+    """
+    Set up the profiler from the parsed arguments, see add_arguments
+    :param args: The parsed arguments
+    """
+    if args.profile is not None:
+        current.set_profile(args.profile, args.profiler, args.profile_output)
+
+
+def finish(args, script):
+    """
+    Write the profile and the metrics report from the parsed arguments, see
+    add_arguments
+    :param args: The parsed arguments
+    :param script: The name of the script
+    """
+    current.dump_profile()
+    if args.metrics is not None:
+        with open(args.metrics, "w") as metrics_file:
+            json.dump(current.report(script), metrics_file, indent=2)
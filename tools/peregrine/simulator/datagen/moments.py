@@ -0,0 +1,198 @@
+"""Module for computing mean and covariance of data streams.
+"""
+import numpy as np
+
+
+class RunningMoments:
+    """
+    Running count, mean vector and co-moment matrix of a stream of instances.
+    Instances are added one at a time or in blocks, and the moments of two
+    streams can be merged, using the numerically stable updates from
+    https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance
+    The minimum and maximum of every column are kept too, so that the columns
+    whose instances are all equal keep exact moments, see
+    pin_constant_columns.
+    :param d: The dimension of each instance
+    """
+
+    def __init__(self, d):
+        self.count = 0
+        self.mean = np.zeros(d)
+        self.comoment = np.zeros((d, d))
+        self.minimum = np.full(d, np.inf)
+        self.maximum = np.full(d, -np.inf)
+
+    def update(self, x):
+        """
+        Add a single instance (Welford's algorithm)
+        :param x: The instance
+        """
+        x = np.asarray(x, dtype=np.float64)
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.comoment += np.outer(delta, x - self.mean)
+        self.minimum = np.minimum(self.minimum, x)
+        self.maximum = np.maximum(self.maximum, x)
+        pin_constant_columns(
+            self.mean, self.comoment, self.minimum, self.maximum
+        )
+
+    def update_block(self, block):
+        """
+        Add a block of instances
+        :param block: The instances, one per row
+        """
+        block = np.asarray(block, dtype=np.float64)
+        if block.shape[0] == 0:
+            return
+        other = RunningMoments(block.shape[1])
+        other.count = block.shape[0]
+        other.mean = block.mean(axis=0)
+        centered = block - other.mean
+        other.comoment = np.matmul(centered.T, centered)
+        other.minimum = block.min(axis=0)
+        other.maximum = block.max(axis=0)
+        pin_constant_columns(
+            other.mean, other.comoment, other.minimum, other.maximum
+        )
+        self.merge(other)
+
+    def merge(self, other):
+        """
+        Add the instances of another stream (Chan et al. parallel algorithm)
+        :param other: The moments of the other stream
+        """
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count = other.count
+            self.mean = other.mean.copy()
+            self.comoment = other.comoment.copy()
+            self.minimum = other.minimum.copy()
+            self.maximum = other.maximum.copy()
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.comoment = (
+            self.comoment
+            + other.comoment
+            + np.outer(delta, delta) * (self.count * other.count / count)
+        )
+        self.count = count
+        self.minimum = np.minimum(self.minimum, other.minimum)
+        self.maximum = np.maximum(self.maximum, other.maximum)
+        pin_constant_columns(
+            self.mean, self.comoment, self.minimum, self.maximum
+        )
+
+    def covariance(self):
+        """
+        Get the sample covariance matrix, normalized like numpy.cov
+        :return: covariance matrix
+        """
+        if self.count < 2:
+            return np.full(self.comoment.shape, np.nan)
+        return self.comoment / (self.count - 1)
+
+    def std(self):
+        """
+        Get the standard deviation vector, normalized like numpy.std
+        :return: standard deviation vector
+        """
+        return np.sqrt(np.diag(self.comoment) / self.count)
+
+
+def pin_constant_columns(means, comoments, minimums, maximums):
+    """
+    Make the moments of the columns whose instances are all equal exact: their
+    mean is their value, and their co-moments are 0. Computed or merged
+    moments leave such columns with a variance of the order of the rounding
+    errors, which get_dependent_columns would take for a free column.
+    :param means: The mean vectors, shape [..., d], updated in place
+    :param comoments: The co-moment matrices, shape [..., d, d], updated in
+        place
+    :param minimums: The minimum of every column, shape [..., d]
+    :param maximums: The maximum of every column, shape [..., d]
+    """
+    constant = np.asarray(minimums) == np.asarray(maximums)
+    means[constant] = np.asarray(minimums)[constant]
+    comoments[constant] = 0
+    np.swapaxes(comoments, -1, -2)[constant] = 0
+
+
+def grouped_extents(groups, values, G):
+    """
+    Compute the minimum and maximum of every column of groups of instances at
+    once
+    :param groups: The group of each instance, integers in [0, G)
+    :param values: The instances, one per row
+    :param G: The number of groups
+    :return: minimums and maximums of the groups, shape [G, d]
+    """
+    values = np.asarray(values, dtype=np.float64)
+    minimums = np.full((G, values.shape[1]), np.inf)
+    maximums = np.full((G, values.shape[1]), -np.inf)
+    np.minimum.at(minimums, groups, values)
+    np.maximum.at(maximums, groups, values)
+    return minimums, maximums
+
+
+def grouped_moments(groups, values, G):
+    """
+    Compute the count, mean vector and co-moment matrix of groups of
+    instances at once, with exact moments for the columns that are constant
+    within a group (see pin_constant_columns)
+    :param groups: The group of each instance, integers in [0, G)
+    :param values: The instances, one per row
+    :param G: The number of groups
+    :return: counts, mean vectors and co-moment matrices of the groups
+    """
+    values = np.asarray(values, dtype=np.float64)
+    d = values.shape[1]
+    counts = np.bincount(groups, minlength=G).astype(np.float64)
+    means = np.empty((G, d))
+    for i in range(d):
+        means[:, i] = np.bincount(groups, values[:, i], G) / counts
+    centered = values - means[groups]
+    comoments = np.empty((G, d, d))
+    for i in range(d):
+        for j in range(i, d):
+            comoments[:, i, j] = np.bincount(
+                groups, centered[:, i] * centered[:, j], G
+            )
+            comoments[:, j, i] = comoments[:, i, j]
+    pin_constant_columns(means, comoments, *grouped_extents(groups, values, G))
+    return counts, means, comoments
+
+
+def merge_moments(counts1, means1, comoments1, counts2, means2, comoments2):
+    """
+    Merge the moments of the same groups computed over two sets of instances
+    (Chan et al. parallel algorithm, see RunningMoments.merge)
+    :param counts1: The counts of the groups in the first set, shape [G]
+    :param means1: The mean vectors of the first set, shape [G, d]
+    :param comoments1: The co-moment matrices of the first set, shape
+        [G, d, d]
+    :param counts2: The counts of the groups in the second set
+    :param means2: The mean vectors of the second set
+    :param comoments2: The co-moment matrices of the second set
+    :return: counts, mean vectors and co-moment matrices of the union
+    """
+    counts = np.asarray(counts1) + np.asarray(counts2)
+    n1 = np.asarray(counts1, dtype=np.float64)
+    n2 = np.asarray(counts2, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weights = np.where(counts > 0, n2 / counts, 0.0)
+        scales = np.where(counts > 0, n1 * n2 / counts, 0.0)
+    delta = np.asarray(means2) - np.asarray(means1)
+    means = means1 + delta * weights[:, np.newaxis]
+    comoments = (
+        comoments1
+        + comoments2
+        + delta[:, :, np.newaxis]
+        * delta[:, np.newaxis, :]
+        * scales[:, np.newaxis, np.newaxis]
+    )
+    return counts, means, comoments
@@ -0,0 +1,115 @@
+"""Module for overlapping the generation of the jobs with their output.
+
+The jobs are generated in a background thread, which hands the output
+matrices to the writer through a bounded queue. Sampling runs mostly in numpy
+without holding the GIL, so it overlaps with the formatting and writing of the
+previous blocks. The generator blocks when the queue is full, so it runs
+ahead of the writer by at most the depth of the queue, and the writer receives
+the jobs and their blocks in the order they were generated.
+"""
+import queue
+import threading
+
+JOB = 0
+BLOCK = 1
+END = 2
+DONE = 3
+ERROR = 4
+
+# how often a blocked generator checks whether the writer stopped, in seconds
+POLL_SECONDS = 0.1
+
+
+class JobPipeline:
+    """
+    Generate jobs in a background thread, at most depth blocks ahead of the
+    consumer. Iterating over the pipeline yields the same jobs as iterating
+    over jobs, and the blocks of a job must be consumed before the next job.
+    :param jobs: iterator over jobs and either the iterator over their
+        blocks, or the exception raised when generating them
+    :param depth: The maximum number of blocks waiting to be consumed
+    """
+
+    def __init__(self, jobs, depth):
+        self.queue = queue.Queue(depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.produce, args=(jobs,), daemon=True
+        )
+        self.thread.start()
+
+    def put(self, item):
+        """
+        Queue an item, waiting while the queue is full
+        :param item: The item to queue
+        :return: False if the consumer stopped
+        """
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(self, jobs):
+        """
+        Generate the jobs into the queue. This runs in the background thread.
+        :param jobs: iterator over jobs and their blocks
+        """
+        try:
+            for job, blocks in jobs:
+                if isinstance(blocks, Exception):
+                    if not self.put((JOB, job, blocks)):
+                        return
+                    continue
+                if not self.put((JOB, job, None)):
+                    return
+                for block in blocks:
+                    if not self.put((BLOCK, block)):
+                        return
+                if not self.put((END,)):
+                    return
+            self.put((DONE,))
+        except Exception as e:
+            # raised again in the consumer
+            self.put((ERROR, e))
+
+    def get(self):
+        """
+        Get the next item of the queue, raising the errors of the generator
+        :return: the item
+        """
+        item = self.queue.get()
+        if item[0] == ERROR:
+            raise item[1]
+        return item
+
+    def blocks(self):
+        """
+        Get the blocks of the current job
+        :return: iterator over the blocks
+        """
+        while True:
+            item = self.get()
+            if item[0] == END:
+                return
+            yield item[1]
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.get()
+                if item[0] == DONE:
+                    return
+                _, job, error = item
+                yield job, self.blocks() if error is None else error
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stop the generator and wait for the background thread
+        """
+        self.stopped.set()
+        self.thread.join()
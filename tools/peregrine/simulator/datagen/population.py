@@ -0,0 +1,502 @@
+"""Module for synthesizing a population of new jobs from a distribution set.
+
+The distribution set describes at most a thousand jobs per trace split. A
+synthetic population holds any number of new jobs. Every new job is a job of
+the set, drawn uniformly, with every column rescaled by its own log-normal
+factor, so the population follows a mixture over the jobs of the set. The
+mean and the standard deviation of a column are multiplied by its factor and
+the covariances by the factors of both columns, so a covariance stays
+positive semi-definite and the dependent columns of the job do not change.
+The spread of the factor of a column follows Silverman's rule of thumb on the
+logarithms of the column means over the set. VC is kept, and HT1, HT2 and HT3
+get fresh ids above the ones of the set.
+
+The jobs are synthesized in blocks of BLOCK_JOBS, every block from its own
+random stream derived from the global seed, so a range of jobs can be
+synthesized on its own, in any process. A population is a lazy sequence of
+job distributions, which simulate_dataset generates batch by batch without
+ever holding the whole population in memory.
+"""
+import argparse
+import copy
+import json
+import os
+import numpy as np
+import distribution_store
+import random_streams
+import simulate_dataset
+
+MANIFEST_VERSION = 1
+BLOCK_JOBS = 4096
+# columns that are not rescaled
+KEPT_COLUMNS = ["VC"]
+# columns that get a fresh id for every new job
+ID_COLUMNS = ["HT2", "HT3"]
+
+# fitted models of the populations used in this process
+models = {}
+
+
+def load_distributions(dist_paths):
+    """
+    Load the distributions of several distribution directories as one set
+    :param dist_paths: The distribution directories
+    :return: Distributions
+    """
+    parts = [distribution_store.load(dist_path) for dist_path in dist_paths]
+    header = list(parts[0].header)
+    for dist_path, part in zip(dist_paths, parts):
+        if list(part.header) != header:
+            raise ValueError(
+                "The attributes of "
+                + dist_path
+                + " differ from the ones of "
+                + dist_paths[0]
+            )
+    return distribution_store.Distributions(
+        header,
+        *[
+            np.concatenate([np.asarray(getattr(part, name)) for part in parts])
+            for name in distribution_store.STORE_ARRAYS
+        ]
+    )
+
+
+def factorizable(distributions):
+    """
+    Find the jobs whose dependent columns can be factorized
+    :param distributions: The distributions of the jobs
+    :return: positions of the jobs
+    """
+    positions = []
+    for i, job in enumerate(distributions.jobs()):
+        columns = job[4]
+        try:
+            np.linalg.cholesky(job[3][np.ix_(columns, columns)])
+            positions.append(i)
+        except np.linalg.LinAlgError:
+            continue
+    return np.array(positions, dtype=int)
+
+
+def bandwidth(means):
+    """
+    Get the spread of the log-normal factor of a column, by Silverman's rule
+    of thumb on the logarithms of the positive means of the column
+    :param means: The means of the column over the jobs
+    :return: standard deviation of the logarithm of the factor
+    """
+    logs = np.log(means[means > 0])
+    if logs.size < 2:
+        return 0.0
+    sigma = logs.std()
+    iqr = np.subtract(*np.percentile(logs, [75, 25])) / 1.34
+    if iqr > 0:
+        sigma = min(sigma, iqr)
+    return 0.9 * sigma * logs.size ** -0.2
+
+
+class PopulationModel:
+    """
+    The mixture that new jobs are drawn from
+    :param distributions: The distributions of the jobs of the set
+    :param spread: The factor applied to the spread of every column
+    """
+
+    def __init__(self, distributions, spread=1.0):
+        self.header = list(distributions.header)
+        # jobs that cannot be simulated are left out of the mixture
+        jobs = factorizable(distributions)
+        if jobs.size == 0:
+            raise ValueError("None of the jobs can be simulated")
+        self.mean = np.asarray(distributions.mean)[jobs]
+        self.std = np.asarray(distributions.std)[jobs]
+        self.cov = np.asarray(distributions.cov)[jobs]
+        self.dep_mask = np.asarray(distributions.dep_mask)[jobs]
+        self.int_mask = np.asarray(distributions.int_mask)[jobs]
+        self.bandwidths = np.zeros(len(self.header))
+        for i, name in enumerate(self.header):
+            if name not in KEPT_COLUMNS + ID_COLUMNS:
+                self.bandwidths[i] = spread * bandwidth(self.mean[:, i])
+        # the fresh ids start above the ones of the set
+        hash_tags = [str(h) for h in distributions.hash_tags]
+        self.first_hash_tag = 1 + max(
+            [int(h) for h in hash_tags if h.isdigit()], default=-1
+        )
+        self.first_ids = {}
+        for name in ID_COLUMNS:
+            if name in self.header:
+                ids = self.mean[:, self.header.index(name)]
+                self.first_ids[name] = 1 + int(np.ceil(ids.max()))
+
+    def sample(self, rng, first, count):
+        """
+        Synthesize consecutive new jobs
+        :param rng: The random generator
+        :param first: The index of the first job in the population
+        :param count: The number of jobs
+        :return: Distributions
+        """
+        base = rng.integers(len(self.mean), size=count)
+        factors = np.exp(
+            self.bandwidths * rng.standard_normal((count, len(self.header)))
+        )
+        mean = self.mean[base] * factors
+        std = self.std[base] * factors
+        cov = self.cov[base] * factors[:, :, np.newaxis]
+        cov *= factors[:, np.newaxis, :]
+        indices = np.arange(first, first + count)
+        for name, first_id in self.first_ids.items():
+            mean[:, self.header.index(name)] = first_id + indices
+        hash_tags = (self.first_hash_tag + indices).astype(np.str_)
+        return distribution_store.Distributions(
+            self.header,
+            hash_tags,
+            mean,
+            std,
+            cov,
+            self.dep_mask[base],
+            self.int_mask[base],
+        )
+
+
+class Population:
+    """
+    A synthetic population of new jobs, a lazy sequence of job distributions.
+    Slices are populations too, and only the parameters of a population are
+    pickled, the model being fitted again in every process that uses it.
+    :param dist_paths: The distribution directories the jobs are drawn from
+    :param size: The number of jobs
+    :param seed: The global seed
+    :param spread: The factor applied to the spread of every column
+    """
+
+    def __init__(self, dist_paths, size, seed, spread=1.0):
+        self.dist_paths = [os.path.abspath(p) for p in dist_paths]
+        self.seed = seed
+        self.spread = spread
+        self.start = 0
+        self.stop = size
+
+    @property
+    def model(self):
+        """
+        The fitted model, shared by the populations of this process
+        :return: PopulationModel
+        """
+        key = (tuple(self.dist_paths), self.spread)
+        if key not in models:
+            models[key] = PopulationModel(
+                load_distributions(self.dist_paths), self.spread
+            )
+        return models[key]
+
+    @property
+    def header(self):
+        """
+        The names of the attributes
+        :return: list of names
+        """
+        return self.model.header
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("Populations can only be sliced in order")
+            population = copy.copy(self)
+            population.start = self.start + start
+            population.stop = self.start + max(start, stop)
+            return population
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("Job index out of range")
+        first = self.start + key
+        return self.synthesize(first, first + 1).job(0)
+
+    def __iter__(self):
+        for first, last in self.blocks():
+            yield from self.synthesize(first, last).jobs()
+
+    def blocks(self):
+        """
+        Split the jobs along the blocks they are synthesized in
+        :return: iterator over the index of the first job of every block and
+            the index after its last job
+        """
+        first = self.start
+        while first < self.stop:
+            last = min((first // BLOCK_JOBS + 1) * BLOCK_JOBS, self.stop)
+            yield first, last
+            first = last
+
+    def synthesize(self, start, stop):
+        """
+        Synthesize a range of jobs of the whole population
+        :param start: The index of the first job
+        :param stop: The index after the last job
+        :return: Distributions
+        """
+        model = self.model
+        parts = []
+        for block in range(start // BLOCK_JOBS, -(-stop // BLOCK_JOBS)):
+            rng = random_streams.job_rng(self.seed, "population" + str(block))
+            first = block * BLOCK_JOBS
+            distributions = model.sample(rng, first, BLOCK_JOBS)
+            keep = slice(max(start - first, 0), min(stop - first, BLOCK_JOBS))
+            parts.append(
+                [
+                    np.asarray(getattr(distributions, name))[keep]
+                    for name in distribution_store.STORE_ARRAYS
+                ]
+            )
+        return distribution_store.Distributions(
+            model.header, *[np.concatenate(arrays) for arrays in zip(*parts)]
+        )
+
+    def hash_tag(self, i):
+        """
+        Get the HT1 of a job
+        :param i: The index of the job in the whole population
+        :return: hash tag
+        """
+        return str(self.model.first_hash_tag + i)
+
+    def write_store(self, dist_path):
+        """
+        Write the distributions of the population in the binary format of
+        distribution_store, block by block
+        :param dist_path: The distribution directory
+        """
+        hash_tag_dtype = np.dtype(
+            "<U" + str(len(self.hash_tag(max(self.stop - 1, 0))))
+        )
+        store = distribution_store.create_store(
+            dist_path, self.header, len(self), hash_tag_dtype
+        )
+        for first, last in self.blocks():
+            distributions = self.synthesize(first, last)
+            rows = slice(first - self.start, last - self.start)
+            for name in distribution_store.STORE_ARRAYS:
+                getattr(store, name)[rows] = getattr(distributions, name)
+        for name in distribution_store.STORE_ARRAYS:
+            getattr(store, name).flush()
+
+
+def write_manifest(path, population, size, chunk_rows, failed):
+    """
+    Write the manifest of a population run, from which every job can be
+    synthesized and regenerated
+    :param path: The manifest path
+    :param population: The population
+    :param size: The number of instances simulated per job
+    :param chunk_rows: The number of instances generated at a time, None if
+        every job was generated at once
+    :param failed: The hash tags of the jobs that could not be simulated
+    """
+    model = population.model
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "seed": population.seed,
+        "bit_generator": "PCG64",
+        "distributions": population.dist_paths,
+        "spread": population.spread,
+        "jobs": len(population),
+        "block_jobs": BLOCK_JOBS,
+        "first_hash_tag": model.first_hash_tag,
+        "first_ids": model.first_ids,
+        "size_per_query": size,
+        "chunk_rows": chunk_rows,
+        "failed": list(failed),
+    }
+    with open(path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+
+
+def parse_args():
+    """
+    Parse the command line arguments
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        usage="population.py <consolidated_output> <jobs> <size-per-query> "
+        "<distribution-dir> [<distribution-dir> ...] [options]"
+    )
+    parser.add_argument(
+        "consolidated_output_path", metavar="consolidated_output"
+    )
+    parser.add_argument("jobs", type=int)
+    parser.add_argument("size_per_query", metavar="size-per-query", type=int)
+    parser.add_argument("dist_paths", metavar="distribution-dir", nargs="+")
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="global seed from which the jobs and their instances are "
+        "derived, drawn at random if not given",
+    )
+    parser.add_argument(
+        "--spread",
+        type=float,
+        default=1.0,
+        help="factor applied to the spread of the rescaling of the columns, "
+        "0 to copy the jobs of the set",
+    )
+    parser.add_argument(
+        "--manifest",
+        default=None,
+        help="path of the population manifest, defaults to the consolidated "
+        "output path with a .population.json suffix",
+    )
+    parser.add_argument(
+        "--store",
+        default=None,
+        help="also write the distributions of the new jobs in the binary "
+        "format to this distribution directory, for validate.py",
+    )
+    parser.add_argument(
+        "--datagen-dir",
+        default=None,
+        help="also write a file per job to this directory",
+    )
+    parser.add_argument(
+        "--chunk-rows",
+        type=int,
+        default=None,
+        help="generate and write each job in blocks of this many instances",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes to simulate the jobs with",
+    )
+    parser.add_argument(
+        "--pipeline-depth",
+        type=int,
+        default=0,
+        help="generate the jobs in a background thread, at most this many "
+        "blocks ahead of the output",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["csv", "columnar"],
+        default="csv",
+        help="format of the consolidated output, HT1 being stored as int64 "
+        "values in the columnar format",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="split the consolidated output into this many shards by HT1 "
+        "hash, see shards.py",
+    )
+    parser.add_argument(
+        "--max-shard-bytes",
+        type=int,
+        default=None,
+        help="start a new file of a shard once it reaches this size, implies "
+        "a sharded output",
+    )
+    args = parser.parse_args()
+    if args.jobs < 0:
+        parser.error("the number of jobs must not be negative")
+    if args.spread < 0:
+        parser.error("--spread must not be negative")
+    if args.chunk_rows is not None and args.chunk_rows < 1:
+        parser.error("--chunk-rows must be positive")
+    if args.workers < 1:
+        parser.error("--workers must be positive")
+    if args.pipeline_depth < 0:
+        parser.error("--pipeline-depth must not be negative")
+    if args.shards < 1:
+        parser.error("--shards must be positive")
+    if args.max_shard_bytes is not None and args.max_shard_bytes < 1:
+        parser.error("--max-shard-bytes must be positive")
+    if args.seed is None:
+        args.seed = random_streams.new_seed()
+    if args.manifest is None:
+        args.manifest = args.consolidated_output_path + ".population.json"
+    return args
+
+
+def main():
+    """
+    Main method
+    """
+    args = parse_args()
+    population = Population(args.dist_paths, args.jobs, args.seed, args.spread)
+    header = population.header
+    sim_path = args.datagen_dir
+    if sim_path is not None and not os.path.exists(sim_path):
+        os.mkdir(sim_path)
+    if args.store is not None:
+        if not os.path.exists(args.store):
+            os.mkdir(args.store)
+        population.write_store(args.store)
+
+    # every job gets the integer columns of the job it is drawn from, and the
+    # HT1 of the new jobs are too many to keep a dictionary of
+    int_mask = np.asarray(population.model.int_mask).all(axis=0)
+    consolidated_file, consolidated_csv = simulate_dataset.open_consolidated(
+        args.consolidated_output_path,
+        header,
+        int_mask,
+        None,
+        args.format,
+        args.shards,
+        "hash",
+        args.max_shard_bytes,
+    )
+    with consolidated_file:
+        if len(population) > 0 and consolidated_csv is not consolidated_file:
+            consolidated_csv.writerow(["HT1"] + header)
+        if args.workers > 1:
+            consolidated_file.flush()
+            failures, _ = simulate_dataset.simulate_jobs(
+                header,
+                population,
+                sim_path,
+                consolidated_file,
+                args.size_per_query,
+                args.chunk_rows,
+                args.seed,
+                args.workers,
+                pipeline_depth=args.pipeline_depth,
+            )
+        else:
+            failures, _ = simulate_dataset.simulate_batch(
+                header,
+                population,
+                sim_path,
+                consolidated_csv,
+                args.size_per_query,
+                args.chunk_rows,
+                args.seed,
+                pipeline_depth=args.pipeline_depth,
+            )
+            simulate_dataset.report_failures(failures)
+        write_manifest(
+            args.manifest,
+            population,
+            args.size_per_query,
+            args.chunk_rows,
+            [hash_tag for hash_tag, _ in failures],
+        )
+        print(
+            "\nSuccessfully simulated "
+            + str(len(population) - len(failures))
+            + " jobs.\n"
+        )
+
+    if args.format == "columnar":
+        simulate_dataset.report_saturated(consolidated_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Module for the random streams of the simulator.
+
+Every job draws from its own stream, derived from the global seed of the run
+and the hash tag of the job, and every chunk of a job generated in chunks
+draws from its own child of the job stream. A job or a chunk can therefore be
+regenerated exactly from the global seed alone, in any order and in any
+process. The seed manifest records what is needed to do so.
+"""
+import hashlib
+import json
+import numpy as np
+
+MANIFEST_VERSION = 1
+
+
+def new_seed():
+    """
+    Draw a fresh global seed from the operating system entropy
+    :return: the seed, a non-negative integer
+    """
+    return np.random.SeedSequence().entropy
+
+
+def job_seed_sequence(seed, hash_tag):
+    """
+    Get the seed sequence of a job
+    :param seed: The global seed
+    :param hash_tag: The hash tag of the job
+    :return: numpy seed sequence
+    """
+    digest = hashlib.sha256(str(hash_tag).encode()).digest()
+    entropy = [seed] + np.frombuffer(digest, dtype=np.uint32).tolist()
+    return np.random.SeedSequence(entropy)
+
+
+def job_rng(seed, hash_tag):
+    """
+    Create the random number generator of a job
+    :param seed: The global seed
+    :param hash_tag: The hash tag of the job
+    :return: numpy random generator
+    """
+    return np.random.default_rng(job_seed_sequence(seed, hash_tag))
+
+
+def chunk_rngs(rng, chunks):
+    """
+    Create the random number generators of the chunks of a job, which are
+    the children of the job stream
+    :param rng: The random generator of the job, None for the global numpy
+        random state
+    :param chunks: The number of chunks
+    :return: list of random generators, or of None if rng is None
+    """
+    if rng is None:
+        return [None] * chunks
+    seed_seq = rng.bit_generator.seed_seq
+    return [
+        np.random.default_rng(
+            np.random.SeedSequence(
+                seed_seq.entropy, spawn_key=seed_seq.spawn_key + (i,)
+            )
+        )
+        for i in range(chunks)
+    ]
+
+
+def write_manifest(
+    path, seed, dist_path, size, chunk_rows, hash_tags, failed=None
+):
+    """
+    Write the seed manifest of a simulation run
+    :param path: The manifest path
+    :param seed: The global seed
+    :param dist_path: The distribution directory
+    :param size: The number of instances simulated per job
+    :param chunk_rows: The number of instances generated at a time, None if
+        every job was generated at once
+    :param hash_tags: The hash tags of the jobs simulated
+    :param failed: The hash tags of the jobs that could not be simulated
+    """
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "seed": seed,
+        "bit_generator": "PCG64",
+        "distributions": dist_path,
+        "size_per_query": size,
+        "chunk_rows": chunk_rows,
+        "jobs": list(hash_tags),
+        "failed": list(failed or []),
+    }
+    with open(path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+
+
+def read_manifest(path):
+    """
+    Read the seed manifest of a simulation run
+    :param path: The manifest path
+    :return: dict with the fields written by write_manifest
+    """
+    with open(path) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest["version"] != MANIFEST_VERSION:
+        raise ValueError(
+            "Unsupported seed manifest version " + str(manifest["version"])
+        )
+    return manifest
@@ -0,0 +1,674 @@
+"""Module for replaying simulated jobs as a live stream of job submissions.
+
+The instances of every job are generated lazily in increasing SubmitOffset
+order, so that a trace of any length is replayed in bounded memory. The
+SubmitOffset values of a job are drawn as the order statistics of its normal
+distribution, one block at a time, and the other columns of every instance are
+drawn conditionally on its SubmitOffset. The jobs are merged one window of
+SubmitOffset at a time and sent to the subscribers as CSV lines in the format
+of the consolidated output, paced by the SubmitOffset of the instances and a
+time compression factor, or at a target rate.
+"""
+import argparse
+import asyncio
+import heapq
+import math
+import os
+import sys
+import numpy as np
+import distribution_store
+import random_streams
+from simulate_dataset import written_values
+
+SUBMIT_OFFSET = "SubmitOffset"
+# number of order statistics drawn at a time for every job
+BLOCK_ROWS = 256
+# number of instances merged at a time
+WINDOW_ROWS = 16384
+# the instances due within this many seconds are sent at once
+TICK_SECONDS = 0.01
+# number of payloads buffered for a subscriber before it is dropped
+SUBSCRIBER_QUEUE = 256
+
+# coefficients of the rational approximations of the inverse normal CDF by
+# P. J. Acklam, with a relative error below 1.15e-9
+PPF_A = [
+    -3.969683028665376e01,
+    2.209460984245205e02,
+    -2.759285104469687e02,
+    1.383577518672690e02,
+    -3.066479806614716e01,
+    2.506628277459239e00,
+]
+PPF_B = [
+    -5.447609879822406e01,
+    1.615858368580409e02,
+    -1.556989798598866e02,
+    6.680131188771972e01,
+    -1.328068155288572e01,
+    1.0,
+]
+PPF_C = [
+    -7.784894002430293e-03,
+    -3.223964580411365e-01,
+    -2.400758277161838e00,
+    -2.549732539343734e00,
+    4.374664141464968e00,
+    2.938163982698783e00,
+]
+PPF_D = [
+    7.784695709041462e-03,
+    3.224671290700398e-01,
+    2.445134137142996e00,
+    3.754408661907416e00,
+    1.0,
+]
+PPF_LOW = 0.02425
+
+
+def norm_ppf(p):
+    """
+    Inverse of the standard normal CDF
+    :param p: array of probabilities in (0, 1)
+    :return: array of quantiles
+    """
+    p = np.clip(np.asarray(p, dtype=np.float64), 1e-300, 1 - 1e-16)
+    x = np.empty_like(p)
+    low = p < PPF_LOW
+    high = p > 1 - PPF_LOW
+    mid = ~(low | high)
+    q = p[mid] - 0.5
+    r = q * q
+    x[mid] = q * np.polyval(PPF_A, r) / np.polyval(PPF_B, r)
+    q = np.sqrt(-2 * np.log(p[low]))
+    x[low] = np.polyval(PPF_C, q) / np.polyval(PPF_D, q)
+    q = np.sqrt(-2 * np.log1p(-p[high]))
+    x[high] = -np.polyval(PPF_C, q) / np.polyval(PPF_D, q)
+    return x
+
+
+def norm_cdf(x):
+    """
+    Standard normal CDF
+    :param x: The quantile
+    :return: probability
+    """
+    return 0.5 * math.erfc(-x / math.sqrt(2))
+
+
+class OrderStatistics:
+    """
+    The order statistics of n uniform samples in (0, 1), drawn in increasing
+    order one block at a time. The first k order statistics of the remaining
+    samples are the partial sums of k exponential samples, divided by the sum
+    of n + 1 of them, whose remainder is drawn at once from a gamma
+    distribution.
+    :param n: The number of samples
+    :param rng: The random generator to draw from
+    """
+
+    def __init__(self, n, rng):
+        self.remaining = n
+        self.position = 0.0
+        self.rng = rng
+
+    def next_block(self, size):
+        """
+        Draw the next order statistics
+        :param size: The maximum number of order statistics to draw
+        :return: array of increasing uniforms, empty once all are drawn
+        """
+        k = min(size, self.remaining)
+        if k == 0:
+            return np.empty(0)
+        sums = np.cumsum(self.rng.standard_exponential(k))
+        rest = self.rng.standard_gamma(self.remaining + 1 - k)
+        u = self.position + (1 - self.position) * (sums / (sums[-1] + rest))
+        self.position = u[-1]
+        self.remaining -= k
+        return u
+
+
+class SubmitStream:
+    """
+    The instances of a job on one side of SubmitOffset zero, in increasing
+    order of their written SubmitOffset, which is the absolute value of the
+    ceiling of the generated value
+    :param model: The JobModel of the job
+    :param n: The number of instances on this side
+    :param negative: Whether the generated values are negative
+    :param order_rng: The random generator of the order statistics
+    :param rng: The random generator of the other columns
+    """
+
+    def __init__(self, model, n, negative, order_rng, rng):
+        self.model = model
+        self.negative = negative
+        self.order = OrderStatistics(n, order_rng)
+        self.rng = rng
+        self.values = np.empty(0)
+        self.offsets = np.empty(0)
+
+    def refill(self):
+        """
+        Draw the next block of SubmitOffset values
+        """
+        v = self.order.next_block(BLOCK_ROWS)
+        model = self.model
+        if model.sigma == 0:
+            x = np.full(v.size, model.mu)
+        elif self.negative:
+            # decreasing generated values, from zero towards -inf
+            x = model.mu + model.sigma * norm_ppf(model.p_negative * (1 - v))
+            x = np.minimum(x, 0)
+        else:
+            p = model.p_negative + (1 - model.p_negative) * v
+            x = np.maximum(model.mu + model.sigma * norm_ppf(p), 0)
+        self.values = x
+        self.offsets = np.abs(np.ceil(x))
+
+    def head(self):
+        """
+        Get the written SubmitOffset of the next instance
+        :return: SubmitOffset, inf if all instances were taken
+        """
+        if self.offsets.size == 0:
+            self.refill()
+        if self.offsets.size == 0:
+            return math.inf
+        return self.offsets[0]
+
+    def take(self, end):
+        """
+        Take the instances whose written SubmitOffset is below end
+        :param end: The end of the window
+        :return: matrix of the instances, before rounding
+        """
+        taken = []
+        while self.head() < end:
+            k = np.searchsorted(self.offsets, end)
+            taken.append(self.values[:k])
+            self.values = self.values[k:]
+            self.offsets = self.offsets[k:]
+        x = np.concatenate(taken) if taken else np.empty(0)
+        return self.model.rows(x, self.rng)
+
+
+class JobModel:
+    """
+    The distribution of the instances of a job, factorized with its
+    SubmitOffset column first, so that the other columns are drawn
+    conditionally on the SubmitOffset of every instance
+    :param job: The job distribution, see distribution_store
+    :param column: The index of the SubmitOffset column
+    """
+
+    def __init__(self, job, column):
+        self.hash_tag, mean, std, covar, dep_columns, self.int_cols = job
+        self.d = mean.size
+        self.mean = mean
+        self.column = column
+        dep = np.unique(np.asarray(dep_columns, dtype=int))
+        ind = np.flatnonzero(~np.isin(np.arange(self.d), dep))
+        if column in dep:
+            # factorize with SubmitOffset first, the factor then holds the
+            # regression of the other columns on it and their conditional
+            # covariance
+            order = np.concatenate([[column], dep[dep != column]])
+            A = np.linalg.cholesky(covar[np.ix_(order, order)])
+            self.sigma = A[0, 0]
+            self.slope = A[1:, 0] / self.sigma
+            self.dep = order[1:]
+            self.factor = A[1:, 1:]
+            self.ind = ind
+        else:
+            self.factor = np.linalg.cholesky(covar[np.ix_(dep, dep)])
+            self.sigma = std[column]
+            self.slope = np.zeros(dep.size)
+            self.dep = dep
+            self.ind = ind[ind != column]
+        self.std = std
+        self.mu = mean[column]
+        if self.sigma > 0:
+            self.p_negative = norm_cdf(-self.mu / self.sigma)
+        else:
+            self.p_negative = 1.0 if self.mu < 0 else 0.0
+
+    def rows(self, x, rng):
+        """
+        Draw the other columns of instances with given SubmitOffset values
+        :param x: The generated SubmitOffset values
+        :param rng: The random generator to draw from
+        :return: matrix of the instances, before rounding
+        """
+        n = x.size
+        # every instance draws its own consecutive normals, so the values do
+        # not depend on how the instances are split into windows
+        z = rng.standard_normal((n, self.dep.size + self.ind.size))
+        rows = np.empty((n, self.d))
+        rows[:, self.column] = x
+        rows[:, self.dep] = (
+            self.mean[self.dep]
+            + np.outer(x - self.mu, self.slope)
+            + z[:, : self.dep.size] @ self.factor.T
+        )
+        rows[:, self.ind] = (
+            self.mean[self.ind] + self.std[self.ind] * z[:, self.dep.size :]
+        )
+        return rows
+
+    def streams(self, size, seed):
+        """
+        Create the streams of the instances of the job
+        :param size: The number of instances
+        :param seed: The global seed
+        :return: list of the non-empty SubmitStream of the job
+        """
+        rngs = random_streams.chunk_rngs(
+            random_streams.job_rng(seed, self.hash_tag), 5
+        )
+        negative = int(rngs[0].binomial(size, self.p_negative))
+        streams = []
+        if size - negative > 0:
+            streams.append(
+                SubmitStream(self, size - negative, False, rngs[1], rngs[2])
+            )
+        if negative > 0:
+            streams.append(
+                SubmitStream(self, negative, True, rngs[3], rngs[4])
+            )
+        return streams
+
+
+class ReplayGenerator:
+    """
+    Generate the instances of jobs in increasing SubmitOffset order, one
+    window at a time. Instances with the same SubmitOffset are ordered by
+    job, so the replay only depends on the seed.
+    :param distributions: The distributions to simulate from
+    :param size: The number of instances to simulate per job
+    :param seed: The global seed
+    :param window_rows: The approximate number of instances per window
+    """
+
+    def __init__(self, distributions, size, seed, window_rows=WINDOW_ROWS):
+        self.header = list(distributions.header)
+        self.column = self.header.index(SUBMIT_OFFSET)
+        self.int_mask = np.asarray(distributions.int_mask).all(axis=0)
+        self.window_rows = window_rows
+        # hash tags and factorization errors of the jobs that cannot be
+        # simulated
+        self.failures = []
+        self.streams = []
+        self.heap = []
+        high = 0.0
+        for job in distributions.jobs():
+            try:
+                model = JobModel(job, self.column)
+            except np.linalg.LinAlgError as e:
+                self.failures.append((job[0], e))
+                continue
+            self.streams += model.streams(size, seed)
+            high = max(high, abs(model.mu) + 4 * model.sigma)
+        for i, stream in enumerate(self.streams):
+            heapq.heappush(self.heap, (stream.head(), i))
+        total = sum(s.order.remaining for s in self.streams)
+        self.width = max(1.0, high * window_rows / max(1, total))
+
+    def next_window(self):
+        """
+        Generate the instances of the next window
+        :return: hash tags, matrix of the written values and SubmitOffset of
+            the instances, or None once all instances were generated
+        """
+        if len(self.heap) == 0:
+            return None
+        end = self.heap[0][0] + self.width
+        hash_tags = []
+        values = []
+        order = []
+        while len(self.heap) > 0 and self.heap[0][0] < end:
+            _, i = heapq.heappop(self.heap)
+            stream = self.streams[i]
+            rows = stream.take(end)
+            hash_tags.append(np.full(rows.shape[0], stream.model.hash_tag))
+            values.append(written_values(rows, stream.model.int_cols))
+            order.append(np.full(rows.shape[0], i))
+            head = stream.head()
+            if head < math.inf:
+                heapq.heappush(self.heap, (head, i))
+        hash_tags = np.concatenate(hash_tags)
+        values = np.concatenate(values)
+        offsets = values[:, self.column]
+        # order by SubmitOffset, then by stream, then by generation order
+        index = np.lexsort((np.concatenate(order), offsets))
+        # aim for window_rows instances in the next window
+        ratio = self.window_rows / max(1, index.size)
+        self.width *= min(2.0, max(0.5, ratio))
+        return hash_tags[index], values[index], offsets[index]
+
+
+def format_column(values, integer):
+    """
+    Format the values of a column as they are written to the CSV files
+    :param values: The written values of the column
+    :param integer: Whether the column is an integer column
+    :return: list of strings
+    """
+    if not integer:
+        return list(map(repr, values.tolist()))
+    if values.size == 0 or np.max(values) < 2 ** 63:
+        return list(map(str, values.astype(np.int64).tolist()))
+    return [str(int(v)) for v in values]
+
+
+def format_lines(hash_tags, values, int_mask):
+    """
+    Format instances as lines of the consolidated CSV output, one column at
+    a time, which is several times faster than a CSV writer
+    :param hash_tags: The hash tags of the instances
+    :param values: The written values of the instances
+    :param int_mask: Which columns are integer columns
+    :return: encoded lines
+    """
+    columns = [hash_tags.tolist()] + [
+        format_column(values[:, i], int_mask[i])
+        for i in range(values.shape[1])
+    ]
+    return ("\n".join(map(",".join, zip(*columns))) + "\n").encode()
+
+
+class Subscriber:
+    """
+    A client of the replay, with a bounded queue of payloads to send
+    :param writer: The stream writer of the connection
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.queue = asyncio.Queue(SUBSCRIBER_QUEUE)
+        self.task = asyncio.ensure_future(self.send())
+
+    async def send(self):
+        """
+        Send the queued payloads until None is queued
+        """
+        try:
+            while True:
+                payload = await self.queue.get()
+                if payload is None:
+                    break
+                self.writer.write(payload)
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.writer.close()
+
+
+class Broadcaster:
+    """
+    Send the replay to stdout or to every subscriber of a socket. A
+    subscriber that falls more than SUBSCRIBER_QUEUE payloads behind is
+    dropped, so that it does not slow down the others.
+    :param header: The first line sent to every subscriber
+    """
+
+    def __init__(self, header):
+        self.header = header
+        self.subscribers = set()
+        self.connected = asyncio.Event()
+        self.expected = 0
+        self.dropped = 0
+
+    async def subscribe(self, reader, writer):
+        """
+        Add a subscriber, called by the server for every connection
+        :param reader: The stream reader of the connection
+        :param writer: The stream writer of the connection
+        """
+        subscriber = Subscriber(writer)
+        subscriber.queue.put_nowait(self.header)
+        self.subscribers.add(subscriber)
+        if len(self.subscribers) >= self.expected:
+            self.connected.set()
+
+    async def publish(self, payload):
+        """
+        Send a payload to all subscribers
+        :param payload: The encoded lines
+        """
+        for subscriber in list(self.subscribers):
+            if subscriber.task.done():
+                self.subscribers.discard(subscriber)
+            elif subscriber.queue.full():
+                self.subscribers.discard(subscriber)
+                subscriber.task.cancel()
+                subscriber.writer.close()
+                self.dropped += 1
+            else:
+                subscriber.queue.put_nowait(payload)
+        # let the subscribers send
+        await asyncio.sleep(0)
+
+    async def close(self):
+        """
+        Flush and disconnect all subscribers
+        """
+        for subscriber in self.subscribers:
+            subscriber.queue.put_nowait(None)
+        await asyncio.gather(
+            *[subscriber.task for subscriber in self.subscribers],
+            return_exceptions=True,
+        )
+
+
+class StdoutBroadcaster:
+    """
+    Send the replay to stdout, waiting for every write
+    :param header: The first line
+    """
+
+    def __init__(self, header):
+        self.output = sys.stdout.buffer
+        self.output.write(header)
+        self.dropped = 0
+
+    async def publish(self, payload):
+        """
+        Write a payload
+        :param payload: The encoded lines
+        """
+        self.output.write(payload)
+        await asyncio.sleep(0)
+
+    async def close(self):
+        """
+        Flush stdout
+        """
+        self.output.flush()
+
+
+async def replay(generator, broadcaster, speedup=None, rate=None):
+    """
+    Replay the instances of a generator. An instance is due once the
+    SubmitOffset elapsed since the first instance, divided by speedup, has
+    passed, and no earlier than its position divided by rate. Without speedup
+    and rate the instances are sent as fast as they are generated.
+    :param generator: The ReplayGenerator
+    :param broadcaster: The Broadcaster or StdoutBroadcaster to send to
+    :param speedup: The time compression factor, None to ignore SubmitOffset
+    :param rate: The maximum number of instances per second, None for no
+        limit
+    :return: the number of instances sent
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    first = None
+    sent = 0
+    # generate the next window in a thread while the current one is sent
+    pending = loop.run_in_executor(None, generator.next_window)
+    while True:
+        window = await pending
+        if window is None:
+            break
+        pending = loop.run_in_executor(None, generator.next_window)
+        hash_tags, values, offsets = window
+        n = offsets.size
+        if first is None:
+            first = offsets[0]
+        due = np.zeros(n)
+        if speedup is not None:
+            due = (offsets - first) / speedup
+        if rate is not None:
+            due = np.maximum(due, (sent + np.arange(n)) / rate)
+        i = 0
+        while i < n:
+            now = loop.time() - start
+            if due[i] > now:
+                await asyncio.sleep(due[i] - now)
+                continue
+            j = max(i + 1, np.searchsorted(due, now + TICK_SECONDS, "right"))
+            j = min(j, i + generator.window_rows)
+            await broadcaster.publish(
+                format_lines(hash_tags[i:j], values[i:j], generator.int_mask)
+            )
+            i = j
+        sent += n
+    await broadcaster.close()
+    return sent
+
+
+def parse_args():
+    """
+    Parse the command line arguments
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        usage="replay.py <distribution-dir> <size-per-query> [options]"
+    )
+    parser.add_argument("dist_path", metavar="distribution-dir")
+    parser.add_argument("size_per_query", metavar="size-per-query", type=int)
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="global seed of the replay, drawn at random if not given",
+    )
+    parser.add_argument(
+        "--speedup",
+        type=float,
+        default=None,
+        help="time compression factor, the number of SubmitOffset seconds "
+        "replayed per second",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=None,
+        help="maximum number of instances sent per second",
+    )
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument(
+        "--tcp",
+        default=None,
+        metavar="HOST:PORT",
+        help="serve the replay on a TCP socket instead of stdout",
+    )
+    target.add_argument(
+        "--unix",
+        default=None,
+        metavar="PATH",
+        help="serve the replay on a Unix socket instead of stdout",
+    )
+    parser.add_argument(
+        "--subscribers",
+        type=int,
+        default=1,
+        help="number of subscribers to wait for before starting the replay",
+    )
+    parser.add_argument(
+        "--window-rows",
+        type=int,
+        default=WINDOW_ROWS,
+        help="approximate number of instances generated at a time",
+    )
+    args = parser.parse_args()
+    if args.speedup is not None and args.speedup <= 0:
+        parser.error("--speedup must be positive")
+    if args.rate is not None and args.rate <= 0:
+        parser.error("--rate must be positive")
+    if args.window_rows < 1:
+        parser.error("--window-rows must be positive")
+    if args.seed is None:
+        args.seed = random_streams.new_seed()
+    return args
+
+
+async def serve(args, generator, header):
+    """
+    Serve the replay on a socket, once enough subscribers are connected
+    :param args: The parsed arguments
+    :param generator: The ReplayGenerator
+    :param header: The header line
+    :return: the number of instances sent
+    """
+    broadcaster = Broadcaster(header)
+    broadcaster.expected = args.subscribers
+    if args.tcp is not None:
+        host, port = args.tcp.rsplit(":", 1)
+        server = await asyncio.start_server(
+            broadcaster.subscribe, host, int(port)
+        )
+    else:
+        if os.path.exists(args.unix):
+            os.remove(args.unix)
+        server = await asyncio.start_unix_server(
+            broadcaster.subscribe, args.unix
+        )
+    print(
+        "Waiting for " + str(args.subscribers) + " subscribers.",
+        file=sys.stderr,
+    )
+    async with server:
+        await broadcaster.connected.wait()
+        sent = await replay(generator, broadcaster, args.speedup, args.rate)
+    if args.unix is not None:
+        os.remove(args.unix)
+    if broadcaster.dropped > 0:
+        print(
+            "Dropped " + str(broadcaster.dropped) + " lagging subscribers.",
+            file=sys.stderr,
+        )
+    return sent
+
+
+def main():
+    """
+    Main method
+    """
+    args = parse_args()
+    distributions = distribution_store.load(args.dist_path)
+    generator = ReplayGenerator(
+        distributions, args.size_per_query, args.seed, args.window_rows
+    )
+    for hash_tag, e in generator.failures:
+        print(
+            "Failed to generate data set for " + hash_tag + ".",
+            e,
+            file=sys.stderr,
+        )
+    header = (",".join(["HT1"] + generator.header) + "\n").encode()
+    if args.tcp is None and args.unix is None:
+        sent = asyncio.run(
+            replay(
+                generator, StdoutBroadcaster(header), args.speedup, args.rate
+            )
+        )
+    else:
+        sent = asyncio.run(serve(args, generator, header))
+    print("Replayed " + str(sent) + " instances.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,534 @@
+"""Module for the sharded consolidated output.
+
+A sharded output is a directory holding the consolidated rows split into
+shards, and a shards.json manifest. Every job is written whole to one shard,
+picked either by the hash of its HT1 or in turn by its position in the
+distributions. A shard is written to one or more files, a new file being
+started once the current one reaches the maximum size, so that a shard file
+exceeds the maximum size by less than one job. Shard files are either CSV
+files with the header of the consolidated output, or columnar data sets.
+"""
+
+import csv
+import json
+import os
+import shutil
+import numpy as np
+import columnar
+from sketches import hash64
+
+MANIFEST = "shards.json"
+MANIFEST_VERSION = 1
+HASH_BITS = 64
+COPY_BYTES = 1024 * 1024
+
+
+def shard_of(hash_tag, shards):
+    """
+    Get the shard of a job when routing by HT1 hash. Shard i holds the jobs
+    whose hash lies in [hash_ranges(shards)[i][0], hash_ranges(shards)[i][1])
+    :param hash_tag: The hash tag of the job
+    :param shards: The number of shards
+    :return: shard index
+    """
+    return (hash64(hash_tag) * shards) >> HASH_BITS
+
+
+def hash_ranges(shards):
+    """
+    Get the HT1 hash range of every shard when routing by HT1 hash
+    :param shards: The number of shards
+    :return: list of [low, high) hash bounds
+    """
+    bounds = [-(-(i << HASH_BITS) // shards) for i in range(shards + 1)]
+    return [[bounds[i], bounds[i + 1]] for i in range(shards)]
+
+
+def copy_bytes(source, target, count):
+    """
+    Copy bytes from the current position of a file to another file
+    :param source: The binary file to copy from
+    :param target: The binary file to copy to
+    :param count: The number of bytes to copy
+    """
+    while count > 0:
+        data = source.read(min(count, COPY_BYTES))
+        if not data:
+            raise EOFError("Shard part is shorter than its manifest")
+        target.write(data)
+        count -= len(data)
+
+
+class CsvShardFile:
+    """
+    A CSV file of a shard, starting with the consolidated header
+    :param path: The file path
+    :param header: The names of the columns, without HT1
+    """
+
+    def __init__(self, path, header):
+        self.path = path
+        self.file = open(path, "w", newline="\n")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(["HT1"] + list(header))
+
+    def position(self):
+        """
+        Get the position at which the next row is written
+        :return: byte offset
+        """
+        return self.file.tell()
+
+    def size(self):
+        """
+        Get the size of the file written so far
+        :return: number of bytes
+        """
+        return self.file.tell()
+
+    def extent_bytes(self, start, stop):
+        """
+        Get the size of a range of positions
+        :param start: The first position
+        :param stop: The position after the last one
+        :return: number of bytes
+        """
+        return stop - start
+
+    def append(self, part, start, stop):
+        """
+        Append a range of rows of a shard file written by another process
+        :param part: The path of the other shard file
+        :param start: The position of the first row
+        :param stop: The position after the last row
+        """
+        self.file.flush()
+        with open(part, "rb") as source:
+            source.seek(start)
+            copy_bytes(source, self.file.buffer, stop - start)
+        self.file.buffer.flush()
+
+    def flush(self):
+        """
+        Flush the file
+        """
+        self.file.flush()
+
+    def close(self):
+        """
+        Close the file
+        """
+        self.file.close()
+
+    def saturated(self):
+        """
+        Get the number of clipped values, which are never clipped in CSV
+        :return: empty dict
+        """
+        return {}
+
+
+class ColumnarShardFile:
+    """
+    A columnar data set of a shard
+    :param path: The directory of the data set
+    :param header: The names of the columns, without HT1
+    :param int_mask: Which columns are integer columns
+    :param hash_tags: The dictionary of hash tags of the rows, None to store
+        the hash tags as int64 values
+    """
+
+    def __init__(self, path, header, int_mask, hash_tags):
+        self.path = path
+        self.writer = columnar.ColumnarWriter(
+            path, header, int_mask, hash_tags
+        )
+        self.row_bytes = self.writer.hash_tag_dtype().itemsize + 8 * len(
+            header
+        )
+
+    def position(self):
+        """
+        Get the position at which the next row is written
+        :return: row index
+        """
+        return self.writer.rows
+
+    def size(self):
+        """
+        Get the size of the data set written so far
+        :return: number of bytes
+        """
+        return self.writer.rows * self.row_bytes
+
+    def extent_bytes(self, start, stop):
+        """
+        Get the size of a range of positions
+        :param start: The first position
+        :param stop: The position after the last one
+        :return: number of bytes
+        """
+        return (stop - start) * self.row_bytes
+
+    def append(self, part, start, stop):
+        """
+        Append a range of rows of a shard data set written by another process
+        :param part: The directory of the other data set
+        :param start: The first row
+        :param stop: The row after the last one
+        """
+        self.writer.append_rows(part, start, stop)
+
+    def flush(self):
+        """
+        Flush the column files
+        """
+        self.writer.flush()
+
+    def close(self):
+        """
+        Close the data set and write its manifest
+        """
+        self.writer.close()
+
+    def saturated(self):
+        """
+        Get the number of clipped values per column
+        :return: dict of column name to count
+        """
+        return self.writer.saturated
+
+
+class ShardedWriter:
+    """
+    Writer of a sharded consolidated output. Jobs must be written one after
+    the other, each with consecutive calls to route().
+    :param path: The output directory, created if needed
+    :param header: The names of the columns, without HT1
+    :param int_mask: Which columns are integer columns
+    :param hash_tags: The hash tags of the distributions, in order, or None
+        if they are only routed by hash and stored as int64 values in columnar
+        shard files
+    :param shards: The number of shards
+    :param routing: "hash" to route the jobs by HT1 hash, "round-robin" to
+        route them in turn by their position in hash_tags
+    :param max_bytes: The size at which a new shard file is started, None
+        for one file per shard
+    :param file_format: The format of the shard files, "csv" or "columnar"
+    :param record_jobs: Whether to record the position of every job in the
+        manifest, which append_part needs to merge an output into another
+    """
+
+    def __init__(
+        self,
+        path,
+        header,
+        int_mask,
+        hash_tags,
+        shards=1,
+        routing="hash",
+        max_bytes=None,
+        file_format="csv",
+        record_jobs=False,
+    ):
+        if routing not in ("hash", "round-robin"):
+            raise ValueError("Unknown shard routing " + str(routing))
+        if hash_tags is None and routing != "hash":
+            raise ValueError("Routing in turn needs the hash tags")
+        self.path = path
+        self.header = list(header)
+        self.int_mask = np.asarray(int_mask, dtype=bool)
+        self.hash_tags = None
+        self.positions = None
+        if hash_tags is not None:
+            self.hash_tags = [str(hash_tag) for hash_tag in hash_tags]
+            self.positions = {
+                hash_tag: i for i, hash_tag in enumerate(self.hash_tags)
+            }
+        self.shards = shards
+        self.routing = routing
+        self.max_bytes = max_bytes
+        self.file_format = file_format
+        self.record_jobs = record_jobs
+        if not os.path.exists(path):
+            os.mkdir(path)
+        # open shard file and manifest entry of every shard
+        self.current = [None] * shards
+        self.files = []
+        self.jobs = []
+        self.job = None
+        # clipped values of the closed shard files
+        self.saturated_closed = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def part_args(self):
+        """
+        Get the arguments, after the path, of a writer of a part of this
+        output, to be merged with append_part
+        :return: tuple of arguments
+        """
+        return (
+            self.header,
+            self.int_mask,
+            self.hash_tags,
+            self.shards,
+            self.routing,
+            None,
+            self.file_format,
+            True,
+        )
+
+    def shard(self, hash_tag):
+        """
+        Get the shard of a job
+        :param hash_tag: The hash tag of the job
+        :return: shard index
+        """
+        if self.routing == "hash":
+            return shard_of(hash_tag, self.shards)
+        return self.positions[hash_tag] % self.shards
+
+    def open_file(self, shard):
+        """
+        Start a new file for a shard
+        :param shard: The shard index
+        """
+        if self.current[shard] is not None:
+            self.close_file(*self.current[shard])
+        entry = {
+            "file": "shard-%05d-%05d" % (shard, len(self.files)),
+            "shard": shard,
+            "rows": 0,
+            "bytes": 0,
+            "jobs": 0,
+            "first_hash_tag": None,
+            "last_hash_tag": None,
+        }
+        path = os.path.join(self.path, entry["file"])
+        if self.file_format == "columnar":
+            shard_file = ColumnarShardFile(
+                path, self.header, self.int_mask, self.hash_tags
+            )
+        else:
+            entry["file"] += ".csv"
+            shard_file = CsvShardFile(path + ".csv", self.header)
+        self.current[shard] = (shard_file, entry)
+        self.files.append(entry)
+
+    def close_file(self, shard_file, entry):
+        """
+        Close a shard file
+        :param shard_file: The shard file
+        :param entry: The manifest entry of the file
+        """
+        entry["bytes"] = shard_file.size()
+        self.add_saturated(shard_file.saturated())
+        shard_file.close()
+
+    def add_saturated(self, saturated):
+        """
+        Add the clipped values of a closed file
+        :param saturated: dict of column name to count
+        """
+        for name, count in saturated.items():
+            self.saturated_closed[name] = (
+                self.saturated_closed.get(name, 0) + count
+            )
+
+    def full(self, shard, pending_bytes=0):
+        """
+        Check whether the current file of a shard has reached the maximum
+        size
+        :param shard: The shard index
+        :param pending_bytes: The size of rows not yet written to the file
+        :return: True if a new file must be started before the next job
+        """
+        if self.max_bytes is None or self.current[shard] is None:
+            return False
+        shard_file, entry = self.current[shard]
+        return (
+            entry["rows"] > 0
+            and shard_file.size() + pending_bytes >= self.max_bytes
+        )
+
+    def start_job(self, hash_tag, shard):
+        """
+        Start writing a job, in a new file of its shard if the current one
+        is full
+        :param hash_tag: The hash tag of the job
+        :param shard: The shard of the job
+        :return: shard file and manifest entry the job is written to
+        """
+        if self.current[shard] is None or self.full(shard):
+            self.open_file(shard)
+        shard_file, entry = self.current[shard]
+        entry["jobs"] += 1
+        if entry["first_hash_tag"] is None:
+            entry["first_hash_tag"] = hash_tag
+        entry["last_hash_tag"] = hash_tag
+        return shard_file, entry
+
+    def end_job(self):
+        """
+        Record the position of the job being written
+        """
+        if self.job is None:
+            return
+        hash_tag, shard, shard_file, entry, start, rows = self.job
+        if self.record_jobs:
+            self.jobs.append(
+                [hash_tag, shard, start, shard_file.position(), rows]
+            )
+        self.job = None
+
+    def route(self, hash_tag, rows):
+        """
+        Get the writer for a block of rows of a job
+        :param hash_tag: The hash tag of the job
+        :param rows: The number of rows of the block
+        :return: the CSV writer or columnar.ColumnarWriter of the shard file
+            of the job
+        """
+        hash_tag = str(hash_tag)
+        if self.job is None or self.job[0] != hash_tag:
+            self.end_job()
+            shard = self.shard(hash_tag)
+            shard_file, entry = self.start_job(hash_tag, shard)
+            self.job = [
+                hash_tag,
+                shard,
+                shard_file,
+                entry,
+                shard_file.position(),
+                0,
+            ]
+        self.job[3]["rows"] += rows
+        self.job[5] += rows
+        return self.job[2].writer
+
+    def append_part(self, part_path):
+        """
+        Append the jobs of another sharded output with the same columns,
+        shards and routing, written with record_jobs, and remove it. Every job
+        is appended to the current file of its shard, which is rolled over
+        between jobs as when the jobs are written directly.
+        :param part_path: The directory of the other output
+        """
+        self.end_job()
+        manifest = read_manifest(part_path)
+        part_files = {
+            entry["shard"]: os.path.join(part_path, entry["file"])
+            for entry in manifest["files"]
+        }
+        # the jobs of a shard are contiguous in the part, and consecutive
+        # jobs going to the same file are copied at once
+        pending = {}
+
+        def flush_pending(shard):
+            shard_file, start, stop = pending.pop(shard)
+            shard_file.append(part_files[shard], start, stop)
+
+        for hash_tag, shard, start, stop, rows in manifest["jobs"]:
+            if shard in pending:
+                shard_file, first, last = pending[shard]
+                if self.full(shard, shard_file.extent_bytes(first, last)):
+                    flush_pending(shard)
+            shard_file, entry = self.start_job(hash_tag, shard)
+            entry["rows"] += rows
+            if shard in pending:
+                pending[shard][2] = stop
+            else:
+                pending[shard] = [shard_file, start, stop]
+        for shard in list(pending):
+            flush_pending(shard)
+        shutil.rmtree(part_path)
+
+    @property
+    def saturated(self):
+        """
+        The number of values clipped to the int64 range, per column
+        """
+        saturated = dict(self.saturated_closed)
+        for shard_file, _ in self.open_files():
+            for name, count in shard_file.saturated().items():
+                saturated[name] = saturated.get(name, 0) + count
+        return saturated
+
+    def open_files(self):
+        """
+        Get the files of the shards that are still open
+        :return: list of shard files and manifest entries
+        """
+        return [current for current in self.current if current is not None]
+
+    def flush(self):
+        """
+        Flush the shard files
+        """
+        for shard_file, _ in self.open_files():
+            shard_file.flush()
+
+    def close(self):
+        """
+        Close the shard files and write the manifest
+        """
+        self.end_job()
+        for shard_file, entry in self.open_files():
+            self.close_file(shard_file, entry)
+        self.current = [None] * self.shards
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "format": self.file_format,
+            "routing": self.routing,
+            "shards": self.shards,
+            "max_bytes": self.max_bytes,
+            "rows": sum(entry["rows"] for entry in self.files),
+            "files": self.files,
+            "saturated": {
+                name: count
+                for name, count in self.saturated.items()
+                if count > 0
+            },
+        }
+        if self.routing == "hash":
+            manifest["hash_ranges"] = hash_ranges(self.shards)
+        if self.record_jobs:
+            manifest["jobs"] = self.jobs
+        with open(os.path.join(self.path, MANIFEST), "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=1)
+
+
+def read_manifest(path):
+    """
+    Read the manifest of a sharded output
+    :param path: The directory of the output
+    :return: dict with the shard files, their row counts and first and last
+        hash tags, and the HT1 hash range of every shard if routed by hash
+    """
+    with open(os.path.join(path, MANIFEST)) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest["version"] != MANIFEST_VERSION:
+        raise ValueError(
+            "Unsupported shard manifest version " + str(manifest["version"])
+        )
+    return manifest
+
+
+def shard_files(path, shard):
+    """
+    Get the files of a shard, in the order they were written
+    :param path: The directory of the output
+    :param shard: The shard index
+    :return: list of CSV file paths or columnar data set directories
+    """
+    manifest = read_manifest(path)
+    return [
+        os.path.join(path, entry["file"])
+        for entry in manifest["files"]
+        if entry["shard"] == shard
+    ]
@@ -1,88 +1,343 @@
 """Module for generating synthetic data set based on the given data distribution
 """
-import sys
-import math
+import argparse
+import multiprocessing
 import numpy as np
 import csv
 import os
-import ast
+import shutil
+import tempfile
+import time
+import checkpoint
+import columnar
+import distribution_store
+import metrics
+import pipeline
+import random_streams
+import shards
+import validate
+from moments import RunningMoments
 
+# maximum number of values generated at once when simulating jobs in batches
+BATCH_VALUES = 2 ** 21
 
-def gaussian(N, d):
+
+def gaussian(N, d, rng=None):
     """
-    Generate normal distribution using Box-Muller transform.
+    Generate normal distribution using the ziggurat method of the random
+    generator.
     :param N: number of instances to generate
     :param d: the dimension of each instance
+    :param rng: the random generator to draw from, defaults to the global
+        numpy random state
     :return:
     """
-    columns = []
-    for i in range(0, int((d + 1) / 2)):
-        u1 = np.random.rand(N)
-        u2 = np.random.rand(N)
-        z1 = np.sqrt(-2 * np.log(u1)) * np.cos(2 * np.pi * u2)
-        columns.append(z1)
-        if len(columns) < d:
-            z2 = np.sqrt(-2 * np.log(u1)) * np.sin(2 * np.pi * u2)
-            columns.append(z2)
-    return np.array(columns)
+    source = np.random if rng is None else rng
+    with metrics.stage("sample"):
+        return source.standard_normal((d, N))
 
 
-def generate_dependent_data(columns, mean, covar, N):
+def factorize_dependent_data(columns, mean, covar):
     """
-    Generate correlated data
-    https://en.wikipedia.org/wiki/Multivariate_normal_distribution#Drawing_values_from_the_distribution
+    Factorize the covariance of the dependent columns
     :param columns: The list of dependent columns
     :param mean: The mean vector of the columns
     :param covar: The covariance matrix
-    :param N: The number of instances to generate
-    :return:
+    :return: mean vector and Cholesky factor of the dependent columns
     """
     # extract mean, covar only for the dependent columns
-    nonzero_covar = []
-    nonzero_covar_mean = []
-    for c in range(0, covar.shape[0]):
-        if c in columns:
-            row = []
-            for v in range(0, covar[c].size):
-                if v in columns:
-                    row.append(covar[c, v])
-            nonzero_covar.append(row)
-            nonzero_covar_mean.append(mean[c])
-    nonzero_covar = np.array(nonzero_covar)
-    nonzero_covar_mean = np.asarray(nonzero_covar_mean)
+    columns = np.unique(np.asarray(columns, dtype=int))
+    nonzero_covar = covar[np.ix_(columns, columns)]
+    nonzero_covar_mean = mean[columns]
 
     # factorize
-    A = np.linalg.cholesky(nonzero_covar)  # Cholesky decomposition
+    with metrics.stage("factorize"):
+        A = np.linalg.cholesky(nonzero_covar)  # Cholesky decomposition
+    return nonzero_covar_mean, A
+
 
+def sample_dependent_data(mean, A, N, rng=None):
+    """
+    Draw correlated data from a factorized distribution
+    :param mean: The mean vector of the dependent columns
+    :param A: The Cholesky factor of the dependent columns covariance
+    :param N: The number of instances to generate
+    :param rng: The random generator to draw from
+    :return:
+    """
     # generate normal distribution data
-    z = gaussian(N, nonzero_covar_mean.size)
+    z = gaussian(N, mean.size, rng)
 
     # adjust the distribution
-    return nonzero_covar_mean[:, np.newaxis] + np.matmul(A, z)
+    return mean[:, np.newaxis] + np.matmul(A, z)
 
 
-def generate_independent_data(columns, mean, std, N):
+def generate_dependent_data(columns, mean, covar, N, rng=None):
+    """
+    Generate correlated data
+    https://en.wikipedia.org/wiki/Multivariate_normal_distribution#Drawing_values_from_the_distribution
+    :param columns: The list of dependent columns
+    :param mean: The mean vector of the columns
+    :param covar: The covariance matrix
+    :param N: The number of instances to generate
+    :param rng: The random generator to draw from
+    :return:
+    """
+    nonzero_covar_mean, A = factorize_dependent_data(columns, mean, covar)
+    return sample_dependent_data(nonzero_covar_mean, A, N, rng)
+
+
+def generate_independent_data(columns, mean, std, N, rng=None):
     """
     Generate independent variables
     :param columns:
     :param mean:
     :param std:
     :param N:
+    :param rng:
     :return:
     """
     # generate normal distribution data
-    z = gaussian(N, len(columns))
+    z = gaussian(N, len(columns), rng)
 
     # adjust with mean and standard deviation
-    data = []
-    for i in range(0, len(columns)):
-        items = []
-        for v in z[i]:
-            items.append(mean[columns[i]] + std[columns[i]] * v)
-        data.append(items)
+    columns = np.asarray(columns, dtype=int)
+    return mean[columns][:, np.newaxis] + std[columns][:, np.newaxis] * z
+
+
+def assemble_rows(dep_cols, dep_data, ind_cols, ind_data, num_columns):
+    """
+    Scatter the dependent and independent column data into a single output matrix
+    :param dep_cols: dependent columns
+    :param dep_data: data for dependent columns
+    :param ind_cols: independent columns
+    :param ind_data: data for independent columns
+    :param num_columns: the number of columns in the output
+    :return: matrix with one row per instance and one column per attribute
+    """
+    ddata = dep_data.T
+    idata = ind_data.T
+    if (
+        len(ddata) != len(idata)
+        and ddata.shape[0] != 0
+        and idata.shape[0] != 0
+    ):
+        print("Dependent data shape", ddata.shape)
+        print("Independent data shape", idata.shape)
+        raise Exception("Different #rows in dependent and independent columns")
+
+    dep_cols = np.asarray(dep_cols, dtype=int)
+    ind_cols = np.asarray(ind_cols, dtype=int)
+    covered = np.zeros(num_columns, dtype=bool)
+    covered[dep_cols] = True
+    covered[ind_cols] = True
+    missing = np.flatnonzero(~covered)
+    if missing.size > 0 and len(ddata) > 0:
+        raise Exception(
+            "column neither in dependent nor in independent column list",
+            int(missing[0]),
+        )
+
+    rows = np.empty((len(ddata), num_columns))
+    rows[:, dep_cols] = ddata
+    if ind_cols.size > 0:
+        rows[:, ind_cols] = idata
+    return rows
+
+
+def ceil_to_int(values):
+    """
+    Round values up to integers and make them non-negative
+    :param values: the values to round
+    :return: int64 array, or a list of python ints if the values overflow int64
+    """
+    values = np.abs(np.ceil(values))
+    if values.size == 0 or np.max(values) < 2 ** 63:
+        return values.astype(np.int64)
+    return [int(v) for v in values]
+
+
+def format_rows(rows, int_cols):
+    """
+    Convert the output matrix into the cell values written to the CSV files
+    :param rows: the output matrix
+    :param int_cols: the list of integer columns
+    :return: object matrix holding python ints for the integer columns and
+        python floats for the rest
+    """
+    int_mask = np.zeros(rows.shape[1], dtype=bool)
+    int_mask[np.asarray(int_cols, dtype=int)] = True
+    cells = np.empty(rows.shape, dtype=object)
+    for i in range(rows.shape[1]):
+        if int_mask[i]:
+            cells[:, i] = ceil_to_int(rows[:, i])
+        else:
+            cells[:, i] = np.abs(rows[:, i])
+    return cells
+
+
+def written_values(rows, int_cols):
+    """
+    Get the values of the output matrix as they are written to the CSV files,
+    which is how validate.py reads them back
+    :param rows: the output matrix
+    :param int_cols: the list of integer columns
+    :return: matrix of the written values
+    """
+    values = np.abs(rows)
+    int_cols = np.asarray(int_cols, dtype=int)
+    values[:, int_cols] = np.abs(np.ceil(rows[:, int_cols]))
+    return values
+
+
+def write_block(
+    dep_cols,
+    dep_data,
+    ind_cols,
+    ind_data,
+    sim_csv,
+    consolidated_csv,
+    hash_tag,
+    header,
+    int_cols,
+):
+    """
+    Write a block of simulated instances of a job
+    :param dep_cols: dependent columns
+    :param dep_data: data for dependent columns
+    :param ind_cols: independent columns
+    :param ind_data: data for independent columns
+    :param sim_csv: the writer for the simulated output of the job
+    :param consolidated_csv: the writer for the consolidated output
+    :param hash_tag: the hash tag of the job whose datagen is being written to the output
+    :param header: the file header
+    :param int_cols: the list of integer columns
+    """
+    rows = assemble_rows(dep_cols, dep_data, ind_cols, ind_data, len(header))
+    write_rows(rows, sim_csv, consolidated_csv, hash_tag, int_cols)
+
+
+def write_rows(
+    rows, sim_csv, consolidated_csv, hash_tag, int_cols, moments=None
+):
+    """
+    Write the output matrix of a job
+    :param rows: the output matrix
+    :param sim_csv: the writer for the simulated output of the job, None to
+        only write the consolidated output
+    :param consolidated_csv: the writer for the consolidated output, a CSV
+        writer, a columnar.ColumnarWriter or a shards.ShardedWriter
+    :param hash_tag: the hash tag of the job whose datagen is being written to the output
+    :param int_cols: the list of integer columns
+    :param moments: the running moments of the job, updated with the values
+        as they are written, or None
+    """
+    with metrics.stage("write"):
+        write_cells(
+            rows, sim_csv, consolidated_csv, hash_tag, int_cols, moments
+        )
+    metrics.count("rows", rows.shape[0])
 
-    # return in matrix form
-    return np.array(data)
+
+def write_cells(rows, sim_csv, consolidated_csv, hash_tag, int_cols, moments):
+    """
+    Format and write the output matrix of a job
+    :param rows: the output matrix
+    :param sim_csv: the writer for the simulated output of the job, or None
+    :param consolidated_csv: the writer for the consolidated output
+    :param hash_tag: the hash tag of the job
+    :param int_cols: the list of integer columns
+    :param moments: the running moments of the job, or None
+    """
+    if isinstance(consolidated_csv, shards.ShardedWriter):
+        consolidated_csv = consolidated_csv.route(hash_tag, rows.shape[0])
+    binary = isinstance(consolidated_csv, columnar.ColumnarWriter)
+    if moments is not None or binary:
+        values = written_values(rows, int_cols)
+        if moments is not None:
+            moments.update_block(values)
+        if binary:
+            consolidated_csv.write(hash_tag, values)
+    if binary and sim_csv is None:
+        return
+
+    with metrics.stage("format"):
+        cells = format_rows(rows, int_cols)
+    if sim_csv is not None:
+        sim_csv.writerows(cells.tolist())
+    if binary:
+        return
+
+    consolidated = np.empty((cells.shape[0], cells.shape[1] + 1), dtype=object)
+    consolidated[:, 0] = hash_tag
+    consolidated[:, 1:] = cells
+    consolidated_csv.writerows(consolidated.tolist())
+
+
+def generate_jobs(jobs, size, rngs):
+    """
+    Generate the instances of several jobs at once. The jobs are grouped by
+    their dependent columns, and each group is factorized with one stacked
+    Cholesky decomposition and sampled with one batched matrix product. Every
+    job draws from its own random generator in the same order as generate(),
+    so a job gets the same instances as when it is generated on its own.
+    :param jobs: The job distributions, see distribution_store.Distributions
+    :param size: The number of instances to simulate per job
+    :param rngs: The random generator of each job
+    :return: list with the output matrix of each job, or the LinAlgError if
+        the covariance of the job could not be factorized
+    """
+    results = [None] * len(jobs)
+    groups = {}
+    for i, job in enumerate(jobs):
+        columns = np.unique(np.asarray(job[4], dtype=int))
+        groups.setdefault(tuple(columns.tolist()), []).append(i)
+
+    for columns, indices in groups.items():
+        columns = np.array(columns, dtype=int)
+        d = jobs[indices[0]][1].size
+        ind_columns = np.flatnonzero(~np.isin(np.arange(d), columns))
+        covars = np.array(
+            [jobs[i][3][np.ix_(columns, columns)] for i in indices]
+        )
+        with metrics.stage("factorize"):
+            try:
+                A = np.linalg.cholesky(covars)
+            except np.linalg.LinAlgError:
+                # factorize the jobs one by one to report the failing ones
+                A = np.empty_like(covars)
+                factorized = []
+                for n, i in enumerate(indices):
+                    try:
+                        A[n] = np.linalg.cholesky(covars[n])
+                        factorized.append(n)
+                    except np.linalg.LinAlgError as e:
+                        results[i] = e
+                A = A[factorized]
+                indices = [indices[n] for n in factorized]
+
+        J = len(indices)
+        means = np.array([jobs[i][1] for i in indices]).reshape(J, d)
+        stds = np.array([jobs[i][2] for i in indices]).reshape(J, d)
+        dep_z = np.empty((J, columns.size, size))
+        ind_z = np.empty((J, ind_columns.size, size))
+        for n, i in enumerate(indices):
+            dep_z[n] = gaussian(size, columns.size, rngs[i])
+            ind_z[n] = gaussian(size, ind_columns.size, rngs[i])
+
+        rows = np.empty((J, size, d))
+        rows[:, :, columns] = np.swapaxes(
+            means[:, columns, np.newaxis] + np.matmul(A, dep_z), 1, 2
+        )
+        rows[:, :, ind_columns] = np.swapaxes(
+            means[:, ind_columns, np.newaxis]
+            + stds[:, ind_columns, np.newaxis] * ind_z,
+            1,
+            2,
+        )
+        for n, i in enumerate(indices):
+            results[i] = rows[n]
+    return results
 
 
 def write_output(
@@ -111,73 +366,111 @@ def write_output(
     with open(sim_output, "w", newline="\n") as myfile:
         wr = csv.writer(myfile)
         wr.writerow(header)
-
-        ddata = dep_data.T
-        idata = ind_data.T
-        if (
-            len(ddata) != len(idata)
-            and ddata.shape[0] != 0
-            and idata.shape[0] != 0
-        ):
-            print("Dependent data shape", ddata.shape)
-            print("Independent data shape", idata.shape)
-            raise Exception(
-                "Different #rows in dependent and independent columns"
-            )
-
-        for r in range(0, len(ddata)):
-            d_idx = 0
-            i_idx = 0
-            row = []
-            for i in range(0, len(header)):
-                if i in dep_cols:
-                    value = (
-                        math.ceil(ddata[r, d_idx])
-                        if i in int_cols
-                        else ddata[r, d_idx]
-                    )
-                    row.append(abs(value))
-                    d_idx += 1
-                elif i in ind_cols:
-                    value = (
-                        math.ceil(idata[r, i_idx])
-                        if i in int_cols
-                        else idata[r, i_idx]
-                    )
-                    row.append(abs(value))
-                    i_idx += 1
-                else:
-                    raise Exception(
-                        "column neither in dependent nor in independent column list",
-                        i,
-                    )
-            wr.writerow(row)
-            row.insert(0, hash_tag)
-            consolidated_csv.writerow(row)
+        write_block(
+            dep_cols,
+            dep_data,
+            ind_cols,
+            ind_data,
+            wr,
+            consolidated_csv,
+            hash_tag,
+            header,
+            int_cols,
+        )
 
 
 def generate(
-    header, input_dist, sim_output, consolidated_csv, hash_tag, first, size
+    header,
+    input_dist,
+    sim_output,
+    consolidated_csv,
+    hash_tag,
+    first,
+    size,
+    chunk_rows=None,
+    rng=None,
+    moments=None,
 ):
     """
     Generate simulated data set
-    :param input_dist: The input data distribution
-    :param sim_output: The output path for simulated data set
+    :param input_dist: The input data distribution, either a row of
+        distributions.csv or a job distribution from distribution_store
+    :param sim_output: The output path for simulated data set, None to only
+        write the consolidated output
     :param consolidated_csv: The writer for consolidated CSV
     :param hash_tag: The hash tag for this recurring job
     :param first: Flag to indicate whether this is the first recurring job
     :param size: The number of instances to simulate
+    :param chunk_rows: The number of instances to generate and write at a
+        time, or None to generate the whole job at once
+    :param rng: The random generator of this job
+    :param moments: The running moments of this job, updated with the
+        instances as they are written, or None
     """
     if first:
         h = header.copy()
         h.insert(0, "HT1")
         consolidated_csv.writerow(h)
 
-    mean = np.asarray(ast.literal_eval(input_dist[1]))
-    stdev = np.asarray(ast.literal_eval(input_dist[2]))
-    covar = np.asarray(ast.literal_eval(input_dist[3]))
-    dep_columns = np.asarray(ast.literal_eval(input_dist[4]))
-    int_columns = np.asarray(ast.literal_eval(input_dist[5]))
+    if isinstance(input_dist[1], str):
+        input_dist = distribution_store.parse_distribution(input_dist)
+    # factorize before opening the output, which is not written for jobs
+    # that cannot be factorized
+    blocks = generate_blocks(input_dist, size, chunk_rows, rng)
+    write_job(
+        header,
+        blocks,
+        sim_output,
+        consolidated_csv,
+        hash_tag,
+        input_dist[5],
+        moments,
+    )
+
+
+def write_job(
+    header, blocks, sim_output, consolidated_csv, hash_tag, int_cols, moments
+):
+    """
+    Write the output matrices of a job to its own output file and to the
+    consolidated output
+    :param header: the file header
+    :param blocks: the output matrices of the job
+    :param sim_output: the output path for the simulated data set, None to
+        only write the consolidated output
+    :param consolidated_csv: the writer for the consolidated output
+    :param hash_tag: the hash tag of the job
+    :param int_cols: the list of integer columns
+    :param moments: the running moments of the job, or None
+    """
+    if sim_output is None:
+        for rows in blocks:
+            write_rows(
+                rows, None, consolidated_csv, hash_tag, int_cols, moments
+            )
+        return
+    with open(sim_output, "w", newline="\n") as sim_file:
+        sim_csv = csv.writer(sim_file)
+        sim_csv.writerow(header)
+        for rows in blocks:
+            write_rows(
+                rows, sim_csv, consolidated_csv, hash_tag, int_cols, moments
+            )
+
+
+def generate_blocks(input_dist, size, chunk_rows=None, rng=None):
+    """
+    Generate the instances of a job, in blocks of chunk_rows instances. Each
+    block draws from its own child stream of the job stream, so that it can be
+    regenerated on its own.
+    :param input_dist: The job distribution, see distribution_store
+    :param size: The number of instances to simulate
+    :param chunk_rows: The number of instances to generate at a time, or None
+        to generate the whole job at once
+    :param rng: The random generator of this job
+    :return: iterator over the output matrices of the blocks
+    """
+    _, mean, stdev, covar, dep_columns, _ = input_dist
 
     # separate dependent and independent columns
     ind_columns = []
@@ -185,86 +478,875 @@ def generate(
         if i not in dep_columns:
             ind_columns.append(i)
 
-    # generate dependent and independent column data
-    dep_data = generate_dependent_data(dep_columns, mean, covar, size)
-    ind_data = generate_independent_data(ind_columns, mean, stdev, size)
+    if chunk_rows is None or chunk_rows >= size:
+        # generate dependent and independent column data
+        dep_data = generate_dependent_data(dep_columns, mean, covar, size, rng)
+        ind_data = generate_independent_data(
+            ind_columns, mean, stdev, size, rng
+        )
+        return iter(
+            [
+                assemble_rows(
+                    dep_columns, dep_data, ind_columns, ind_data, mean.size
+                )
+            ]
+        )
 
-    # write to file
-    write_output(
-        dep_columns,
-        dep_data,
-        ind_columns,
-        ind_data,
-        sim_output,
-        consolidated_csv,
-        hash_tag,
+    # factorize once, then generate the job in blocks of chunk_rows instances
+    # so that memory does not grow with the size of the job
+    dep_mean, A = factorize_dependent_data(dep_columns, mean, covar)
+    starts = range(0, size, chunk_rows)
+    rngs = random_streams.chunk_rngs(rng, len(starts))
+
+    def blocks():
+        for start, chunk_rng in zip(starts, rngs):
+            n = min(chunk_rows, size - start)
+            yield assemble_rows(
+                dep_columns,
+                sample_dependent_data(dep_mean, A, n, chunk_rng),
+                ind_columns,
+                generate_independent_data(
+                    ind_columns, mean, stdev, n, chunk_rng
+                ),
+                mean.size,
+            )
+
+    return blocks()
+
+
+def regenerate_job(manifest_path, hash_tag):
+    """
+    Regenerate the instances of a single job of a simulation run from its
+    seed manifest
+    :param manifest_path: The path of the seed manifest of the run
+    :param hash_tag: The hash tag of the job
+    :return: the output matrix of the job, before rounding of the integer
+        columns
+    """
+    manifest = random_streams.read_manifest(manifest_path)
+    distributions, missing = distribution_store.select(
+        manifest["distributions"], [hash_tag]
+    )
+    if missing:
+        raise KeyError(hash_tag)
+    blocks = generate_blocks(
+        distributions.job(0),
+        manifest["size_per_query"],
+        manifest["chunk_rows"],
+        random_streams.job_rng(manifest["seed"], hash_tag),
+    )
+    return np.concatenate(list(blocks))
+
+
+def job_blocks(input_dists, size, chunk_rows, seed):
+    """
+    Generate jobs in the order of their distributions. Jobs generated in
+    chunks are generated one block at a time, all other jobs in batches with
+    generate_jobs.
+    :param input_dists: The input data distributions, a list or a lazy
+        sequence of jobs such as population.Population
+    :param size: The number of instances to simulate per job
+    :param chunk_rows: The number of instances to generate at a time
+    :param seed: The global seed
+    :return: iterator over the job distributions and either the iterator over
+        the output matrices of the job, or the LinAlgError if the covariance of
+        the job could not be factorized
+    """
+    if len(input_dists) == 0:
+        return
+    chunked = chunk_rows is not None and chunk_rows < size
+    for batch in job_batches(input_dists, size, input_dists[0][1].size):
+        # batches of a lazy sequence of jobs are generated here
+        batch = list(batch)
+        rngs = [random_streams.job_rng(seed, job[0]) for job in batch]
+        if not chunked:
+            with metrics.stage("generate"):
+                results = generate_jobs(batch, size, rngs)
+            for job, result in zip(batch, results):
+                if isinstance(result, np.linalg.LinAlgError):
+                    yield job, result
+                else:
+                    yield job, iter([result])
+            continue
+        for job, rng in zip(batch, rngs):
+            try:
+                blocks = generate_blocks(job, size, chunk_rows, rng)
+            except np.linalg.LinAlgError as e:
+                blocks = e
+            yield job, blocks
+
+
+def simulate_batch(
+    header,
+    input_dists,
+    sim_path,
+    consolidated_csv,
+    size,
+    chunk_rows,
+    seed,
+    validate_jobs=False,
+    pipeline_depth=0,
+    recorder=None,
+):
+    """
+    Simulate a batch of jobs, each into its own output file and into the
+    consolidated output in the order of the batch. Jobs generated in chunks
+    are generated one at a time, all other jobs at once with generate_jobs.
+    :param header: The file header
+    :param input_dists: The input data distributions of the batch
+    :param sim_path: The output directory for the simulated data sets, None
+        to only write the consolidated output
+    :param consolidated_csv: The writer for consolidated CSV
+    :param size: The number of instances to simulate per job
+    :param chunk_rows: The number of instances to generate at a time
+    :param seed: The global seed
+    :param validate_jobs: Whether to compute the moments of the jobs as they
+        are written
+    :param pipeline_depth: The number of blocks that may be generated ahead
+        of the output in a background thread, 0 to generate and write in turn
+    :param recorder: The checkpoint.JobRecorder that consolidated_csv writes
+        through, told where every job ends, or None
+    :return: list of hash tags and factorization errors of the jobs that could
+        not be simulated, and list of hash tags and running moments of the
+        jobs simulated if validate_jobs is set
+    """
+    jobs = job_blocks(input_dists, size, chunk_rows, seed)
+    if pipeline_depth > 0:
+        jobs = pipeline.JobPipeline(jobs, pipeline_depth)
+
+    failures = []
+    job_moments = []
+    # the latency of a job includes its share of the generation of its batch
+    started = time.perf_counter()
+    for input_dist, blocks in jobs:
+        hash_tag = input_dist[0]
+        if isinstance(blocks, np.linalg.LinAlgError):
+            failures.append((hash_tag, blocks))
+            if recorder is not None:
+                recorder.end_job(hash_tag, failed=True)
+            started = time.perf_counter()
+            continue
+        moments = RunningMoments(len(header)) if validate_jobs else None
+        sim_output = None
+        if sim_path is not None:
+            sim_output = os.path.join(sim_path, hash_tag)
+        write_job(
+            header,
+            blocks,
+            sim_output,
+            consolidated_csv,
+            hash_tag,
+            input_dist[5],
+            moments,
+        )
+        if recorder is not None:
+            recorder.end_job(hash_tag)
+        if validate_jobs:
+            job_moments.append((hash_tag, moments))
+        finished = time.perf_counter()
+        metrics.observe("job", finished - started)
+        started = finished
+    return failures, job_moments
+
+
+def simulate_job(task):
+    """
+    Simulate a batch of jobs into their own output files and a part of the
+    consolidated output. This is the unit of work of the process pool.
+    :param task: tuple of header, input distributions, output directory for
+        the simulated data sets, output path for the consolidated part, size,
+        chunk rows, global seed, whether to compute the moments of the jobs,
+        the pipeline depth, the class and arguments of the writer of the
+        consolidated part (None for a CSV part), and whether to record the
+        jobs of a CSV part
+    :return: consolidated part path, the hash tags and factorization errors
+        of the jobs that could not be simulated, the hash tags and running
+        moments of the jobs simulated, the jobs recorded in the part, see
+        checkpoint.JobRecorder, or None, and the metrics of the task, see
+        metrics.Metrics.snapshot
+    """
+    (
         header,
-        int_columns,
+        input_dists,
+        sim_path,
+        part_output,
+        size,
+        chunk_rows,
+        seed,
+        validate_jobs,
+        pipeline_depth,
+        part_writer,
+        record_jobs,
+    ) = task
+    # the worker processes send the metrics of every task back
+    metrics.current.reset()
+    if part_writer is not None:
+        writer_class, writer_args = part_writer
+        with writer_class(part_output, *writer_args) as part_writer:
+            failures, job_moments = simulate_batch(
+                header,
+                input_dists,
+                sim_path,
+                part_writer,
+                size,
+                chunk_rows,
+                seed,
+                validate_jobs,
+                pipeline_depth,
+            )
+        metrics.current.dump_profile(per_process=True)
+        return (
+            part_output,
+            failures,
+            job_moments,
+            None,
+            metrics.current.snapshot(),
+        )
+    with open(part_output, "w", newline="\n") as part_file:
+        recorder = None
+        part_csv = csv.writer(part_file)
+        if record_jobs:
+            recorder = checkpoint.JobRecorder(part_file)
+            part_csv = csv.writer(recorder)
+        failures, job_moments = simulate_batch(
+            header,
+            input_dists,
+            sim_path,
+            part_csv,
+            size,
+            chunk_rows,
+            seed,
+            validate_jobs,
+            pipeline_depth,
+            recorder,
+        )
+    metrics.current.dump_profile(per_process=True)
+    return (
+        part_output,
+        failures,
+        job_moments,
+        None if recorder is None else recorder.jobs,
+        metrics.current.snapshot(),
+    )
+
+
+def job_batches(input_dists, size, d, parts=1):
+    """
+    Split the jobs into batches that are generated at once, of at most
+    BATCH_VALUES values each
+    :param input_dists: The input data distributions, a list or a lazy
+        sequence of jobs, whose slices are then the batches
+    :param size: The number of instances to simulate per job
+    :param d: The number of columns
+    :param parts: The minimum number of batches, if there are enough jobs
+    :return: list of batches of input distributions
+    """
+    batch_jobs = max(1, BATCH_VALUES // max(1, size * d))
+    batch_jobs = min(batch_jobs, max(1, -(-len(input_dists) // parts)))
+    return [
+        input_dists[i : i + batch_jobs]
+        for i in range(0, len(input_dists), batch_jobs)
+    ]
+
+
+def report_failures(failures):
+    """
+    Report the jobs that could not be simulated
+    :param failures: list of hash tags and factorization errors
+    """
+    for hash_tag, e in failures:
+        print("Failed to generate data set for " + hash_tag + ".", e)
+
+
+def simulate_jobs(
+    header,
+    input_dists,
+    sim_path,
+    consolidated_file,
+    size,
+    chunk_rows,
+    seed,
+    workers,
+    validate_jobs=False,
+    pipeline_depth=0,
+    progress=None,
+):
+    """
+    Simulate the jobs in a process pool. Every batch of jobs writes its
+    consolidated rows to a part file, and the parts are appended to the
+    consolidated output in the original distribution order.
+    :param header: The file header
+    :param input_dists: The input data distributions, a list or a lazy
+        sequence of jobs whose batches are then generated in the workers
+    :param sim_path: The output directory for the simulated data sets, None
+        to only write the consolidated output
+    :param consolidated_file: The consolidated output file, or the
+        columnar.ColumnarWriter or shards.ShardedWriter of the consolidated
+        output
+    :param size: The number of instances to simulate per job
+    :param chunk_rows: The number of instances to generate at a time
+    :param seed: The global seed
+    :param workers: The number of worker processes
+    :param validate_jobs: Whether to compute the moments of the jobs as they
+        are written
+    :param pipeline_depth: The number of blocks that every worker may
+        generate ahead of its output, 0 to generate and write in turn
+    :param progress: The checkpoint.Checkpoint to record the jobs of every
+        part in once it is appended to a CSV consolidated output, or None
+    :return: list of hash tags and factorization errors of the jobs that could
+        not be simulated, and list of hash tags and running moments of the
+        jobs simulated if validate_jobs is set
+    """
+    part_writer = None
+    if hasattr(consolidated_file, "append_part"):
+        part_writer = (type(consolidated_file), consolidated_file.part_args())
+        output_path = consolidated_file.path
+    else:
+        output_path = consolidated_file.name
+    parts_dir = tempfile.mkdtemp(
+        dir=os.path.dirname(os.path.abspath(output_path))
+    )
+    try:
+        # several batches per worker to balance the load
+        batches = job_batches(input_dists, size, len(header), 4 * workers)
+        tasks = [
+            (
+                header,
+                batch,
+                sim_path,
+                os.path.join(parts_dir, str(i)),
+                size,
+                chunk_rows,
+                seed,
+                validate_jobs,
+                pipeline_depth,
+                part_writer,
+                progress is not None,
+            )
+            for i, batch in enumerate(batches)
+        ]
+        all_failures = []
+        all_moments = []
+        with multiprocessing.Pool(workers) as pool:
+            for (
+                part_output,
+                failures,
+                job_moments,
+                jobs,
+                task_metrics,
+            ) in pool.imap(simulate_job, tasks):
+                metrics.current.merge(task_metrics)
+                report_failures(failures)
+                if part_writer is not None:
+                    consolidated_file.append_part(part_output)
+                else:
+                    with open(part_output, newline="\n") as part_file:
+                        shutil.copyfileobj(part_file, consolidated_file)
+                    os.remove(part_output)
+                if progress is not None:
+                    progress.add(jobs, progress.end)
+                    progress.commit(consolidated_file)
+                all_failures += failures
+                all_moments += job_moments
+        return all_failures, all_moments
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+
+class DatasetSimulator:
+    """
+    Simulate jobs in memory from a set of distributions, which are loaded
+    once. Every job draws from the same random stream as in simulate.py with
+    the same seed, and the values returned are those written to the CSV
+    files.
+    :param dist_path: The distribution directory
+    :param distributions: The distributions to simulate from, instead of
+        loading them from dist_path
+    :param seed: The global seed, drawn at random if None
+    """
+
+    def __init__(self, dist_path=None, distributions=None, seed=None):
+        if distributions is None:
+            distributions = distribution_store.load(dist_path)
+        self.distributions = distributions
+        self.header = list(distributions.header)
+        self.seed = random_streams.new_seed() if seed is None else seed
+        self.positions = {
+            str(hash_tag): i
+            for i, hash_tag in enumerate(distributions.hash_tags)
+        }
+        # hash tags and factorization errors of the jobs that could not be
+        # simulated by the last call
+        self.failures = []
+
+    def jobs(self, hash_tags=None):
+        """
+        Get the distributions of jobs
+        :param hash_tags: The hash tags of the jobs, None for all jobs
+        :return: list of job distributions
+        """
+        if hash_tags is None:
+            return list(self.distributions.jobs())
+        return [
+            self.distributions.job(self.positions[str(hash_tag)])
+            for hash_tag in hash_tags
+        ]
+
+    def generate(self, hash_tags=None, rows=1000, chunk_rows=None):
+        """
+        Simulate jobs
+        :param hash_tags: The hash tags of the jobs to simulate, None for all
+            jobs
+        :param rows: The number of instances to simulate per job
+        :param chunk_rows: The number of instances to generate at a time, see
+            the --chunk-rows option of simulate.py
+        :return: hash tag of each instance, shape [N], and values of each
+            instance, shape [N, d]
+        """
+        tags = []
+        values = []
+        for hash_tag, block in self.iter_blocks(hash_tags, rows, chunk_rows):
+            tags.append(np.full(block.shape[0], hash_tag))
+            values.append(block)
+        if len(values) == 0:
+            return np.empty(0, dtype=np.str_), np.empty((0, len(self.header)))
+        return np.concatenate(tags), np.concatenate(values)
+
+    def iter_batches(
+        self, batch_rows, hash_tags=None, rows=1000, chunk_rows=None
+    ):
+        """
+        Simulate jobs in batches of instances, which hold the instances of
+        generate() in the same order
+        :param batch_rows: The number of instances per batch, the last batch
+            may be smaller
+        :param hash_tags: The hash tags of the jobs to simulate, None for all
+            jobs
+        :param rows: The number of instances to simulate per job
+        :param chunk_rows: The number of instances to generate at a time
+        :return: iterator over batches of hash tags, shape [batch_rows], and
+            values, shape [batch_rows, d]
+        """
+        tags = []
+        values = []
+        pending = 0
+        for hash_tag, block in self.iter_blocks(hash_tags, rows, chunk_rows):
+            tags.append(np.full(block.shape[0], hash_tag))
+            values.append(block)
+            pending += block.shape[0]
+            if pending < batch_rows:
+                continue
+            tags = np.concatenate(tags)
+            values = np.concatenate(values)
+            full = pending - pending % batch_rows
+            for start in range(0, full, batch_rows):
+                yield (
+                    tags[start : start + batch_rows],
+                    values[start : start + batch_rows],
+                )
+            tags = [tags[full:]]
+            values = [values[full:]]
+            pending -= full
+        if pending > 0:
+            yield np.concatenate(tags), np.concatenate(values)
+
+    def iter_blocks(self, hash_tags=None, rows=1000, chunk_rows=None):
+        """
+        Simulate jobs, one block of instances at a time
+        :param hash_tags: The hash tags of the jobs to simulate, None for all
+            jobs
+        :param rows: The number of instances to simulate per job
+        :param chunk_rows: The number of instances to generate at a time
+        :return: iterator over hash tags and values of the blocks
+        """
+        self.failures = []
+        jobs = job_blocks(self.jobs(hash_tags), rows, chunk_rows, self.seed)
+        for job, blocks in jobs:
+            if isinstance(blocks, np.linalg.LinAlgError):
+                self.failures.append((job[0], blocks))
+                continue
+            for block in blocks:
+                yield job[0], written_values(block, job[5])
+
+
+def open_consolidated(
+    path,
+    header,
+    int_mask,
+    hash_tags,
+    file_format="csv",
+    shard_count=1,
+    routing="hash",
+    max_shard_bytes=None,
+):
+    """
+    Open the consolidated output, sharded if there are several shards or a
+    maximum shard file size
+    :param path: The consolidated output path
+    :param header: The file header, without HT1
+    :param int_mask: Which columns are integer columns
+    :param hash_tags: The hash tags of the jobs, in order, or None if they
+        are integers that are stored as such in a columnar output
+    :param file_format: "csv" or "columnar"
+    :param shard_count: The number of shards
+    :param routing: How the jobs are routed to the shards, see
+        shards.ShardedWriter
+    :param max_shard_bytes: The size at which a new shard file is started
+    :return: the consolidated output file, or its columnar.ColumnarWriter or
+        shards.ShardedWriter, and the writer of its rows, which is a
+        csv.writer only for a plain CSV file that still needs its header
+    """
+    if shard_count > 1 or max_shard_bytes is not None:
+        consolidated_file = shards.ShardedWriter(
+            path,
+            header,
+            int_mask,
+            hash_tags,
+            shard_count,
+            routing,
+            max_shard_bytes,
+            file_format,
+        )
+        return consolidated_file, consolidated_file
+    if file_format == "columnar":
+        consolidated_file = columnar.ColumnarWriter(
+            path, header, int_mask, hash_tags
+        )
+        return consolidated_file, consolidated_file
+    consolidated_file = open(path, "w", newline="\n")
+    return consolidated_file, csv.writer(consolidated_file)
+
+
+def report_saturated(consolidated_file):
+    """
+    Report the values clipped to the int64 range in a columnar output
+    :param consolidated_file: The columnar.ColumnarWriter or
+        shards.ShardedWriter of the consolidated output
+    """
+    for name, count in consolidated_file.saturated.items():
+        if count > 0:
+            print(
+                "Clipped " + str(count) + " values of " + name + " to "
+                "the int64 range in the columnar output."
+            )
+
+
+def parse_args():
+    """
+    Parse the command line arguments
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        usage="simulate.py <distribution-dir> <datagen-dir> "
+        "<consolidated_output> <size-per-query> [options]"
+    )
+    parser.add_argument("dist_path", metavar="distribution-dir")
+    parser.add_argument("sim_path", metavar="datagen-dir")
+    parser.add_argument(
+        "consolidated_output_path", metavar="consolidated_output"
+    )
+    parser.add_argument("size_per_query", metavar="size-per-query", type=int)
+    parser.add_argument(
+        "--chunk-rows",
+        type=int,
+        default=None,
+        help="generate and write each job in blocks of this many instances",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes to simulate the jobs with",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="global seed from which the random stream of every job is "
+        "derived, drawn at random if not given",
+    )
+    parser.add_argument(
+        "--seed-manifest",
+        default=None,
+        help="path of the seed manifest, defaults to the consolidated "
+        "output path with a .seeds.json suffix",
+    )
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="validate the jobs against their distributions while they are "
+        "simulated, instead of reading the output back with validate.py",
+    )
+    parser.add_argument(
+        "--kl-table",
+        default=None,
+        help="write the KL-divergence of every job to this path, see the "
+        "--table option of validate.py, implies --validate",
+    )
+    parser.add_argument(
+        "--no-job-files",
+        action="store_true",
+        help="only write the consolidated output, not a file per job",
+    )
+    parser.add_argument(
+        "--pipeline-depth",
+        type=int,
+        default=0,
+        help="generate the jobs in a background thread, at most this many "
+        "blocks ahead of the output",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["csv", "columnar"],
+        default="csv",
+        help="format of the consolidated output, columnar writes a directory "
+        "with one binary file per column, see columnar.py",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="split the consolidated output into this many shards, written "
+        "to a directory with a shards.json manifest, see shards.py",
+    )
+    parser.add_argument(
+        "--max-shard-bytes",
+        type=int,
+        default=None,
+        help="start a new file of a shard once it reaches this size, implies "
+        "a sharded output",
     )
+    parser.add_argument(
+        "--shard-by",
+        choices=["hash", "round-robin"],
+        default="hash",
+        help="route every job to a shard by the hash of its HT1, or in turn",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="record the completed jobs in a progress manifest next to the "
+        "consolidated output, and resume the run it records if there is one",
+    )
+    parser.add_argument(
+        "--hash-tags",
+        default=None,
+        help="only simulate the jobs with these comma separated HT1, read "
+        "through the index of distributions.csv",
+    )
+    parser.add_argument(
+        "--hash-tag-file",
+        default=None,
+        help="only simulate the jobs whose HT1 are listed in this file, one "
+        "per line",
+    )
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    if args.chunk_rows is not None and args.chunk_rows < 1:
+        parser.error("--chunk-rows must be positive")
+    if args.workers < 1:
+        parser.error("--workers must be positive")
+    if args.pipeline_depth < 0:
+        parser.error("--pipeline-depth must not be negative")
+    if args.shards < 1:
+        parser.error("--shards must be positive")
+    if args.max_shard_bytes is not None and args.max_shard_bytes < 1:
+        parser.error("--max-shard-bytes must be positive")
+    if args.kl_table is not None:
+        args.validate = True
+    if args.resume:
+        if args.format != "csv" or args.shards > 1 or args.max_shard_bytes:
+            parser.error("--resume needs a single CSV consolidated output")
+        if args.validate:
+            parser.error(
+                "--resume cannot be combined with --validate, validate the "
+                "output with validate.py"
+            )
+        progress = checkpoint.progress_path(args.consolidated_output_path)
+        if args.seed is None and os.path.isfile(progress):
+            # resume with the seed drawn by the interrupted run
+            args.seed = checkpoint.read_manifest(progress)["settings"]["seed"]
+    if args.seed is None:
+        args.seed = random_streams.new_seed()
+    if args.seed_manifest is None:
+        args.seed_manifest = args.consolidated_output_path + ".seeds.json"
+    args.hash_tags = distribution_store.read_hash_tags(
+        args.hash_tags, args.hash_tag_file
+    )
+    return args
 
 
 def main():
     """
     Main method
     """
-    # check inputs
-    if len(sys.argv) < 4:
-        print(
-            "Usage: simulate.py <distribution-dir> <datagen-dir> <consolidated_output> <size-per-query>"
-        )
-        sys.exit(1)
+    args = parse_args()
+    metrics.configure(args)
 
     # command line args
-    dist_path = sys.argv[1]
-    sim_path = sys.argv[2]
-    consolidated_output_path = sys.argv[3]
-    size_per_query = int(sys.argv[4])
+    dist_path = args.dist_path
+    sim_path = args.sim_path
+    consolidated_output_path = args.consolidated_output_path
+    size_per_query = args.size_per_query
 
-    if not os.path.exists(sim_path):
+    if args.no_job_files:
+        sim_path = None
+    elif not os.path.exists(sim_path):
         os.mkdir(sim_path)
 
-    first = True
+    # load the distributions, from the binary store if there is one, or only
+    # the selected ones through the index
+    with metrics.stage("load"):
+        if args.hash_tags is None:
+            distributions = distribution_store.load(dist_path)
+        else:
+            distributions, missing = distribution_store.select(
+                dist_path, args.hash_tags
+            )
+            for hash_tag in missing:
+                print("Unknown HT1 " + hash_tag + ".")
+        header = list(distributions.header)
+        input_dists = list(distributions.jobs())
+    metrics.count("jobs", len(input_dists))
 
     # run the generator
-    with open(os.path.join(dist_path, "distributions.csv")) as dist_file, open(
-        os.path.join(dist_path, "header.csv")
-    ) as header_file, open(
-        consolidated_output_path, "w", newline="\n"
-    ) as consolidated_file:
-        dist_csv = csv.reader(dist_file, delimiter=",")
-        header_csv = csv.reader(header_file, delimiter=",")
-        header = None
-        for line in header_csv:
-            header = line
-            break
-
-        consolidated_csv = csv.writer(consolidated_file)
-
-        success_count = 0
-        for input_dist in dist_csv:
-
-            if len(input_dist) == 0:
-                continue
+    progress = None
+    recorder = None
+    if args.resume:
+        progress = checkpoint.Checkpoint(
+            checkpoint.progress_path(consolidated_output_path),
+            {
+                "distributions": os.path.abspath(dist_path),
+                "hash_tags": args.hash_tags,
+                "size_per_query": size_per_query,
+                "chunk_rows": args.chunk_rows,
+                "seed": args.seed,
+            },
+        )
+        done = progress.done()
+        skipped = len(done)
+        input_dists = [job for job in input_dists if job[0] not in done]
+        consolidated_file = progress.open_output(
+            consolidated_output_path, ["HT1"] + header
+        )
+        recorder = checkpoint.JobRecorder(
+            consolidated_file, progress.end, progress
+        )
+        consolidated_csv = csv.writer(recorder)
+        if skipped > 0:
+            print(
+                "Skipping " + str(skipped) + " jobs completed by the "
+                "interrupted run."
+            )
+    else:
+        int_mask = np.asarray(distributions.int_mask).all(axis=0)
+        consolidated_file, consolidated_csv = open_consolidated(
+            consolidated_output_path,
+            header,
+            int_mask,
+            distributions.hash_tags.tolist(),
+            args.format,
+            args.shards,
+            args.shard_by,
+            args.max_shard_bytes,
+        )
+        if len(input_dists) > 0 and consolidated_csv is not consolidated_file:
+            h = header.copy()
+            h.insert(0, "HT1")
+            consolidated_csv.writerow(h)
+    with consolidated_file:
 
-            sim_output = os.path.join(sim_path, input_dist[0])
-            try:
-                generate(
-                    header,
-                    input_dist,
-                    sim_output,
-                    consolidated_csv,
-                    input_dist[0],
-                    first,
-                    size_per_query,
-                )
-                success_count += 1
-            except np.linalg.LinAlgError as e:
-                print(
-                    "Failed to generate data set for " + input_dist[0] + ".", e
-                )
-            first = False
+        if args.workers > 1:
+            consolidated_file.flush()
+            failures, job_moments = simulate_jobs(
+                header,
+                input_dists,
+                sim_path,
+                consolidated_file,
+                size_per_query,
+                args.chunk_rows,
+                args.seed,
+                args.workers,
+                args.validate,
+                args.pipeline_depth,
+                progress,
+            )
+        else:
+            # the jobs are generated in batches of at most BATCH_VALUES values
+            failures, job_moments = simulate_batch(
+                header,
+                input_dists,
+                sim_path,
+                consolidated_csv,
+                size_per_query,
+                args.chunk_rows,
+                args.seed,
+                args.validate,
+                args.pipeline_depth,
+                recorder,
+            )
+            report_failures(failures)
+        success_count = len(input_dists) - len(failures)
+        metrics.count("failed_factorizations", len(failures))
+        failed = [hash_tag for hash_tag, _ in failures]
+        if progress is not None:
+            progress.commit(consolidated_file, force=True)
+            failed = progress.failed()
+
+        # record the seed, from which every job can be regenerated
+        random_streams.write_manifest(
+            args.seed_manifest,
+            args.seed,
+            os.path.abspath(dist_path),
+            size_per_query,
+            args.chunk_rows,
+            distributions.hash_tags.tolist(),
+            failed,
+        )
 
         print("\nSuccessfully simulated " + str(success_count) + " jobs.\n")
 
+    if args.format == "columnar":
+        report_saturated(consolidated_file)
+    metrics.count(
+        "bytes_written", metrics.path_bytes(consolidated_output_path)
+    )
+    if sim_path is not None:
+        metrics.count("bytes_written", metrics.path_bytes(sim_path))
+
+    if args.validate:
+        with metrics.stage("validate"):
+            validate_moments(distributions, job_moments, args.kl_table)
+    metrics.finish(args, "simulate_dataset.py")
+
+
+def validate_moments(distributions, job_moments, table_path=None):
+    """
+    Validate the simulated jobs from the moments of the instances written,
+    and report the KL-divergences like validate.py
+    :param distributions: The distributions the jobs were simulated from
+    :param job_moments: list of hash tags and running moments of the jobs
+    :param table_path: The path of the per-job table, None to not write it
+    :return: The number of jobs validated
+    """
+    positions = {
+        str(hash_tag): i for i, hash_tag in enumerate(distributions.hash_tags)
+    }
+    hash_tags = [hash_tag for hash_tag, _ in job_moments]
+    kl, errors = validate.validate_jobs(
+        distributions,
+        [positions[hash_tag] for hash_tag in hash_tags],
+        [moments.mean for _, moments in job_moments],
+        [moments.covariance() for _, moments in job_moments],
+    )
+    return validate.report(
+        hash_tags,
+        [moments.count for _, moments in job_moments],
+        kl,
+        errors,
+        table_path,
+    )
+
 
-main()
+if __name__ == "__main__":
+    main()
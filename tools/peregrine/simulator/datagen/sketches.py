@@ -0,0 +1,256 @@
+"""Module for bounded-memory summaries of data streams.
+"""
+import hashlib
+import heapq
+import numpy as np
+
+
+def hash64(key, salt=0):
+    """
+    Hash a key to a 64 bit integer that is stable across processes and runs
+    :param key: The key to hash
+    :param salt: Salt to derive independent hash functions from
+    :return: 64 bit hash value
+    """
+    digest = hashlib.blake2b(
+        str(key).encode(), digest_size=8, salt=salt.to_bytes(16, "little")
+    ).digest()
+    return int.from_bytes(digest, "little")
+
+
+class MisraGries:
+    """
+    Frequent items sketch (Misra-Gries). Every key occurring more than
+    N / (capacity + 1) times in a stream of N keys is kept, and the count kept
+    for a key underestimates its frequency by at most N / (capacity + 1).
+    :param capacity: The number of counters to keep
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+
+    def update(self, key):
+        """
+        Add a key to the sketch
+        :param key: The key
+        """
+        if key in self.counts:
+            self.counts[key] += 1
+            return
+        self.counts[key] = 1
+        if len(self.counts) > 2 * self.capacity:
+            # decrement all counters by the (capacity + 1)-th largest count
+            # at once, which drops all but at most capacity keys
+            counts = sorted(self.counts.values(), reverse=True)
+            decrement = counts[self.capacity]
+            self.counts = {
+                k: c - decrement
+                for k, c in self.counts.items()
+                if c > decrement
+            }
+
+    def keys(self):
+        """
+        Get the keys kept in the sketch
+        :return: list of keys
+        """
+        return list(self.counts)
+
+
+class HashRangeCounter:
+    """
+    Exact counts of the distinct keys of a stream whose salted hash value lies
+    in [low, high). The upper bound starts at 2^64 and is lowered whenever more
+    than size keys are tracked, evicting the keys with the largest hash
+    values. A key whose hash is below the final upper bound was tracked from
+    its first occurrence, so all its counts are exact. Since the hash values
+    are random, the tracked keys are a uniform sample of the distinct keys.
+    :param size: The maximum number of keys to track
+    :param low: The lower bound of the hash range
+    :param salt: The salt of the hash function, which seeds the sample
+    """
+
+    def __init__(self, size, low=0, salt=0):
+        self.size = size
+        self.low = low
+        self.high = 2 ** 64
+        self.salt = salt
+        self.heap = []
+        self.counts = {}
+
+    def update(self, key):
+        """
+        Add a key to the counter
+        :param key: The key
+        """
+        if key in self.counts:
+            self.counts[key] += 1
+            return
+        value = hash64(key, self.salt)
+        if value < self.low or value >= self.high:
+            return
+        heapq.heappush(self.heap, (-value, key))
+        self.counts[key] = 1
+        if len(self.counts) > self.size:
+            value, evicted = heapq.heappop(self.heap)
+            del self.counts[evicted]
+            self.high = -value
+
+
+class QuantileSketch:
+    """
+    Quantile sketch of every column of a stream of instances, with relative
+    accuracy (DDSketch, https://arxiv.org/abs/1908.10693). The values of
+    each column are counted in logarithmic bins, separately for positive and
+    negative values, so every quantile is estimated within the relative
+    accuracy, and two sketches of the same accuracy are merged by adding
+    their bins. Values closer to zero than min_value are counted as zero, and
+    the bins of the values closest to zero are folded together if more than
+    max_bins are in use, so the memory does not depend on the number of
+    instances.
+    :param d: The dimension of each instance
+    :param relative_accuracy: The relative accuracy of the quantiles
+    :param max_bins: The maximum number of bins per column and sign
+    :param min_value: The smallest absolute value that is not counted as zero
+    """
+
+    def __init__(
+        self, d, relative_accuracy=0.01, max_bins=4096, min_value=1e-9
+    ):
+        self.d = d
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.max_bins = max_bins
+        self.min_value = min_value
+        self.count = 0
+        self.zeros = np.zeros(d, dtype=np.int64)
+        # offset and counts of the bins of every column, by sign
+        self.bins = {
+            sign: [(0, np.zeros(0, dtype=np.int64)) for _ in range(d)]
+            for sign in [1, -1]
+        }
+
+    def update_block(self, block):
+        """
+        Add a block of instances
+        :param block: The instances, one per row
+        """
+        block = np.asarray(block, dtype=np.float64).reshape(-1, self.d)
+        if block.shape[0] == 0:
+            return
+        self.count += block.shape[0]
+        magnitude = np.abs(block)
+        nonzero = magnitude >= self.min_value
+        self.zeros += np.count_nonzero(~nonzero, axis=0)
+        with np.errstate(divide="ignore"):
+            index = np.ceil(np.log(magnitude) / self.log_gamma)
+        for sign in [1, -1]:
+            selected = nonzero & (block > 0 if sign > 0 else block < 0)
+            for j in range(self.d):
+                column = index[selected[:, j], j].astype(np.int64)
+                if column.size == 0:
+                    continue
+                low = column.min()
+                self.add_bins(sign, j, low, np.bincount(column - low))
+
+    def add_bins(self, sign, j, offset, counts):
+        """
+        Add counts to the bins of a column
+        :param sign: 1 for the positive values, -1 for the negative values
+        :param j: The column
+        :param offset: The index of the first bin of the counts
+        :param counts: The counts of consecutive bins
+        """
+        old_offset, old_counts = self.bins[sign][j]
+        if old_counts.size > 0:
+            low = min(old_offset, offset)
+            high = max(old_offset + old_counts.size, offset + counts.size)
+            merged = np.zeros(high - low, dtype=np.int64)
+            merged[
+                old_offset - low : old_offset - low + old_counts.size
+            ] += old_counts
+            merged[offset - low : offset - low + counts.size] += counts
+            offset, counts = low, merged
+        if counts.size > self.max_bins:
+            # fold the bins of the values closest to zero
+            folded = counts.size - self.max_bins
+            head = counts[:folded].sum()
+            counts = counts[folded:].copy()
+            counts[0] += head
+            offset += folded
+        self.bins[sign][j] = (offset, counts)
+
+    def merge(self, other):
+        """
+        Add the instances of another sketch with the same accuracy
+        :param other: The other sketch
+        """
+        self.count += other.count
+        self.zeros += other.zeros
+        for sign in [1, -1]:
+            for j in range(self.d):
+                offset, counts = other.bins[sign][j]
+                if counts.size > 0:
+                    self.add_bins(sign, j, offset, counts)
+
+    def bins_of(self, j):
+        """
+        Get the bounds and counts of the non-empty bins of a column. A bin
+        of positive values holds the values in (lower, upper], a bin of
+        negative values those in [lower, upper), and the zero bin is [0, 0].
+        :param j: The column
+        :return: ascending lower bounds, upper bounds and counts
+        """
+        lower, upper, counts = [], [], []
+        for sign in [-1, 1]:
+            offset, bin_counts = self.bins[sign][j]
+            index = np.flatnonzero(bin_counts)
+            if sign < 0:
+                index = index[::-1]
+            outer = self.gamma ** (offset + index).astype(np.float64)
+            inner = outer / self.gamma
+            lower.append(inner if sign > 0 else -outer)
+            upper.append(outer if sign > 0 else -inner)
+            counts.append(bin_counts[index])
+            if sign < 0 and self.zeros[j] > 0:
+                lower.append(np.zeros(1))
+                upper.append(np.zeros(1))
+                counts.append(self.zeros[j : j + 1])
+        return (
+            np.concatenate(lower),
+            np.concatenate(upper),
+            np.concatenate(counts),
+        )
+
+    def quantiles(self, j, q):
+        """
+        Estimate quantiles of a column, interpolating within the bins
+        :param j: The column
+        :param q: The quantiles, between 0 and 1
+        :return: estimated values, NaN if the sketch is empty
+        """
+        q = np.asarray(q, dtype=np.float64)
+        if self.count == 0:
+            return np.full(q.shape, np.nan)
+        return bin_quantiles(*self.bins_of(j), q)
+
+
+def bin_quantiles(lower, upper, counts, q):
+    """
+    Estimate quantiles from the non-empty bins of a column, interpolating
+    within the bins, see QuantileSketch.bins_of
+    :param lower: The ascending lower bounds of the bins
+    :param upper: The upper bounds of the bins
+    :param counts: The counts of the bins
+    :param q: The quantiles, between 0 and 1
+    :return: estimated values
+    """
+    cumulative = np.cumsum(counts)
+    ranks = np.asarray(q, dtype=np.float64) * cumulative[-1]
+    k = np.minimum(
+        np.searchsorted(cumulative, ranks, side="left"), counts.size - 1
+    )
+    fraction = (ranks - (cumulative[k] - counts[k])) / counts[k]
+    return lower[k] + np.clip(fraction, 0, 1) * (upper[k] - lower[k])
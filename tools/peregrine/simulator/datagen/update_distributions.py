@@ -0,0 +1,430 @@
+"""Module for folding new data into extracted distributions.
+
+extract_inputs.py stores the count, mean, co-moment matrix and column
+minimums and maximums of every job next to distributions.csv
+(distribution_store.write_moments). The moments of the union of two sets of
+instances follow from the moments of each set, so another slice of AutoToken
+input, or another distribution directory extracted with the same schema, can
+be folded into a distribution directory without reading the earlier inputs
+again. Only the jobs whose moments changed get a new covariance and new
+dependent columns; the rows of the other jobs are copied from
+distributions.csv as they are.
+"""
+
+import argparse
+import ast
+import csv
+import os
+import numpy as np
+import distribution_store
+import extract_inputs
+import ingest
+from moments import merge_moments, pin_constant_columns
+
+
+class JobUpdates:
+    """
+    Moments of jobs to fold into a distribution directory
+    :param header: The names of the attributes
+    :param hash_tags: The hash tags of the jobs, shape [G]
+    :param counts: The number of instances of each job, shape [G]
+    :param means: The mean vectors, shape [G, d]
+    :param comoments: The co-moment matrices, shape [G, d, d]
+    :param minimums: The minimum of every column, shape [G, d]
+    :param maximums: The maximum of every column, shape [G, d]
+    :param int_columns: The integer columns of each job, for the jobs that
+        are new to the distribution directory
+    """
+
+    def __init__(
+        self,
+        header,
+        hash_tags,
+        counts,
+        means,
+        comoments,
+        minimums,
+        maximums,
+        int_columns,
+    ):
+        self.header = list(header)
+        self.hash_tags = [str(hash_tag) for hash_tag in hash_tags]
+        self.counts = np.asarray(counts, dtype=np.int64).reshape(-1)
+        d = len(self.header)
+        self.means = np.asarray(means, dtype=np.float64).reshape(-1, d)
+        self.comoments = np.asarray(comoments, dtype=np.float64).reshape(
+            -1, d, d
+        )
+        self.minimums = np.asarray(minimums, dtype=np.float64).reshape(-1, d)
+        self.maximums = np.asarray(maximums, dtype=np.float64).reshape(-1, d)
+        self.int_columns = int_columns
+
+
+def read_rows(dist_path):
+    """
+    Read the rows of distributions.csv without parsing the distributions
+    :param dist_path: The distribution directory
+    :return: list of rows, as lists of strings
+    """
+    with open(os.path.join(dist_path, "distributions.csv")) as dist_file:
+        return [
+            row for row in csv.reader(dist_file, delimiter=",") if len(row) > 0
+        ]
+
+
+def read_moments(dist_path):
+    """
+    Read the moments of a distribution directory, checking that they describe
+    its distributions.csv
+    :param dist_path: The distribution directory
+    :return: header, hash tags, counts, mean vectors, co-moment matrices, and
+        column minimums and maximums
+    """
+    if not distribution_store.has_moments(dist_path):
+        raise ValueError(
+            dist_path + " has no moments that are up to date with its "
+            "distributions.csv, extract it again with extract_inputs.py"
+        )
+    return distribution_store.read_moments(dist_path)
+
+
+def distribution_updates(dist_path):
+    """
+    Get the moments of the jobs of another distribution directory
+    :param dist_path: The distribution directory
+    :return: JobUpdates
+    """
+    moments = read_moments(dist_path)
+    int_columns = [ast.literal_eval(row[5]) for row in read_rows(dist_path)]
+    return JobUpdates(*moments, int_columns)
+
+
+def input_updates(input_file, selected=None, workers=1):
+    """
+    Get the moments of the jobs of a slice of AutoToken input, grouped by HT1
+    :param input_file: The AutoToken input
+    :param selected: The hash tags of the jobs to consider, None for all jobs
+    :param workers: The number of processes parsing the input
+    :return: JobUpdates
+    """
+    if workers > 1:
+        header, group_moments, group_hash_tag = (
+            ingest.accumulate_groups_parallel(
+                input_file,
+                extract_inputs.HASH_TAG,
+                extract_inputs.HASH_TAG,
+                extract_inputs.COLUMNS,
+                extract_inputs.INT_COLUMNS,
+                workers,
+                selected=selected,
+            )
+        )
+        hash_tags, moments = extract_inputs.select_groups(
+            group_moments, group_hash_tag, None, 1
+        )
+    else:
+        header, hash_tags, moments = extract_inputs.accumulate_groups(
+            input_file,
+            extract_inputs.HASH_TAG,
+            extract_inputs.HASH_TAG,
+            extract_inputs.COLUMNS,
+            extract_inputs.INT_COLUMNS,
+            max_groups=None,
+            support_threshold=1,
+            selected=selected,
+        )
+    int_columns = extract_inputs.shift_columns(
+        extract_inputs.COLUMNS, extract_inputs.INT_COLUMNS
+    )
+    return JobUpdates(
+        header,
+        hash_tags,
+        [m.count for m in moments],
+        [m.mean for m in moments],
+        [m.comoment for m in moments],
+        [m.minimum for m in moments],
+        [m.maximum for m in moments],
+        [int_columns] * len(hash_tags),
+    )
+
+
+def update(
+    dist_path,
+    updates,
+    output_path=None,
+    support_threshold=2,
+    existing_only=False,
+    binary=False,
+):
+    """
+    Fold moments into a distribution directory. The jobs of the directory are
+    merged with the updates of the same HT1, and the other updated jobs with
+    enough support are added after them.
+    :param dist_path: The distribution directory
+    :param updates: The JobUpdates to fold in
+    :param output_path: The directory of the updated distributions, None to
+        update the distribution directory in place
+    :param support_threshold: The minimum number of instances of a new job
+    :param existing_only: Whether to only update the jobs of the directory
+    :param binary: Whether to also store the updated distributions in the
+        binary format, which is also done if the directory has a binary store
+    :return: The number of updated jobs and the number of new jobs
+    """
+    if output_path is None:
+        output_path = dist_path
+    (
+        header,
+        hash_tags,
+        counts,
+        means,
+        comoments,
+        minimums,
+        maximums,
+    ) = read_moments(dist_path)
+    if list(updates.header) != list(header):
+        raise ValueError(
+            "The updates do not have the attributes of " + dist_path
+        )
+    rows = read_rows(dist_path)
+    # the binary store is patched rather than converted again
+    store = None
+    if distribution_store.has_store(dist_path):
+        store = distribution_store.read_store(dist_path, mmap_mode=None)
+    positions = {str(hash_tag): i for i, hash_tag in enumerate(hash_tags)}
+
+    # merge the jobs of the directory with their updates
+    new = np.array(
+        [i for i, h in enumerate(updates.hash_tags) if h in positions],
+        dtype=int,
+    )
+    old = np.array([positions[updates.hash_tags[i]] for i in new], dtype=int)
+    counts = counts.copy()
+    means = means.copy()
+    comoments = comoments.copy()
+    counts[old], means[old], comoments[old] = merge_moments(
+        counts[old],
+        means[old],
+        comoments[old],
+        updates.counts[new],
+        updates.means[new],
+        updates.comoments[new],
+    )
+    minimums = minimums.copy()
+    maximums = maximums.copy()
+    minimums[old] = np.minimum(minimums[old], updates.minimums[new])
+    maximums[old] = np.maximum(maximums[old], updates.maximums[new])
+
+    # append the new jobs
+    added = []
+    if not existing_only:
+        added = [
+            i
+            for i, hash_tag in enumerate(updates.hash_tags)
+            if hash_tag not in positions
+            and updates.counts[i] >= support_threshold
+        ]
+    hash_tags = [str(hash_tag) for hash_tag in hash_tags]
+    hash_tags += [updates.hash_tags[i] for i in added]
+    counts = np.concatenate([counts, updates.counts[added]])
+    means = np.concatenate([means, updates.means[added]])
+    comoments = np.concatenate([comoments, updates.comoments[added]])
+    minimums = np.concatenate([minimums, updates.minimums[added]])
+    maximums = np.concatenate([maximums, updates.maximums[added]])
+    # the merged moments of the constant columns are exact, as in extraction
+    pin_constant_columns(means, comoments, minimums, maximums)
+    int_columns = [None] * len(rows)
+    int_columns += [updates.int_columns[i] for i in added]
+
+    # only the changed jobs get new distributions
+    changed = np.concatenate(
+        [np.sort(old), np.arange(len(rows), len(hash_tags))]
+    ).astype(int)
+    covars, stds = extract_inputs.moment_distributions(
+        counts[changed], comoments[changed]
+    )
+    dep_cols = extract_inputs.get_dependent_columns_batch(covars)
+    for n, i in enumerate(changed):
+        if int_columns[i] is None:
+            int_columns[i] = ast.literal_eval(rows[i][5])
+        job_row = [
+            hash_tags[i],
+            means[i].tolist(),
+            stds[n].tolist(),
+            covars[n].tolist(),
+            dep_cols[n],
+            list(int_columns[i]),
+        ]
+        if i < len(rows):
+            rows[i] = job_row
+        else:
+            rows.append(job_row)
+
+    if not os.path.exists(output_path):
+        os.mkdir(output_path)
+    dist_file_path = os.path.join(output_path, "distributions.csv")
+    with open(dist_file_path + ".tmp", "w") as dist_file:
+        csv.writer(dist_file).writerows(rows)
+    os.replace(dist_file_path + ".tmp", dist_file_path)
+    if output_path != dist_path:
+        with open(os.path.join(output_path, "header.csv"), "w") as h:
+            csv.writer(h).writerow(header)
+    distribution_store.write_moments(
+        output_path,
+        header,
+        hash_tags,
+        counts,
+        means,
+        comoments,
+        minimums,
+        maximums,
+    )
+    if store is not None:
+        distribution_store.write_store(
+            output_path,
+            patch_store(store, hash_tags, changed, rows),
+        )
+    elif binary:
+        distribution_store.convert(output_path)
+    return len(old), len(added)
+
+
+def patch_store(store, hash_tags, changed, rows):
+    """
+    Update the distributions of a binary store with the changed jobs
+    :param store: The distributions of the binary store
+    :param hash_tags: The hash tags of all jobs, the new ones last
+    :param changed: The positions of the jobs that changed
+    :param rows: The rows of distributions.csv, holding the lists of the
+        changed jobs
+    :return: Distributions
+    """
+    J = len(hash_tags)
+    d = len(store.header)
+    arrays = {
+        name: np.asarray(getattr(store, name))
+        for name in distribution_store.STORE_ARRAYS
+    }
+    for name in ["mean", "std", "cov", "dep_mask", "int_mask"]:
+        array = arrays[name]
+        arrays[name] = np.zeros((J,) + array.shape[1:], dtype=array.dtype)
+        arrays[name][: len(array)] = array
+    arrays["hash_tags"] = np.array(hash_tags, dtype=np.str_)
+    for i in changed:
+        _, mean, std, cov, dep_cols, int_cols = rows[i]
+        arrays["mean"][i] = mean
+        arrays["std"][i] = std
+        arrays["cov"][i] = np.reshape(cov, (d, d))
+        arrays["dep_mask"][i] = False
+        arrays["dep_mask"][i, np.asarray(dep_cols, dtype=int)] = True
+        arrays["int_mask"][i] = False
+        arrays["int_mask"][i, np.asarray(int_cols, dtype=int)] = True
+    return distribution_store.Distributions(
+        store.header,
+        *[arrays[name] for name in distribution_store.STORE_ARRAYS]
+    )
+
+
+def parse_args():
+    """
+    Parse the command line arguments
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        usage="update_distributions.py <distribution-dir> "
+        "[--input <autotoken-input> ...] [--merge <distribution-dir> ...] "
+        "[options]"
+    )
+    parser.add_argument("dist_path", metavar="distribution-dir")
+    parser.add_argument(
+        "--input",
+        action="append",
+        default=[],
+        help="AutoToken input to fold in, grouped by HT1, can be repeated",
+    )
+    parser.add_argument(
+        "--merge",
+        action="append",
+        default=[],
+        help="distribution directory to fold in, can be repeated",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="directory of the updated distributions, the distribution "
+        "directory itself if not given",
+    )
+    parser.add_argument(
+        "--support-threshold",
+        type=int,
+        default=2,
+        help="minimum number of instances of a job that is not yet in the "
+        "distributions, for it to be added",
+    )
+    parser.add_argument(
+        "--existing-only",
+        action="store_true",
+        help="only update the jobs that are already in the distributions",
+    )
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="also store the distributions in the binary format",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="parse the inputs in byte ranges using this many processes",
+    )
+    args = parser.parse_args()
+    if not args.input and not args.merge:
+        parser.error("nothing to fold in, give --input or --merge")
+    if args.support_threshold < 2:
+        parser.error("--support-threshold must be at least 2")
+    if args.workers < 1:
+        parser.error("--workers must be positive")
+    return args
+
+
+def main():
+    """
+    Main method
+    """
+    args = parse_args()
+    dist_path = args.dist_path
+    output_path = args.output
+    sources = [("input", path) for path in args.input]
+    sources += [("merge", path) for path in args.merge]
+    for kind, path in sources:
+        selected = None
+        if args.existing_only:
+            selected = set(read_moments(dist_path)[1].tolist())
+        if kind == "input":
+            updates = input_updates(path, selected, args.workers)
+        else:
+            updates = distribution_updates(path)
+        updated, added = update(
+            dist_path,
+            updates,
+            output_path,
+            args.support_threshold,
+            args.existing_only,
+            args.binary,
+        )
+        print(
+            "Folded "
+            + path
+            + " into "
+            + str(updated)
+            + " jobs and added "
+            + str(added)
+            + " jobs."
+        )
+        # the next sources are folded into the updated distributions
+        if output_path is not None:
+            dist_path = output_path
+            output_path = None
+
+
+if __name__ == "__main__":
+    main()
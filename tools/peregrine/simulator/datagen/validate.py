@@ -1,8 +1,33 @@
+import argparse
 import csv
+import functools
+import itertools
 import os
 import sys
+import time
 import numpy as np
-import ast
+import distribution_store
+import metrics
+from moments import RunningMoments, grouped_moments
+from sketches import QuantileSketch, bin_quantiles
+
+PERCENTILES = [50, 90, 95, 99, 100]
+# number of rows parsed at a time by the streaming validation
+STREAM_ROWS = 65536
+# quantiles at which the marginal Wasserstein distance is evaluated
+MARGINAL_QUANTILES = (np.arange(200) + 0.5) / 200
+# bisection steps of the quantiles of the reference marginal distributions
+QUANTILE_ITERATIONS = 32
+# the standardized quantiles of the reference marginal distributions are
+# tabulated by FOLDED_STEP over |mean| / std, up to FOLDED_MAX beyond which
+# the values are never made absolute
+FOLDED_STEP = 1 / 64
+FOLDED_MAX = 9.0
+# reference standard deviations within this factor of the resolution of the
+# values, the spacing of the floating point numbers at the reference mean or
+# the smallest nonzero value of the sketches, are rounding noise, and their
+# columns are taken as constant
+MIN_SPREAD = 1000
 
 
 def mv_kullback_leibler_divergence(mean1, mean2, covar1, covar2, dep_columns):
@@ -15,21 +40,100 @@ def mv_kullback_leibler_divergence(mean1, mean2, covar1, covar2, dep_columns):
     :param dep_columns: The list of linearly dependent columns
     :return:
     """
-    ind_columns = []
-    for i in range(0, mean1.size):
-        if i not in dep_columns:
-            ind_columns.append(i)
-
-    mean1, covar1 = exclude_independent_columns(mean1, covar1, dep_columns)
-    mean2, covar2 = exclude_independent_columns(mean2, covar2, dep_columns)
-    return 0.5 * (
-        np.matmul(np.linalg.inv(covar2), covar1).trace()
-        + np.matmul(
-            (mean2 - mean1).T, np.matmul(np.linalg.inv(covar2), mean2 - mean1)
-        )
-        - mean1.size
-        + np.log(np.linalg.det(covar2) / np.linalg.det(covar1))
+    dep_mask = np.zeros((1, np.asarray(mean1).size), dtype=bool)
+    dep_mask[0, np.asarray(dep_columns, dtype=int)] = True
+    kl, errors = kl_divergence_batch(
+        np.asarray(mean1, dtype=np.float64)[np.newaxis],
+        np.asarray(mean2, dtype=np.float64)[np.newaxis],
+        np.asarray(covar1, dtype=np.float64)[np.newaxis],
+        np.asarray(covar2, dtype=np.float64)[np.newaxis],
+        dep_mask,
+    )
+    if errors[0] is not None:
+        raise errors[0]
+    return kl[0]
+
+
+def kl_divergence_batch(mean1, mean2, covar1, covar2, dep_mask):
+    """
+    Compute the KL-divergences of many pairs of multi-variate distributions at
+    once, each restricted to its dependent columns. Pairs with the same
+    dependent columns are stacked, and the inverses and determinants are
+    replaced by Cholesky solves and log-determinants, which do not overflow
+    for covariances of large cardinalities.
+    :param mean1: Mean vectors of the first distributions, shape [J, d]
+    :param mean2: Mean vectors of the second distributions, shape [J, d]
+    :param covar1: Covariance matrices of the first distributions,
+        shape [J, d, d]
+    :param covar2: Covariance matrices of the second distributions,
+        shape [J, d, d]
+    :param dep_mask: The linearly dependent columns of each pair, shape [J, d]
+    :return: KL-divergences, NaN for the pairs that failed, and the
+        LinAlgError of each pair that failed, None for the others
+    """
+    J = len(dep_mask)
+    kl = np.full(J, np.nan)
+    errors = [None] * J
+    if J == 0:
+        return kl, errors
+    masks, inverse = np.unique(
+        np.asarray(dep_mask, dtype=bool), axis=0, return_inverse=True
     )
+    inverse = inverse.reshape(-1)
+    for g, mask in enumerate(masks):
+        jobs = np.flatnonzero(inverse == g)
+        columns = np.flatnonzero(mask)
+        mean1_g, covar1_g = exclude_independent_columns_batch(
+            mean1[jobs], covar1[jobs], columns
+        )
+        mean2_g, covar2_g = exclude_independent_columns_batch(
+            mean2[jobs], covar2[jobs], columns
+        )
+        L1, errors1 = cholesky_batch(covar1_g)
+        L2, errors2 = cholesky_batch(covar2_g)
+        ok = np.ones(jobs.size, dtype=bool)
+        for i in range(jobs.size):
+            error = errors2[i] if errors2[i] is not None else errors1[i]
+            if error is not None:
+                errors[jobs[i]] = error
+                ok[i] = False
+        if not ok.any():
+            continue
+        L1, L2 = L1[ok], L2[ok]
+
+        # tr(covar2^-1 covar1) = |L2^-1 L1|_F^2 and
+        # (mean2 - mean1)' covar2^-1 (mean2 - mean1) = |L2^-1 (mean2 - mean1)|^2
+        trace = np.square(np.linalg.solve(L2, L1)).sum(axis=(1, 2))
+        delta = (mean2_g - mean1_g)[ok][:, :, np.newaxis]
+        mahalanobis = np.square(np.linalg.solve(L2, delta)).sum(axis=(1, 2))
+        logdet1 = 2 * np.log(np.diagonal(L1, axis1=1, axis2=2)).sum(axis=1)
+        logdet2 = 2 * np.log(np.diagonal(L2, axis1=1, axis2=2)).sum(axis=1)
+        kl[jobs[ok]] = 0.5 * (
+            trace + mahalanobis - columns.size + logdet2 - logdet1
+        )
+    return kl, errors
+
+
+def cholesky_batch(covars):
+    """
+    Factorize a stack of covariance matrices, one by one if the stacked
+    factorization fails, to find the matrices that are not positive definite
+    :param covars: The covariance matrices, shape [J, k, k]
+    :return: Cholesky factors, and the LinAlgError of each matrix that could
+        not be factorized, None for the others
+    """
+    try:
+        return np.linalg.cholesky(covars), [None] * len(covars)
+    except np.linalg.LinAlgError:
+        pass
+    L = np.zeros_like(covars)
+    errors = [None] * len(covars)
+    for i in range(len(covars)):
+        try:
+            L[i] = np.linalg.cholesky(covars[i])
+        except np.linalg.LinAlgError as e:
+            errors[i] = e
+    return L, errors
 
 
 def exclude_independent_columns(mean, covar, dep_columns):
@@ -40,26 +144,84 @@ def exclude_independent_columns(mean, covar, dep_columns):
     :param dep_columns: The dependent columns to consider
     :return:
     """
-    #
-    nonzero_covar = []
-    nonzero_covar_mean = []
-    for c in range(0, covar.shape[0]):
-        if c in dep_columns:
-            row = []
-            for v in range(0, covar[c].size):
-                if v in dep_columns:
-                    row.append(covar[c, v])
-            nonzero_covar.append(row)
-            nonzero_covar_mean.append(mean[c])
+    columns = np.unique(np.asarray(dep_columns, dtype=int))
+    return (
+        np.asarray(mean)[columns],
+        np.asarray(covar)[np.ix_(columns, columns)],
+    )
 
-    return np.asarray(nonzero_covar_mean), np.array(nonzero_covar)
+
+def exclude_independent_columns_batch(means, covars, columns):
+    """
+    Extract means, covars only for the dependent columns, for a stack of
+    distributions with the same dependent columns
+    :param means: The mean vectors, shape [J, d]
+    :param covars: The covariance matrices, shape [J, d, d]
+    :param columns: The sorted dependent columns to consider
+    :return:
+    """
+    return (
+        means[:, columns],
+        covars[:, columns[:, np.newaxis], columns[np.newaxis, :]],
+    )
+
+
+def summarize(kl):
+    """
+    Summarize the KL-divergences of the validated jobs
+    :param kl: The KL-divergences
+    :return: list of (statistic, value) pairs
+    """
+    kl = np.asarray(kl, dtype=np.float64)
+    finite = kl[np.isfinite(kl)]
+    summary = [("jobs", kl.size), ("non-finite", kl.size - finite.size)]
+    if finite.size > 0:
+        summary.append(("mean", finite.mean()))
+        for q in PERCENTILES:
+            summary.append(("p" + str(q), np.percentile(finite, q)))
+    return summary
+
+
+def write_table(table_path, hash_tags, rows, kl, errors):
+    """
+    Write the per-job validation table, as CSV or, if the path ends with
+    .npy, as a numpy structured array
+    :param table_path: The path of the table
+    :param hash_tags: The hash tags of the jobs
+    :param rows: The number of simulated rows of each job
+    :param kl: The KL-divergence of each job, NaN for the jobs that failed
+    :param errors: The error of each job that failed, None for the others,
+        written as an empty string
+    """
+    messages = ["" if e is None else str(e) for e in errors]
+    if table_path.endswith(".npy"):
+        table = np.empty(
+            len(hash_tags),
+            dtype=[
+                ("HT1", np.asarray(hash_tags, dtype=np.str_).dtype),
+                ("rows", np.int64),
+                ("KL", np.float64),
+                ("error", np.asarray(messages, dtype=np.str_).dtype),
+            ],
+        )
+        table["HT1"] = hash_tags
+        table["rows"] = rows
+        table["KL"] = kl
+        table["error"] = messages
+        np.save(table_path, table)
+        return
+    with open(table_path, "w", newline="\n") as table_file:
+        table_csv = csv.writer(table_file)
+        table_csv.writerow(["HT1", "rows", "KL", "error"])
+        table_csv.writerows(zip(hash_tags, rows, kl, messages))
 
 
 def get_distributions(input_path, int_columns):
     """
     Gather mean, standard deviation, and covariance
     :param input_path: The data set path to compute the distributions for
-    :return:
+    :param int_columns: The list of integer columns
+    :return: mean, covariance, number of rows
     """
     with open(input_path) as csv_file:
         csv_reader = csv.reader(csv_file, delimiter=",")
@@ -77,55 +239,797 @@ def get_distributions(input_path, int_columns):
                 tuples.append(tup)
                 line_count += 1
         data = (np.array(tuples).T).astype(np.float64)
-        return np.mean(data, axis=1), np.cov(data)
+        return np.mean(data, axis=1), np.cov(data), len(tuples)
 
 
-def main():
+def validate_jobs(distributions, jobs, means, covars):
     """
-    Main method
+    Compute the KL-divergences of simulated jobs against their reference
+    distributions
+    :param distributions: The reference distributions
+    :param jobs: The positions of the simulated jobs in the distributions
+    :param means: The mean vector of each simulated job
+    :param covars: The covariance matrix of each simulated job
+    :return: KL-divergences and errors, see kl_divergence_batch
     """
-    # check inputs
-    if len(sys.argv) < 2:
-        print("Usage: Validate.py <distribution-dir> <datagen-dir>")
-        sys.exit(1)
+    d = len(distributions.header)
+    jobs = np.asarray(jobs, dtype=int)
+    return kl_divergence_batch(
+        np.asarray(distributions.mean[jobs]),
+        np.reshape(means, (-1, d)),
+        np.asarray(distributions.cov[jobs]),
+        np.reshape(covars, (-1, d, d)),
+        np.asarray(distributions.dep_mask[jobs]),
+    )
 
-    # command line args
-    dist_path = sys.argv[1]
-    sim_path = sys.argv[2]
 
-    # run the generator
-    with open(os.path.join(dist_path, "distributions.csv")) as dist_file:
-        dist_csv = csv.reader(dist_file, delimiter=",")
+def validate_arrays(distributions, hash_tags, values):
+    """
+    Compute the KL-divergences of simulated jobs held in memory against their
+    reference distributions
+    :param distributions: The reference distributions
+    :param hash_tags: The hash tag of the job of each simulated row, shape [N]
+    :param values: The column values of each simulated row, as written to the
+        CSV files, shape [N, d]
+    :return: hash tags of the jobs in order of first appearance, number of
+        rows of each job, and KL-divergences and errors, see
+        kl_divergence_batch
+    """
+    positions = {
+        str(hash_tag): i for i, hash_tag in enumerate(distributions.hash_tags)
+    }
+    keys, first, inverse = np.unique(
+        np.asarray(hash_tags).astype(str),
+        return_index=True,
+        return_inverse=True,
+    )
+    unknown = [key for key in keys if key not in positions]
+    if len(unknown) > 0:
+        raise KeyError("Jobs without a distribution", unknown)
+    counts, means, comoments = grouped_moments(
+        inverse.reshape(-1), values, keys.size
+    )
+    # report the jobs in order of first appearance
+    order = np.argsort(first, kind="stable")
+    keys, counts, means, comoments = (
+        keys[order],
+        counts[order],
+        means[order],
+        comoments[order],
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        covars = comoments / (counts - 1)[:, None, None]
+    kl, errors = validate_jobs(
+        distributions, [positions[key] for key in keys], means, covars
+    )
+    return keys.tolist(), counts.astype(np.int64), kl, errors
+
 
-        validate_count = 0
-        for ref_dist in dist_csv:
+def report(hash_tags, rows, kl, errors, table_path=None):
+    """
+    Report the validation of the jobs: the errors of the jobs that failed,
+    the per-job table if requested, and summary percentiles
+    :param hash_tags: The hash tags of the jobs
+    :param rows: The number of simulated rows of each job
+    :param kl: The KL-divergence of each job, NaN for the jobs that failed
+    :param errors: The error of each job that failed, None for the others
+    :param table_path: The path of the per-job table, None to not write it
+    :return: The number of jobs validated
+    """
+    for hash_tag, e in zip(hash_tags, errors):
+        if e is not None:
+            print("Group " + hash_tag + ":", e)
+    if table_path is not None:
+        write_table(table_path, hash_tags, rows, kl, errors)
 
-            if len(ref_dist) == 0:
-                continue
+    validated = [k for k, e in zip(kl, errors) if e is None]
+    for name, value in summarize(validated):
+        print(name + ":", value)
+    print("\nValidated " + str(len(validated)) + " jobs.\n")
+    return len(validated)
 
-            sim = os.path.join(sim_path, ref_dist[0])
 
-            if not os.path.isfile(sim):
+def normal_cdf(z):
+    """
+    Standard normal distribution function, with an absolute error below
+    1.5e-7 (Abramowitz and Stegun 7.1.26)
+    :param z: The standardized values
+    :return: probabilities
+    """
+    z = np.asarray(z, dtype=np.float64)
+    x = np.abs(z) / np.sqrt(2)
+    t = 1 / (1 + 0.3275911 * x)
+    poly = t * (
+        0.254829592
+        + t
+        * (
+            -0.284496736
+            + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))
+        )
+    )
+    erf = 1 - poly * np.exp(-x * x)
+    return 0.5 * (1 + np.sign(z) * erf)
+
+
+def read_blocks(path, chunk_rows=STREAM_ROWS, hash_tags=False):
+    """
+    Parse a CSV file with a header in blocks of rows
+    :param path: The file path
+    :param chunk_rows: The number of rows per block
+    :param hash_tags: Whether the first column holds the HT1, as in the
+        consolidated output
+    :return: iterator over the values of the blocks, shape [n, d], preceded
+        by their HT1, shape [n], if hash_tags is set
+    """
+    with open(path) as csv_file:
+        csv_file.readline()
+        while True:
+            lines = [
+                line
+                for line in itertools.islice(csv_file, chunk_rows)
+                if line.strip()
+            ]
+            if not lines:
+                return
+            if not hash_tags:
+                yield np.loadtxt(lines, delimiter=",", ndmin=2)
                 continue
+            fields = np.loadtxt(
+                lines, delimiter=",", dtype=str, quotechar='"', ndmin=2
+            )
+            yield fields[:, 0], fields[:, 1:].astype(np.float64)
+
+
+class MarginalSummary:
+    """
+    Moments and quantile sketch of the simulated instances of a job, which
+    take the same memory whatever the number of instances. The sketch holds
+    the distances of the values to a center, so that its bins are narrow
+    around the center whatever its magnitude.
+    :param d: The number of columns
+    :param relative_accuracy: The relative accuracy of the quantile sketch
+    :param center: The center of every column, 0 by default
+    """
+
+    def __init__(self, d, relative_accuracy=0.01, center=None):
+        self.moments = RunningMoments(d)
+        self.sketch = QuantileSketch(d, relative_accuracy)
+        self.center = (
+            np.zeros(d)
+            if center is None
+            else np.asarray(center, dtype=np.float64)
+        )
+
+    def update_block(self, block):
+        """
+        Add a block of instances
+        :param block: The instances, one per row
+        """
+        self.moments.update_block(block)
+        self.sketch.update_block(block - self.center)
+
+    def merge(self, other):
+        """
+        Add the instances of another summary, of the same center
+        :param other: The other summary
+        """
+        self.moments.merge(other.moments)
+        self.sketch.merge(other.sketch)
+
+    def quantiles(self, j, q):
+        """
+        Estimate quantiles of a column, see QuantileSketch.quantiles
+        :param j: The column
+        :param q: The quantiles, between 0 and 1
+        :return: estimated values, NaN if the summary is empty
+        """
+        return self.center[j] + self.sketch.quantiles(j, q)
+
+    def bins_of(self, j):
+        """
+        Get the bounds and counts of the non-empty bins of a column, see
+        QuantileSketch.bins_of: the bins above the center hold the values in
+        (lower, upper], the bins below it those in [lower, upper), and the
+        center bin is [center, center]
+        :param j: The column
+        :return: ascending lower bounds, upper bounds and counts
+        """
+        lower, upper, counts = self.sketch.bins_of(j)
+        return self.center[j] + lower, self.center[j] + upper, counts
+
+
+def stream_job_files(
+    distributions, sim_path, chunk_rows=STREAM_ROWS, relative_accuracy=0.01
+):
+    """
+    Summarize the simulated jobs from their files under the datagen
+    directory, in a single pass over each file
+    :param distributions: The reference distributions
+    :param sim_path: The datagen directory
+    :param chunk_rows: The number of rows parsed at a time
+    :param relative_accuracy: The relative accuracy of the quantile sketches
+    :return: positions of the jobs in the distributions and their summaries
+    """
+    d = len(distributions.header)
+    jobs = []
+    summaries = []
+    for i, hash_tag in enumerate(distributions.hash_tags):
+        sim = os.path.join(sim_path, str(hash_tag))
+        if not os.path.isfile(sim):
+            continue
+        started = time.perf_counter()
+        summary = MarginalSummary(
+            d, relative_accuracy, np.abs(distributions.mean[i])
+        )
+        with metrics.stage("read"):
+            for block in read_blocks(sim, chunk_rows):
+                summary.update_block(block)
+        metrics.observe("job", time.perf_counter() - started)
+        metrics.count("rows", summary.moments.count)
+        metrics.count("bytes_read", os.path.getsize(sim))
+        jobs.append(i)
+        summaries.append(summary)
+    return jobs, summaries
+
+
+def stream_consolidated(
+    distributions, path, chunk_rows=STREAM_ROWS, relative_accuracy=0.01
+):
+    """
+    Summarize the simulated jobs from the consolidated output, in a single
+    pass. The instances of a job do not need to be contiguous, and the
+    instances of jobs without a distribution are skipped.
+    :param distributions: The reference distributions
+    :param path: The consolidated output path
+    :param chunk_rows: The number of rows parsed at a time
+    :param relative_accuracy: The relative accuracy of the quantile sketches
+    :return: positions of the jobs in the distributions and their summaries,
+        in the order of the distributions
+    """
+    d = len(distributions.header)
+    positions = {
+        str(hash_tag): i for i, hash_tag in enumerate(distributions.hash_tags)
+    }
+    summaries = {}
+    with metrics.stage("read"):
+        for hash_tags, values in read_blocks(path, chunk_rows, True):
+            metrics.count("rows", values.shape[0])
+            keys, inverse = np.unique(hash_tags, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            # sort the rows by job once, rather than masking them per job
+            order = np.argsort(inverse, kind="stable")
+            blocks = np.split(
+                values[order], np.cumsum(np.bincount(inverse))[:-1]
+            )
+            for key, block in zip(keys, blocks):
+                if key not in positions:
+                    continue
+                if key not in summaries:
+                    summaries[key] = MarginalSummary(
+                        d,
+                        relative_accuracy,
+                        np.abs(distributions.mean[positions[key]]),
+                    )
+                summaries[key].update_block(block)
+    metrics.count("bytes_read", os.path.getsize(path))
+    jobs = sorted(positions[key] for key in summaries)
+    return jobs, [summaries[str(distributions.hash_tags[i])] for i in jobs]
+
 
-            mean1 = np.asarray(ast.literal_eval(ref_dist[1]))
-            covar1 = np.asarray(ast.literal_eval(ref_dist[3]))
-            dep_cols = np.asarray(ast.literal_eval(ref_dist[4]))
-            int_cols = np.asarray(ast.literal_eval(ref_dist[5]))
+def written_cdf(y, mean, std, integer):
+    """
+    Distribution function of the values of a normal column as
+    simulate_dataset.py writes them: rounded up for the integer columns, and
+    made absolute (see simulate_dataset.written_values)
+    :param y: The values
+    :param mean: The mean of the normal distribution
+    :param std: The standard deviation of the normal distribution
+    :param integer: Whether the column is an integer column
+    :return: probabilities
+    """
+    y = np.where(integer, np.floor(y), y)
+    # |ceil(x)| <= k for -k - 1 < x <= k, and |x| <= y for -y <= x <= y
+    below = np.where(integer, -y - 1, -y)
+    cdf = normal_cdf((y - mean) / std) - normal_cdf((below - mean) / std)
+    return np.where(y >= 0, np.maximum(cdf, 0), 0.0)
+
+
+def written_cdf_below(y, mean, std, integer):
+    """
+    Probabilities of the values of a normal column as simulate_dataset.py
+    writes them to be below y, see written_cdf
+    :param y: The values
+    :param mean: The mean of the normal distribution
+    :param std: The standard deviation of the normal distribution
+    :param integer: Whether the column is an integer column
+    :return: probabilities
+    """
+    # the integers below y are at most ceil(y) - 1, and the other values
+    # have no mass at a single point
+    return written_cdf(
+        np.where(integer, np.ceil(y) - 1, y), mean, std, integer
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def folded_quantiles(q):
+    """
+    Quantiles of |Z + u| for a standard normal Z, tabulated over u from 0 to
+    FOLDED_MAX by FOLDED_STEP, by bisection
+    :param q: The quantiles, between 0 and 1, as a tuple
+    :return: values, shape [u, k]
+    """
+    q = np.asarray(q, dtype=np.float64)
+    u = np.arange(round(FOLDED_MAX / FOLDED_STEP) + 1)[:, None] * FOLDED_STEP
+    lower = np.zeros((u.size, q.size))
+    upper = np.broadcast_to(u + 10, lower.shape)
+    for _ in range(QUANTILE_ITERATIONS):
+        middle = (lower + upper) / 2
+        above = normal_cdf(middle - u) - normal_cdf(-middle - u) >= q
+        upper = np.where(above, middle, upper)
+        lower = np.where(above, lower, middle)
+    return (lower + upper) / 2
+
+
+def written_quantiles(q, mean, std, integer):
+    """
+    Quantiles of the values of normal columns as simulate_dataset.py writes
+    them, see written_cdf
+    :param q: The quantiles, between 0 and 1, shape [k]
+    :param mean: The means of the columns, shape [c, 1]
+    :param std: The standard deviations of the columns, shape [c, 1]
+    :param integer: Whether the columns are integer columns, shape [c, 1]
+    :return: values, shape [c, k]
+    """
+    # |x| <= y for -y <= x <= y, and |ceil(x)| <= y for -y - 1 < x <= y, so
+    # both fold the normal distribution, around -1/2 for the integer columns
+    shift = np.where(integer, 0.5, 0.0)
+    u = np.abs(mean + shift) / std
+    table = folded_quantiles(tuple(np.asarray(q, dtype=np.float64).ravel()))
+    position = np.minimum(u, FOLDED_MAX) / FOLDED_STEP
+    row = np.minimum(position.astype(np.int64), table.shape[0] - 2)
+    fraction = position - row
+    k = np.arange(table.shape[1])
+    folded = (1 - fraction) * table[row, k] + fraction * table[row + 1, k]
+    # beyond the table, the fold is negligible and the quantiles are shifted
+    folded += np.maximum(u - FOLDED_MAX, 0)
+    values = std * folded - shift
+    # the smallest integer whose distribution function reaches the quantile,
+    # next to the interpolated one
+    rounded = np.maximum(np.ceil(values), 0)
+    rounded = np.where(
+        written_cdf(rounded - 1, mean, std, True) >= q, rounded - 1, rounded
+    )
+    rounded = np.where(
+        written_cdf(rounded, mean, std, True) >= q, rounded, rounded + 1
+    )
+    return np.where(integer, rounded, values)
+
+
+def marginal_distances(summary, mean, std, int_mask):
+    """
+    Compare the marginal distribution of every column of a simulated job
+    with the one of its reference mean and standard deviation, as
+    simulate_dataset.py writes the values
+    :param summary: The MarginalSummary of the simulated instances, centered
+        on the absolute reference means
+    :param mean: The reference mean vector
+    :param std: The reference standard deviation vector
+    :param int_mask: The integer columns, as a mask
+    :return: Wasserstein-1 distances divided by the reference standard
+        deviations, and Kolmogorov-Smirnov distances, NaN for the columns
+        of constant reference, see MIN_SPREAD
+    """
+    d = len(mean)
+    wasserstein = np.full(d, np.nan)
+    ks = np.full(d, np.nan)
+    resolution = np.maximum(np.spacing(np.abs(mean)), summary.sketch.min_value)
+    columns = np.flatnonzero(std > MIN_SPREAD * resolution)
+    if summary.sketch.count == 0 or columns.size == 0:
+        return wasserstein, ks
+    reference = written_quantiles(
+        MARGINAL_QUANTILES,
+        mean[columns, None],
+        std[columns, None],
+        int_mask[columns, None],
+    )
+    bounds, below = [], []
+    for n, j in enumerate(columns):
+        # W1 is the integral of the distance between the quantile functions
+        lower, upper, counts = summary.bins_of(j)
+        simulated = bin_quantiles(lower, upper, counts, MARGINAL_QUANTILES)
+        if int_mask[j]:
+            # the values of an integer column are the integers of their bins
+            simulated = np.round(simulated)
+        wasserstein[j] = np.mean(np.abs(simulated - reference[n])) / std[j]
+        below_upper = np.cumsum(counts) / summary.sketch.count
+        bounds.append((lower, upper))
+        below.append(
+            (below_upper - counts / summary.sketch.count, below_upper)
+        )
+    # KS is the largest distance between the distribution functions,
+    # evaluated at the bounds of the bins, where the empirical one is known.
+    # The bounds of the bins are included above the center and excluded
+    # below it, where the reference distribution function is taken below
+    # the bound. The bins of all the columns are evaluated at once.
+    sizes = np.array([b[0].size for b in bounds])
+    owner = columns[np.repeat(np.arange(columns.size), sizes)]
+    lower, upper = (np.concatenate(b) for b in zip(*bounds))
+    below_lower, below_upper = (np.concatenate(b) for b in zip(*below))
+    mean, std, integer = mean[owner], std[owner], int_mask[owner]
+    center = summary.center[owner]
+    cdf_upper = np.where(
+        upper < center,
+        written_cdf_below(upper, mean, std, integer),
+        written_cdf(upper, mean, std, integer),
+    )
+    cdf_lower = np.where(
+        lower > center,
+        written_cdf(lower, mean, std, integer),
+        written_cdf_below(lower, mean, std, integer),
+    )
+    distance = np.maximum(
+        np.abs(below_upper - cdf_upper), np.abs(below_lower - cdf_lower)
+    )
+    ks[columns] = np.maximum.reduceat(distance, np.cumsum(sizes) - sizes)
+    return wasserstein, ks
+
+
+def draw_marginals(distributions, rows, relative_accuracy=0.01, seed=0):
+    """
+    Summarize instances drawn from the reference marginal distributions of
+    every job, written as simulate_dataset.py writes them, on which the
+    marginal fidelity only reflects the sampling and the sketch resolution
+    :param distributions: The reference distributions
+    :param rows: The number of instances of every job
+    :param relative_accuracy: The relative accuracy of the quantile sketches
+    :param seed: The seed of the draws
+    :return: positions of the jobs in the distributions and their summaries
+    """
+    source = np.random.default_rng(seed)
+    d = len(distributions.header)
+    summaries = []
+    for i in range(len(distributions.hash_tags)):
+        int_mask = np.asarray(distributions.int_mask[i])
+        values = source.normal(
+            distributions.mean[i], distributions.std[i], (rows, d)
+        )
+        values = np.abs(np.where(int_mask, np.ceil(values), values))
+        summary = MarginalSummary(
+            d, relative_accuracy, np.abs(distributions.mean[i])
+        )
+        summary.update_block(values)
+        summaries.append(summary)
+    return list(range(len(summaries))), summaries
+
+
+def report_marginals(distributions, jobs, summaries, table_path=None):
+    """
+    Report the marginal fidelity of every attribute over the jobs, and write
+    the per-job and per-attribute table if requested. The number of jobs in
+    which an attribute is not compared, as its reference is constant, is
+    reported with it.
+    :param distributions: The reference distributions
+    :param jobs: The positions of the simulated jobs in the distributions
+    :param summaries: The MarginalSummary of each job
+    :param table_path: The path of the table, None to not write it
+    :return: p90 over the jobs of the Wasserstein-1 distances divided by the
+        reference standard deviations, of their sketch error bounds and of
+        the Kolmogorov-Smirnov distances, NaN for the attributes not reported
+    """
+    header = list(distributions.header)
+    d = len(header)
+    wasserstein = np.full((len(jobs), d), np.nan)
+    error = np.full((len(jobs), d), np.nan)
+    ks = np.full((len(jobs), d), np.nan)
+    with metrics.stage("marginals"):
+        for n, (i, summary) in enumerate(zip(jobs, summaries)):
+            std = np.asarray(distributions.std[i])
+            wasserstein[n], ks[n] = marginal_distances(
+                summary,
+                np.asarray(distributions.mean[i]),
+                std,
+                np.asarray(distributions.int_mask[i]),
+            )
+            # a quantile of the sketch is off by less than the width of its
+            # bin, twice the relative accuracy of its distance to the center,
+            # whose mean is at most the root mean square distance
+            reported = np.isfinite(wasserstein[n])
+            spread = np.sqrt(
+                summary.moments.std() ** 2
+                + (summary.moments.mean - summary.center) ** 2
+            )
+            error[n, reported] = (
+                2
+                * summary.sketch.relative_accuracy
+                * spread[reported]
+                / std[reported]
+            )
+    if table_path is not None:
+        with open(table_path, "w", newline="\n") as table_file:
+            table_csv = csv.writer(table_file)
+            table_csv.writerow(
+                [
+                    "HT1",
+                    "attribute",
+                    "rows",
+                    "mean",
+                    "std",
+                    "reference_mean",
+                    "reference_std",
+                    "p50",
+                    "p99",
+                    "W1/std",
+                    "W1/std_error",
+                    "KS",
+                ]
+            )
+            for n, (i, summary) in enumerate(zip(jobs, summaries)):
+                std = summary.moments.std()
+                for j in range(d):
+                    p50, p99 = summary.quantiles(j, [0.5, 0.99])
+                    table_csv.writerow(
+                        [
+                            str(distributions.hash_tags[i]),
+                            header[j],
+                            summary.moments.count,
+                            summary.moments.mean[j],
+                            std[j],
+                            distributions.mean[i][j],
+                            distributions.std[i][j],
+                            p50,
+                            p99,
+                            wasserstein[n, j],
+                            error[n, j],
+                            ks[n, j],
+                        ]
+                    )
+
+    p90 = np.full((3, d), np.nan)
+    skipped = []
+    print("Marginal fidelity (p50 and p90 over the jobs):")
+    for j in range(d):
+        reported = np.isfinite(wasserstein[:, j])
+        if not reported.any():
+            skipped.append(header[j])
+            continue
+        constant = len(jobs) - reported.sum()
+        w50, p90[0, j] = np.percentile(wasserstein[reported, j], [50, 90])
+        p90[1, j] = np.percentile(error[reported, j], 90)
+        k50, p90[2, j] = np.percentile(ks[reported, j], [50, 90])
+        print(
+            "{}: W1/std {:.4g} {:.4g} (sketch error below {:.2g}) "
+            "KS {:.4g} {:.4g} over {} jobs{}".format(
+                header[j],
+                w50,
+                p90[0, j],
+                p90[1, j],
+                k50,
+                p90[2, j],
+                reported.sum(),
+                (
+                    ", not compared in {} jobs of constant reference".format(
+                        constant
+                    )
+                    if constant
+                    else ""
+                ),
+            )
+        )
+    if skipped:
+        print(
+            "Not compared, as their reference is constant in every job: "
+            + ", ".join(skipped)
+        )
+    return p90
+
+
+def check_marginals(distributions, rows, relative_accuracy=0.01, seed=0):
+    """
+    Check that the marginal fidelity is close to 0 for instances drawn from
+    the reference marginal distributions, see draw_marginals
+    :param distributions: The reference distributions
+    :param rows: The number of instances of every job
+    :param relative_accuracy: The relative accuracy of the quantile sketches
+    :param seed: The seed of the draws
+    :return: the attributes whose p90 distances exceed the tolerance
+    """
+    jobs, summaries = draw_marginals(
+        distributions, rows, relative_accuracy, seed
+    )
+    wasserstein, error, ks = report_marginals(distributions, jobs, summaries)
+    # the sampling alone leaves distances of the order of 1 / sqrt(rows)
+    tolerance = 2 / np.sqrt(rows)
+    failed = (wasserstein > tolerance + error) | (ks > tolerance)
+    return [distributions.header[j] for j in np.flatnonzero(failed)]
+
+
+def parse_args():
+    """
+    Parse the command line arguments
+    :return: the parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        usage="Validate.py <distribution-dir> <datagen-dir> [options]"
+    )
+    parser.add_argument("dist_path", metavar="distribution-dir")
+    parser.add_argument("sim_path", metavar="datagen-dir", nargs="?")
+    parser.add_argument(
+        "--table",
+        default=None,
+        help="write the KL-divergence of every job to this path, as CSV or "
+        "as a numpy structured array if it ends with .npy",
+    )
+    parser.add_argument(
+        "--hash-tags",
+        default=None,
+        help="only validate the jobs with these comma separated HT1, read "
+        "through the index of distributions.csv",
+    )
+    parser.add_argument(
+        "--hash-tag-file",
+        default=None,
+        help="only validate the jobs whose HT1 are listed in this file, one "
+        "per line",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="read the simulated jobs in blocks of rows, keeping only their "
+        "moments and quantile sketches, and also report the fidelity of the "
+        "marginal distribution of every attribute",
+    )
+    parser.add_argument(
+        "--consolidated",
+        default=None,
+        help="stream this consolidated output instead of the job files of "
+        "the datagen directory, implies --stream",
+    )
+    parser.add_argument(
+        "--chunk-rows",
+        type=int,
+        default=STREAM_ROWS,
+        help="number of rows parsed at a time by --stream",
+    )
+    parser.add_argument(
+        "--relative-accuracy",
+        type=float,
+        default=0.01,
+        help="relative accuracy of the quantile sketches of --stream",
+    )
+    parser.add_argument(
+        "--marginal-table",
+        default=None,
+        help="with --stream, write the marginal fidelity of every job and "
+        "attribute to this path as CSV",
+    )
+    parser.add_argument(
+        "--check-marginals",
+        type=int,
+        default=None,
+        metavar="ROWS",
+        help="instead of validating simulated jobs, draw this many instances "
+        "of every job from its reference marginal distributions and check "
+        "that their marginal fidelity is close to 0",
+    )
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    if args.check_marginals is not None:
+        if args.check_marginals < 1:
+            parser.error("--check-marginals must be positive")
+    elif args.sim_path is None and args.consolidated is None:
+        parser.error("the datagen directory is required")
+    if args.consolidated is not None:
+        args.stream = True
+    if args.chunk_rows < 1:
+        parser.error("--chunk-rows must be positive")
+    if not 0 < args.relative_accuracy < 1:
+        parser.error("--relative-accuracy must be between 0 and 1")
+    if args.marginal_table is not None and not args.stream:
+        parser.error("--marginal-table requires --stream")
+    args.hash_tags = distribution_store.read_hash_tags(
+        args.hash_tags, args.hash_tag_file
+    )
+    return args
+
+
+def main():
+    """
+    Main method
+    """
+    args = parse_args()
+    metrics.configure(args)
+
+    # command line args
+    dist_path = args.dist_path
+    sim_path = args.sim_path
+
+    # run the generator, reading the reference distributions from the binary
+    # store if there is one, or only the selected ones through the index
+    with metrics.stage("load"):
+        if args.hash_tags is None:
+            distributions = distribution_store.load(dist_path)
+        else:
+            distributions, missing = distribution_store.select(
+                dist_path, args.hash_tags
+            )
+            for hash_tag in missing:
+                print("Unknown HT1 " + hash_tag + ".")
+
+    if args.check_marginals is not None:
+        failed = check_marginals(
+            distributions, args.check_marginals, args.relative_accuracy
+        )
+        metrics.finish(args, "validate.py")
+        if failed:
+            print("Marginal fidelity off for: " + ", ".join(failed))
+            sys.exit(1)
+        return
+
+    if args.stream:
+        if args.consolidated is not None:
+            jobs, summaries = stream_consolidated(
+                distributions,
+                args.consolidated,
+                args.chunk_rows,
+                args.relative_accuracy,
+            )
+        else:
+            jobs, summaries = stream_job_files(
+                distributions,
+                sim_path,
+                args.chunk_rows,
+                args.relative_accuracy,
+            )
+        with metrics.stage("kl"):
+            kl, errors = validate_jobs(
+                distributions,
+                jobs,
+                [summary.moments.mean for summary in summaries],
+                [summary.moments.covariance() for summary in summaries],
+            )
+        metrics.count("jobs", len(jobs))
+        metrics.count(
+            "failed_factorizations", sum(e is not None for e in errors)
+        )
+        hash_tags = [str(distributions.hash_tags[i]) for i in jobs]
+        rows = [summary.moments.count for summary in summaries]
+        report(hash_tags, rows, kl, errors, args.table)
+        report_marginals(distributions, jobs, summaries, args.marginal_table)
+        metrics.finish(args, "validate.py")
+        return
 
-            mean2, covar2 = get_distributions(sim, int_cols)
+    # gather the moments of the simulated jobs
+    jobs = []
+    rows = []
+    means = []
+    covars = []
+    for i, hash_tag in enumerate(distributions.hash_tags):
+        sim = os.path.join(sim_path, str(hash_tag))
 
-            try:
-                klb = mv_kullback_leibler_divergence(
-                    mean1, mean2, covar1, covar2, dep_cols
-                )
-                print("Group " + ref_dist[0] + ":", klb)
-                validate_count += 1
+        if not os.path.isfile(sim):
+            continue
 
-            except Exception as e:
-                print(e)
+        _, _, _, _, _, int_cols = distributions.job(i)
+        started = time.perf_counter()
+        with metrics.stage("read"):
+            mean2, covar2, count = get_distributions(sim, int_cols)
+        metrics.observe("job", time.perf_counter() - started)
+        metrics.count("rows", count)
+        metrics.count("bytes_read", os.path.getsize(sim))
+        jobs.append(i)
+        rows.append(count)
+        means.append(mean2)
+        covars.append(covar2)
 
-        print("\nValidated " + str(validate_count) + " jobs.\n")
+    with metrics.stage("kl"):
+        kl, errors = validate_jobs(distributions, jobs, means, covars)
+    metrics.count("jobs", len(jobs))
+    metrics.count("failed_factorizations", sum(e is not None for e in errors))
+    hash_tags = [str(distributions.hash_tags[i]) for i in jobs]
+    report(hash_tags, rows, kl, errors, args.table)
+    metrics.finish(args, "validate.py")
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Shared fixtures of the datagen tests.
+"""
+import csv
+import os
+import subprocess
+import sys
+import numpy as np
+import pytest
+
+DATAGEN = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "datagen"
+)
+sys.path.insert(0, DATAGEN)
+
+import distribution_store  # noqa: E402
+
+AUTOTOKEN_HEADER = [
+    "JobId",
+    "VC",
+    "HT1",
+    "HT2",
+    "HT3",
+    "EstCardinality",
+    "InputCardinality",
+    "InputChildrenCardinality",
+    "AvgRowLength",
+    "EstCost",
+    "EstExclusiveCost",
+    "VertexCount",
+    "RequestedTokens",
+    "ActualMaxTokens",
+    "SubmitOffset",
+    "WaitTime",
+    "RunTime",
+]
+
+
+def write_autotoken_input(path, jobs=40, rows=3000, seed=0, first=0):
+    """
+    Write a synthetic AutoToken input, where about half of the columns of
+    every job are constant, with values that are not exact in binary, so that
+    merged moments of these columns pick up rounding errors
+    :param path: The path of the input
+    :param jobs: The number of jobs
+    :param rows: The number of rows
+    :param seed: The seed of the values
+    :param first: The index of the first row, for inputs that follow others
+    """
+    specs = np.random.default_rng(seed)
+    d = len(AUTOTOKEN_HEADER)
+    constant = specs.random((jobs, d)) < 0.5
+    value = np.round(specs.random((jobs, d)) * 100) + specs.random((jobs, d))
+    scale = specs.random((jobs, d)) * 10 + 1
+    rng = np.random.default_rng([seed, first])
+    job = rng.integers(0, jobs, rows)
+    noise = rng.standard_normal((rows, d))
+    values = np.where(
+        constant[job], value[job], value[job] + scale[job] * noise
+    )
+    with open(path, "w", newline="") as input_file:
+        writer = csv.writer(input_file)
+        writer.writerow(AUTOTOKEN_HEADER)
+        for n, (g, x) in enumerate(zip(job, values)):
+            writer.writerow(
+                [str(first + n), repr(float(x[1])), str(1000 + g)]
+                + [repr(float(v)) for v in x[3:]]
+            )
+    return path
+
+
+@pytest.fixture
+def autotoken_input(tmp_path):
+    """
+    Path of a synthetic AutoToken input, see write_autotoken_input
+    """
+    return write_autotoken_input(str(tmp_path / "input.csv"))
+
+
+def run_script(script, *args):
+    """
+    Run a datagen script, failing on a non-zero exit code
+    :param script: The script name
+    :param args: The command line arguments
+    """
+    subprocess.run(
+        [sys.executable, os.path.join(DATAGEN, script)]
+        + [str(arg) for arg in args],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def extract(input_file, dist_path, *options):
+    """
+    Extract the distributions of all jobs with at least 2 instances
+    :param input_file: The AutoToken input
+    :param dist_path: The distribution directory
+    :param options: The options of extract_inputs.py
+    :return: distribution_store.Distributions
+    """
+    extract_path = dist_path + "_extract"
+    if not os.path.exists(extract_path):
+        os.mkdir(extract_path)
+    run_script(
+        "extract_inputs.py",
+        input_file,
+        extract_path,
+        dist_path,
+        1000,
+        2,
+        *options
+    )
+    return distribution_store.read_csv(dist_path)
+
+
+def assert_same_distributions(a, b):
+    """
+    Check that two sets of distributions hold the same jobs with the same
+    dependent columns, and the same moments up to rounding
+    """
+    assert list(a.header) == list(b.header)
+    assert a.hash_tags.tolist() == b.hash_tags.tolist()
+    assert np.array_equal(a.dep_mask, b.dep_mask)
+    assert np.array_equal(a.int_mask, b.int_mask)
+    # the constant columns have no variance at all, whatever the path
+    assert np.array_equal(a.std == 0, b.std == 0)
+    assert np.allclose(a.mean, b.mean, rtol=1e-12, atol=0)
+    assert np.allclose(a.std, b.std, rtol=1e-9, atol=0)
+    assert np.allclose(a.cov, b.cov, rtol=1e-9, atol=1e-12)
@@ -0,0 +1,92 @@
+"""Tests of the single-pass extraction of extract_inputs.py.
+"""
+import numpy as np
+import pytest
+import extract_inputs
+from moments import RunningMoments
+
+
+def single_pass(input_file, buffer_rows):
+    """
+    Extract the moments and dependent columns of every job in a single pass
+    """
+    _, hash_tags, moments = extract_inputs.accumulate_groups(
+        input_file,
+        extract_inputs.HASH_TAG,
+        extract_inputs.HASH_TAG,
+        extract_inputs.COLUMNS,
+        extract_inputs.INT_COLUMNS,
+        max_groups=None,
+        support_threshold=2,
+        buffer_rows=buffer_rows,
+    )
+    covars, _ = extract_inputs.moment_distributions(
+        np.array([m.count for m in moments]),
+        np.array([m.comoment for m in moments]),
+    )
+    return dict(
+        zip(hash_tags, extract_inputs.get_dependent_columns_batch(covars))
+    ), dict(zip(hash_tags, moments))
+
+
+def two_pass(input_file, extract_path):
+    """
+    Extract the dependent columns of every job from the per-job files
+    """
+    files, hash_tags = extract_inputs.group_inputs(
+        input_file,
+        extract_inputs.HASH_TAG,
+        extract_inputs.HASH_TAG,
+        extract_inputs.COLUMNS,
+        extract_path,
+        None,
+        2,
+    )
+    int_columns = extract_inputs.shift_columns(
+        extract_inputs.COLUMNS, extract_inputs.INT_COLUMNS
+    )
+    return {
+        hash_tag: extract_inputs.get_distributions(path, int_columns)[
+            4
+        ].tolist()
+        for path, hash_tag in zip(files, hash_tags)
+    }
+
+
+@pytest.mark.parametrize("buffer_rows", [1, 7, 100, 1000])
+def test_dependent_columns_do_not_depend_on_buffering(
+    autotoken_input, buffer_rows
+):
+    expected, _ = single_pass(autotoken_input, 10 ** 9)
+    dep_cols, moments = single_pass(autotoken_input, buffer_rows)
+    assert dep_cols == expected
+    for m in moments.values():
+        constant = m.minimum == m.maximum
+        assert constant.any()
+        assert not m.comoment[constant].any()
+        assert not m.comoment[:, constant].any()
+        assert np.array_equal(m.mean[constant], m.minimum[constant])
+
+
+def test_single_pass_matches_two_pass(autotoken_input, tmp_path):
+    (tmp_path / "extract").mkdir()
+    expected = two_pass(autotoken_input, str(tmp_path / "extract"))
+    dep_cols, _ = single_pass(autotoken_input, 100)
+    assert dep_cols == expected
+
+
+def test_running_moments_merge_keeps_constant_columns_exact():
+    rng = np.random.default_rng(0)
+    block = np.column_stack([np.full(1000, 0.1), rng.normal(size=1000)])
+    whole = RunningMoments(2)
+    whole.update_block(block)
+    merged = RunningMoments(2)
+    for part in np.array_split(block, 13):
+        merged.update_block(part)
+    one_by_one = RunningMoments(2)
+    for x in block[:50]:
+        one_by_one.update(x)
+    for m in [whole, merged, one_by_one]:
+        assert m.mean[0] == 0.1
+        assert m.comoment[0, 0] == 0 and m.comoment[0, 1] == 0
+    assert np.allclose(merged.comoment, whole.comoment)
@@ -0,0 +1,67 @@
+"""Tests of the parallel extraction of ingest.py.
+"""
+import os
+import numpy as np
+import pytest
+import extract_inputs
+import ingest
+from conftest import assert_same_distributions, extract
+
+
+def test_byte_ranges_cover_the_lines(autotoken_input):
+    with open(autotoken_input, "rb") as input_file:
+        lines = input_file.read().splitlines(keepends=True)
+    _, ranges = ingest.split_byte_ranges(autotoken_input, 7)
+    assert ranges[0][0] == len(lines[0])
+    assert ranges[-1][1] == os.path.getsize(autotoken_input)
+    ends = np.cumsum([len(line) for line in lines])
+    for (_, end), (start, _) in zip(ranges, ranges[1:]):
+        assert end == start and end in ends
+
+
+@pytest.mark.parametrize("range_bytes", [4096, 30000])
+def test_parallel_moments_match_serial(autotoken_input, range_bytes):
+    _, hash_tags, serial = extract_inputs.accumulate_groups(
+        autotoken_input,
+        extract_inputs.HASH_TAG,
+        extract_inputs.HASH_TAG,
+        extract_inputs.COLUMNS,
+        extract_inputs.INT_COLUMNS,
+        max_groups=None,
+        support_threshold=2,
+    )
+    _, moments, parallel_hash_tags = ingest.accumulate_groups_parallel(
+        autotoken_input,
+        extract_inputs.HASH_TAG,
+        extract_inputs.HASH_TAG,
+        extract_inputs.COLUMNS,
+        extract_inputs.INT_COLUMNS,
+        2,
+        range_bytes,
+    )
+    parallel_tags, parallel = extract_inputs.select_groups(
+        moments, parallel_hash_tags, None, 2
+    )
+    assert parallel_tags == hash_tags
+    for a, b in zip(serial, parallel):
+        assert a.count == b.count
+        assert np.array_equal(a.minimum, b.minimum)
+        assert np.array_equal(a.maximum, b.maximum)
+        constant = a.minimum == a.maximum
+        assert np.array_equal(a.mean[constant], b.mean[constant])
+        assert not b.comoment[constant].any()
+        assert np.allclose(a.comoment, b.comoment, rtol=1e-9, atol=1e-9)
+
+
+def test_parallel_extraction_matches_serial(autotoken_input, tmp_path):
+    serial = extract(
+        autotoken_input, str(tmp_path / "serial"), "--single-pass"
+    )
+    parallel = extract(
+        autotoken_input,
+        str(tmp_path / "parallel"),
+        "--single-pass",
+        "--workers",
+        3,
+    )
+    assert_same_distributions(serial, parallel)
@@ -0,0 +1,37 @@
+"""Tests of the profiles of the worker processes in metrics.py.
+"""
+import multiprocessing
+import os
+import pstats
+import metrics
+
+
+def profiled_task(n):
+    """
+    Run the profiled stage in a worker process, see simulate_dataset.py
+    """
+    metrics.current.reset()
+    with metrics.stage("work"):
+        sum(range(n))
+    metrics.current.dump_profile(per_process=True)
+    return metrics.current.snapshot()
+
+
+def test_worker_profiles_are_merged_into_the_run_profile(tmp_path):
+    path = str(tmp_path / "work.prof")
+    metrics.current = metrics.Metrics()
+    metrics.current.set_profile("work", "cprofile", path)
+    with multiprocessing.Pool(2) as pool:
+        for snapshot in pool.imap(profiled_task, [10000] * 4):
+            metrics.current.merge(snapshot)
+    assert len(metrics.current.profile_parts) > 0
+    metrics.current.dump_profile()
+    report = metrics.current.report("test")
+    assert report["profile"]["path"] == path
+    assert report["profile"]["process_paths"] == []
+    assert os.listdir(tmp_path) == ["work.prof"]
+    calls = {
+        function[2]: stat[0]
+        for function, stat in pstats.Stats(path).stats.items()
+    }
+    assert calls["<built-in method builtins.sum>"] == 4
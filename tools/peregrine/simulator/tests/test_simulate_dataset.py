@@ -0,0 +1,212 @@
+"""Tests of the equivalence of the outputs of simulate_dataset.py.
+"""
+import csv
+import filecmp
+import json
+import os
+import subprocess
+import numpy as np
+import pytest
+import checkpoint
+import columnar
+import distribution_store
+import shards
+import simulate_dataset
+from conftest import DATAGEN, run_script
+
+DISTRIBUTIONS = os.path.join(
+    DATAGEN, os.pardir, "distributions", "Trace2", "testing_distributions"
+)
+SIZE = 40
+SEED = 7
+
+
+def simulate(path, *options):
+    """
+    Simulate the test distributions into a consolidated output
+    :param path: The consolidated output path
+    :param options: The options of simulate_dataset.py
+    :return: the consolidated output path
+    """
+    run_script(
+        "simulate_dataset.py",
+        DISTRIBUTIONS,
+        path + "_sim",
+        path,
+        SIZE,
+        "--seed",
+        SEED,
+        "--no-job-files",
+        *options
+    )
+    return path
+
+
+def read_csv_output(path):
+    """
+    Read a CSV consolidated output
+    :return: header, hash tag of every row and values
+    """
+    with open(path, newline="") as output_file:
+        rows = list(csv.reader(output_file))
+    values = np.array([[float(cell) for cell in row[1:]] for row in rows[1:]])
+    return rows[0], [row[0] for row in rows[1:]], values
+
+
+def read_columnar_output(path):
+    """
+    Read a columnar consolidated output, see read_csv_output
+    """
+    header = [spec["name"] for spec in columnar.read_manifest(path)["columns"]]
+    columns = columnar.read_columns(path, mmap_mode=None)
+    values = np.column_stack(
+        [columns[name].astype(np.float64) for name in header[1:]]
+    )
+    return header, columnar.read_hash_tags(path).tolist(), values
+
+
+def rows_by_job(hash_tags, values):
+    """
+    Group the rows of an output by job, checking that every job is
+    contiguous
+    :return: dict of hash tag to values
+    """
+    starts = [0] + [
+        i for i in range(1, len(hash_tags)) if hash_tags[i] != hash_tags[i - 1]
+    ]
+    jobs = {}
+    for start, stop in zip(starts, starts[1:] + [len(hash_tags)]):
+        assert hash_tags[start] not in jobs
+        jobs[hash_tags[start]] = values[start:stop]
+    return jobs
+
+
+@pytest.fixture(scope="module")
+def outputs(tmp_path_factory):
+    """
+    The outputs of the serial runs, in whole jobs and in chunks
+    """
+    path = tmp_path_factory.mktemp("reference")
+    return {
+        None: simulate(str(path / "whole.csv")),
+        25: simulate(str(path / "chunked.csv"), "--chunk-rows", 25),
+    }
+
+
+@pytest.mark.parametrize("chunk_rows", [None, 25])
+@pytest.mark.parametrize(
+    "options",
+    [
+        ["--workers", 3],
+        ["--pipeline-depth", 2],
+        ["--workers", 2, "--pipeline-depth", 3],
+    ],
+)
+def test_workers_and_pipeline_leave_the_output_unchanged(
+    tmp_path, outputs, chunk_rows, options
+):
+    if chunk_rows is not None:
+        options = options + ["--chunk-rows", chunk_rows]
+    output = simulate(str(tmp_path / "out.csv"), *options)
+    assert filecmp.cmp(output, outputs[chunk_rows], shallow=False)
+
+
+def test_chunks_of_a_whole_job_leave_the_output_unchanged(tmp_path, outputs):
+    output = simulate(str(tmp_path / "out.csv"), "--chunk-rows", SIZE)
+    assert filecmp.cmp(output, outputs[None], shallow=False)
+
+
+def test_chunked_jobs_are_regenerated_from_the_seed_manifest(outputs):
+    _, hash_tags, values = read_csv_output(outputs[25])
+    jobs = rows_by_job(hash_tags, values)
+    distributions = distribution_store.load(DISTRIBUTIONS)
+    for i in range(0, len(distributions.hash_tags), 50):
+        hash_tag = str(distributions.hash_tags[i])
+        rows = simulate_dataset.regenerate_job(
+            outputs[25] + ".seeds.json", hash_tag
+        )
+        int_cols = np.flatnonzero(distributions.int_mask[i])
+        np.testing.assert_array_equal(
+            simulate_dataset.written_values(rows, int_cols), jobs[hash_tag]
+        )
+
+
+@pytest.mark.parametrize("batch_values", [1, simulate_dataset.BATCH_VALUES])
+def test_batches_leave_the_values_unchanged(
+    monkeypatch, outputs, batch_values
+):
+    # a single value per batch generates every job on its own
+    monkeypatch.setattr(simulate_dataset, "BATCH_VALUES", batch_values)
+    simulator = simulate_dataset.DatasetSimulator(DISTRIBUTIONS, seed=SEED)
+    hash_tags, values = simulator.generate(rows=SIZE)
+    _, expected_tags, expected = read_csv_output(outputs[None])
+    assert hash_tags.tolist() == expected_tags
+    np.testing.assert_array_equal(values, expected)
+
+
+def test_resumed_run_matches_an_uninterrupted_run(tmp_path, outputs):
+    output = simulate(str(tmp_path / "out.csv"), "--resume")
+    assert filecmp.cmp(output, outputs[None], shallow=False)
+    # interrupt the run after a third of the jobs were recorded, in the
+    # middle of the next job
+    manifest_path = checkpoint.progress_path(output)
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    recorded = len(manifest["jobs"]) // 3
+    torn = manifest["jobs"][recorded]
+    manifest["jobs"] = manifest["jobs"][:recorded]
+    manifest["end"] = torn["offset"]
+    with open(manifest_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.truncate(output, torn["offset"] + torn["bytes"] // 2)
+    simulate(output, "--resume", "--workers", 2)
+    assert filecmp.cmp(output, outputs[None], shallow=False)
+
+
+def test_resume_rejects_an_output_shorter_than_recorded(tmp_path):
+    output = simulate(str(tmp_path / "out.csv"), "--resume")
+    os.truncate(output, os.path.getsize(output) // 2)
+    with pytest.raises(subprocess.CalledProcessError):
+        simulate(output, "--resume")
+
+
+def test_columnar_output_holds_the_csv_values(tmp_path, outputs):
+    output = simulate(str(tmp_path / "out"), "--format", "columnar")
+    header, hash_tags, values = read_columnar_output(output)
+    expected_header, expected_tags, expected = read_csv_output(outputs[None])
+    assert header == expected_header
+    assert hash_tags == expected_tags
+    np.testing.assert_array_equal(values, expected)
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        ["--shards", 3],
+        ["--shards", 3, "--shard-by", "round-robin", "--workers", 2],
+        ["--shards", 2, "--format", "columnar", "--max-shard-bytes", 20000],
+    ],
+)
+def test_sharded_output_holds_the_csv_values(tmp_path, outputs, options):
+    output = simulate(str(tmp_path / "out"), *options)
+    _, expected_tags, expected = read_csv_output(outputs[None])
+    expected_jobs = rows_by_job(expected_tags, expected)
+    manifest = shards.read_manifest(output)
+    jobs = {}
+    for entry in manifest["files"]:
+        path = os.path.join(output, entry["file"])
+        if os.path.isdir(path):
+            _, hash_tags, values = read_columnar_output(path)
+        else:
+            _, hash_tags, values = read_csv_output(path)
+        assert len(hash_tags) == entry["rows"]
+        shard_jobs = rows_by_job(hash_tags, values)
+        if "--shard-by" not in options:
+            for hash_tag in shard_jobs:
+                assert shards.shard_of(hash_tag, options[1]) == entry["shard"]
+        # every job is written whole to a single file
+        assert not set(shard_jobs) & set(jobs)
+        jobs.update(shard_jobs)
+    assert sorted(jobs) == sorted(expected_jobs)
+    for hash_tag, values in expected_jobs.items():
+        np.testing.assert_array_equal(jobs[hash_tag], values)
@@ -0,0 +1,31 @@
+"""Tests of folding new inputs into distributions with update_distributions.py.
+"""
+import pytest
+import distribution_store
+from conftest import (
+    assert_same_distributions,
+    extract,
+    run_script,
+    write_autotoken_input,
+)
+
+
+@pytest.mark.parametrize("options", [[], ["--single-pass"]])
+def test_update_matches_extraction_of_all_inputs(tmp_path, options):
+    first = write_autotoken_input(str(tmp_path / "a.csv"), rows=1500)
+    second = write_autotoken_input(
+        str(tmp_path / "b.csv"), rows=1500, first=1500
+    )
+    with open(tmp_path / "ab.csv", "w") as both:
+        with open(first) as first_file:
+            both.write(first_file.read())
+        with open(second) as second_file:
+            both.writelines(second_file.readlines()[1:])
+
+    extract(first, str(tmp_path / "updated"), *options)
+    run_script(
+        "update_distributions.py", tmp_path / "updated", "--input", second
+    )
+    expected = extract(str(tmp_path / "ab.csv"), str(tmp_path / "all"))
+    updated = distribution_store.read_csv(str(tmp_path / "updated"))
+    assert_same_distributions(updated, expected)
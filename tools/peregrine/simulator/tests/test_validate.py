@@ -0,0 +1,80 @@
+"""Tests of the marginal fidelity of validate.py.
+"""
+import csv
+import numpy as np
+import pytest
+import validate
+
+
+def bisected_quantiles(q, mean, std, integer):
+    """
+    Invert the written distribution function of a column by bisection
+    """
+    lower = np.full(q.shape, -1.0)
+    upper = np.full(q.shape, abs(mean) + 12 * std + 1)
+    for _ in range(60):
+        middle = (lower + upper) / 2
+        above = validate.written_cdf(middle, mean, std, integer) >= q
+        upper = np.where(above, middle, upper)
+        lower = np.where(above, lower, middle)
+    return np.floor(upper) if integer else upper
+
+
+@pytest.mark.parametrize("integer", [False, True])
+def test_written_quantiles_invert_the_written_distribution(integer):
+    source = np.random.default_rng(0)
+    q = validate.MARGINAL_QUANTILES
+    for _ in range(200):
+        mean = source.normal() * 10 ** source.uniform(-2, 4)
+        std = abs(mean) * 10 ** source.uniform(-1.5, 1.5)
+        quantiles = validate.written_quantiles(
+            q, np.array([[mean]]), np.array([[std]]), np.array([[integer]])
+        )[0]
+        expected = bisected_quantiles(q, mean, std, integer)
+        np.testing.assert_allclose(quantiles, expected, atol=1e-4 * std)
+        if integer:
+            np.testing.assert_array_equal(quantiles, np.round(quantiles))
+
+
+def test_narrow_columns_are_compared_and_noise_is_not():
+    source = np.random.default_rng(1)
+    # a narrow column far from 0, a narrow integer column, and a column
+    # whose standard deviation is rounding noise
+    mean = np.array([3.6e6, 5e4, 27.2])
+    std = np.array([3.6e3, 40.0, 3e-15])
+    int_mask = np.array([False, True, False])
+    values = source.normal(mean, std, (4000, 3))
+    values = np.abs(np.where(int_mask, np.ceil(values), values))
+    summary = validate.MarginalSummary(3, 0.01, np.abs(mean))
+    summary.update_block(values)
+    wasserstein, ks = validate.marginal_distances(summary, mean, std, int_mask)
+    assert np.all(wasserstein[:2] < 0.1)
+    assert np.all(ks[:2] < 0.05)
+    assert np.isnan(wasserstein[2]) and np.isnan(ks[2])
+
+
+def test_npy_and_csv_tables_hold_the_same_rows(tmp_path):
+    hash_tags = ["101", "202", "303"]
+    rows = [10, 20, 30]
+    kl = np.array([0.5, np.nan, 1.5])
+    errors = [
+        None,
+        np.linalg.LinAlgError("Matrix is not positive definite"),
+        None,
+    ]
+    validate.write_table(str(tmp_path / "t.csv"), hash_tags, rows, kl, errors)
+    validate.write_table(str(tmp_path / "t.npy"), hash_tags, rows, kl, errors)
+    with open(tmp_path / "t.csv", newline="") as table_file:
+        table_csv = list(csv.DictReader(table_file))
+    table = np.load(tmp_path / "t.npy")
+    assert list(table.dtype.names) == list(table_csv[0])
+    for row, expected in zip(table, table_csv):
+        assert row["HT1"] == expected["HT1"]
+        assert row["rows"] == int(expected["rows"])
+        np.testing.assert_equal(row["KL"], float(expected["KL"]))
+        assert row["error"] == expected["error"]
+    assert table["error"].tolist() == [
+        "",
+        "Matrix is not positive definite",
+        "",
+    ]